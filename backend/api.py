@@ -3,15 +3,31 @@ FastAPI server for next-item prediction.
 Loads trained PyTorch model and serves predictions via REST API.
 """
 
-from fastapi import FastAPI, HTTPException
+from fastapi import FastAPI, HTTPException, Header, Request, WebSocket, WebSocketDisconnect
+from fastapi.exceptions import RequestValidationError
 from fastapi.middleware.cors import CORSMiddleware
-from pydantic import BaseModel, Field
+from fastapi.responses import PlainTextResponse, Response
+from pydantic import BaseModel, Field, ValidationError
+from email.message import Message
+from functools import lru_cache
 from typing import List, Optional
-import torch
-import pickle
+import asyncio
+import json
+import secrets
+import threading
+import time
+import traceback
 import os
 
-from model import NextItemPredictor
+import numpy as np
+
+from bundle_base import BaseBundle, IncrementalCart
+from coalescing import SingleFlight
+from filtering import StockList
+from reranking import MMRConfig
+import binary_protocol
+from cart_session import CartDelta, CartSession
+import metrics
 
 
 # Pydantic models for API
@@ -24,6 +40,18 @@ class PredictRequest(BaseModel):
     cart: List[CartItem]
     user_id: Optional[str] = None
     top_k: int = Field(default=10, ge=1, le=50)
+    # Business rules, applied before top-k (see filtering.py)
+    exclude_cart_items: bool = False
+    include_departments: Optional[List[str]] = None
+    exclude_departments: Optional[List[str]] = None
+    include_aisles: Optional[List[str]] = None
+    exclude_aisles: Optional[List[str]] = None
+    exclude_product_ids: Optional[List[str]] = None
+    # Diversity re-ranking of the top candidates (see reranking.py); 0 = off
+    diversity: float = Field(default=0.0, ge=0, le=1)
+    diversity_candidates: int = Field(default=200, ge=1, le=1000)
+    aisle_penalty: float = Field(default=0.1, ge=0)
+    department_penalty: float = Field(default=0.0, ge=0)
 
 
 class PredictionItem(BaseModel):
@@ -40,47 +68,269 @@ class PredictResponse(BaseModel):
     co_purchase: List[dict] = []  # Can be extended later
 
 
-# Global model and vocabulary
-model = None
-vocabulary = None
-device = None
+# Inference backend: torch (checkpoints) or onnx (ONNX Runtime on the CPU,
+# models exported by scripts/export_onnx.py; torch is never imported)
+INFERENCE_BACKEND = os.environ.get("INFERENCE_BACKEND", "torch")
+if INFERENCE_BACKEND not in ("torch", "onnx"):
+    raise ValueError(f"Unknown INFERENCE_BACKEND: {INFERENCE_BACKEND} (expected torch or onnx)")
+
+# ONNX Runtime threads per prediction (0 = all cores)
+ONNX_THREADS = int(os.environ.get("ONNX_THREADS", "0"))
+
+# Artifact locations (overridable for benchmarks and multi-model deployments)
+if INFERENCE_BACKEND == "onnx":
+    DEFAULT_MODEL_PATH = "./models/best_model.onnx"
+elif os.path.exists("./models/best_model.safetensors"):
+    # Memory-mapped copy the training scripts write next to best_model.pt
+    DEFAULT_MODEL_PATH = "./models/best_model.safetensors"
+else:
+    DEFAULT_MODEL_PATH = "./models/best_model.pt"
+MODEL_PATH = os.environ.get("MODEL_PATH", DEFAULT_MODEL_PATH)
+VOCAB_PATH = os.environ.get("VOCAB_PATH", "./models/vocabulary.pkl")
+PRODUCTS_PATH = os.environ.get("PRODUCTS_PATH", "./models/all_products.json")
+
+class ReloadRequest(BaseModel):
+    model_path: Optional[str] = None
+    vocab_path: Optional[str] = None
+
+
+class StockUpdate(BaseModel):
+    out_of_stock: List[str]
+
+
+# Shared secret for /admin endpoints (unset = admin endpoints disabled)
+ADMIN_TOKEN = os.environ.get("ADMIN_TOKEN")
+
+# /admin/reload only loads files under this directory (default: the served model's)
+MODELS_DIR = os.path.realpath(os.environ.get("MODELS_DIR", os.path.dirname(os.path.abspath(MODEL_PATH))))
+
+# Poll the model/vocabulary files and hot-swap on change (seconds, 0 = off)
+MODEL_WATCH_INTERVAL = float(os.environ.get("MODEL_WATCH_INTERVAL", "0"))
+
+# Identical concurrent /predict carts share one computation, run on this
+# many inference threads; PREDICTION_CACHE_SIZE > 0 also keeps an LRU of results
+INFERENCE_THREADS = int(os.environ.get("INFERENCE_THREADS", "4"))
+PREDICTION_CACHE_SIZE = int(os.environ.get("PREDICTION_CACHE_SIZE", "0"))
+predictions = SingleFlight(INFERENCE_THREADS, PREDICTION_CACHE_SIZE)
+
+# Item vectors for diversity re-ranking: item_embeddings or fc_out
+DIVERSITY_SIMILARITY = os.environ.get("DIVERSITY_SIMILARITY", "item_embeddings")
+
+# Two-stage scoring: score only CANDIDATE_COUNT candidates per cart from a
+# cheap first stage (embedding or copurchase, see candidates.py); 0 = all items
+# (torch backend only)
+CANDIDATE_COUNT = int(os.environ.get("CANDIDATE_COUNT", "0"))
+CANDIDATE_SOURCE = os.environ.get("CANDIDATE_SOURCE", "embedding")
+COPURCHASE_NEIGHBORS_PATH = os.environ.get("COPURCHASE_NEIGHBORS_PATH", "./models/copurchase_neighbors.npz")
+
+# Clusters searched by beam search for models with a hierarchical output
+# layer (train_instacart.py --hierarchy); 0 = score every item exactly
+# (torch backend only; ONNX models always score exactly)
+HIERARCHICAL_BEAM = int(os.environ.get("HIERARCHICAL_BEAM", "8"))
+
+# Out-of-stock products, never recommended (set via POST /admin/stock)
+stock = StockList()
+
+# Currently served model + vocabulary. Replaced as a whole on reload;
+# handlers take one reference up front so in-flight requests finish on
+# the bundle they started with.
+bundle: Optional[BaseBundle] = None
+load_error: Optional[str] = None
+
+# Background reload state, guarded by reload_lock
+reload_lock = threading.Lock()
+reload_status = {"state": "idle", "error": None, "started_at": None, "finished_at": None}
 
 
-def load_model_and_vocab(model_path: str = "./models/best_model.pt", vocab_path: str = "./models/vocabulary.pkl"):
+def load_backend_bundle(model_path: str, vocab_path: str, device_name: Optional[str] = None) -> BaseBundle:
+    """Load a model with the configured INFERENCE_BACKEND (each backend imports its own runtime)."""
+    if INFERENCE_BACKEND == "onnx":
+        if CANDIDATE_COUNT > 0:
+            raise ValueError("Two-stage scoring (CANDIDATE_COUNT) needs INFERENCE_BACKEND=torch")
+        from onnx_inference import load_onnx_bundle
+        return load_onnx_bundle(model_path, vocab_path, ONNX_THREADS)
+    
+    from candidates import CandidateConfig
+    from inference import load_bundle
+    candidates = CandidateConfig(CANDIDATE_COUNT, CANDIDATE_SOURCE, COPURCHASE_NEIGHBORS_PATH)
+    return load_bundle(model_path, vocab_path, device_name, candidates, HIERARCHICAL_BEAM)
+
+
+def load_model_and_vocab(model_path: str = MODEL_PATH, vocab_path: str = VOCAB_PATH, device_name: Optional[str] = None):
     """Load trained model and vocabulary at startup."""
-    global model, vocabulary, device
-    
-    device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
-    print(f"Using device: {device}")
-    
-    # Load vocabulary
-    print(f"Loading vocabulary from {vocab_path}...")
-    with open(vocab_path, 'rb') as f:
-        vocabulary = pickle.load(f)
-    print(f"Loaded vocabulary with {vocabulary['num_items']} items")
-    
-    # Check if product_info exists in vocabulary
-    if 'product_info' in vocabulary:
-        print(f"Loaded product metadata for {len(vocabulary['product_info'])} products")
-    
-    # Load model checkpoint
-    print(f"Loading model from {model_path}...")
-    checkpoint = torch.load(model_path, map_location=device)
-    
-    # Create model with saved hyperparameters
-    model = NextItemPredictor(
-        num_items=checkpoint['num_items'],
-        embedding_dim=checkpoint['embedding_dim'],
-        hidden_dim=checkpoint['hidden_dim']
-    )
-    model.load_state_dict(checkpoint['model_state_dict'])
-    model = model.to(device)
-    model.eval()
+    global bundle, load_error
+    
+    try:
+        bundle = load_backend_bundle(model_path, vocab_path, device_name)
+    except Exception:
+        metrics.MODEL_LOADS.inc(1, ("failed",))
+        raise
+    metrics.MODEL_LOADS.inc(1, ("loaded",))
+    load_error = None
+    return bundle
+
+
+def reload_model(model_path: str, vocab_path: str):
+    """
+    Load and warm a new bundle, then swap it in.
+    
+    Runs in a background thread; requests keep using the old bundle
+    until the swap, and in-flight ones finish on it afterwards.
+    """
+    global bundle, load_error
+    
+    try:
+        device_name = str(bundle.device) if bundle is not None else None
+        new_bundle = load_backend_bundle(model_path, vocab_path, device_name)
+        
+        reload_status["state"] = "warming"
+        new_bundle.warmup()
+        
+        bundle = new_bundle  # Atomic reference swap
+        load_error = None
+        metrics.MODEL_LOADS.inc(1, ("reloaded",))
+        reload_status.update(state="succeeded", error=None)
+        print(f"Swapped in model from {model_path} (epoch {new_bundle.info['epoch']})")
+    except Exception as e:
+        traceback.print_exc()
+        metrics.MODEL_LOADS.inc(1, ("failed",))
+        reload_status.update(state="failed", error=f"{type(e).__name__}: {e}")
+        print(f"Reload failed, still serving the previous model: {e}")
+    finally:
+        reload_status["finished_at"] = time.time()
+        reload_lock.release()
+
+
+def start_reload(model_path: str, vocab_path: str) -> bool:
+    """Start a background reload; returns False if one is already running."""
+    if not reload_lock.acquire(blocking=False):
+        return False
+    reload_status.update(state="loading", error=None, started_at=time.time(), finished_at=None)
+    threading.Thread(target=reload_model, args=(model_path, vocab_path), daemon=True).start()
+    return True
+
+
+def artifact_mtimes(model_path: str, vocab_path: str):
+    """Modification times the file watcher compares between polls."""
+    paths = [model_path, vocab_path, os.path.join(os.path.splitext(vocab_path)[0], "meta.json")]
+    return tuple(os.path.getmtime(p) if os.path.exists(p) else None for p in paths)
+
+
+async def watch_model_files():
+    """Hot-swap when the served checkpoint or vocabulary changes on disk."""
+    model_path = bundle.info["model_path"] if bundle else MODEL_PATH
+    vocab_path = bundle.info["vocab_path"] if bundle else VOCAB_PATH
+    last_seen = artifact_mtimes(model_path, vocab_path)
+    
+    while True:
+        await asyncio.sleep(MODEL_WATCH_INTERVAL)
+        current = artifact_mtimes(model_path, vocab_path)
+        if current == last_seen:
+            continue
+        
+        # Give the writer one more interval to finish before loading
+        await asyncio.sleep(MODEL_WATCH_INTERVAL)
+        if current != artifact_mtimes(model_path, vocab_path):
+            continue
+        if start_reload(model_path, vocab_path):
+            print("Detected new model files, reloading...")
+            last_seen = current
+
+
+def require_admin(token: Optional[str]):
+    if not ADMIN_TOKEN:
+        raise HTTPException(status_code=403, detail="Admin endpoints are disabled (set ADMIN_TOKEN)")
+    if not secrets.compare_digest(token or "", ADMIN_TOKEN):
+        raise HTTPException(status_code=403, detail="Invalid admin token")
+
+
+def models_dir_path(path: str) -> str:
+    """Resolve a path from an admin request, rejecting anything outside MODELS_DIR."""
+    resolved = os.path.realpath(path)
+    if os.path.commonpath([resolved, MODELS_DIR]) != MODELS_DIR:
+        raise HTTPException(status_code=400, detail=f"Path must be inside {MODELS_DIR}: {path}")
+    return resolved
+
+
+def inline_schema(model_class) -> dict:
+    """JSON schema for a pydantic model with $defs references inlined (for openapi_extra)."""
+    schema = model_class.model_json_schema()
+    definitions = schema.pop("$defs", {})
+    
+    def resolve(node):
+        if isinstance(node, dict):
+            if "$ref" in node:
+                return resolve(definitions[node["$ref"].rsplit("/", 1)[-1]])
+            return {key: resolve(value) for key, value in node.items()}
+        if isinstance(node, list):
+            return [resolve(value) for value in node]
+        return node
+    
+    return resolve(schema)
+
+
+@lru_cache(maxsize=64)
+def is_json_content_type(content_type: Optional[str]) -> bool:
+    """Same rule FastAPI uses to decide whether to JSON-decode a request body."""
+    if not content_type:
+        return False
+    message = Message()
+    message["content-type"] = content_type
+    if message.get_content_maintype() != "application":
+        return False
+    subtype = message.get_content_subtype()
+    return subtype == "json" or subtype.endswith("+json")
+
+
+def parse_body(model_class, body: bytes, content_type: Optional[str]):
+    """
+    Decode and validate a request body exactly like a FastAPI body parameter.
+    
+    Endpoints that read the raw body (to time validation, or to accept other
+    content types) use this to keep the same 422 responses.
+    """
+    data = None
+    if body:
+        data = body
+        if is_json_content_type(content_type):
+            try:
+                data = json.loads(body)
+            except json.JSONDecodeError as e:
+                raise RequestValidationError(
+                    [{"type": "json_invalid", "loc": ("body", e.pos), "msg": "JSON decode error",
+                      "input": {}, "ctx": {"error": e.msg}}],
+                    body=e.doc
+                )
+    
+    if data is None:
+        raise RequestValidationError(
+            [{"type": "missing", "loc": ("body",), "msg": "Field required", "input": None}]
+        )
     
-    print(f"Model loaded successfully!")
-    print(f"  Validation loss: {checkpoint.get('val_loss', 'N/A')}")
-    if 'val_accuracy' in checkpoint:
-        print(f"  Top-k accuracy: {checkpoint['val_accuracy']}")
+    try:
+        return model_class.model_validate(data, from_attributes=True)
+    except ValidationError as e:
+        errors = [
+            {**error, "loc": ("body", *error["loc"])}
+            for error in e.errors(include_url=False)
+        ]
+        raise RequestValidationError(errors, body=data)
+
+
+def parse_body_fast(model_class, body: bytes, content_type: Optional[str]):
+    """
+    parse_body with a fast path for well-formed JSON.
+    
+    pydantic-core parses and validates in one pass without building
+    intermediate Python dicts. Anything it rejects goes through parse_body,
+    so error responses are unchanged.
+    """
+    if body and is_json_content_type(content_type):
+        try:
+            return model_class.model_validate_json(body)
+        except ValidationError:
+            pass
+    return parse_body(model_class, body, content_type)
 
 
 # Create FastAPI app
@@ -90,6 +340,10 @@ app = FastAPI(
     version="1.0.0"
 )
 
+# Request counts and latency per route (only installed when metrics are on)
+if metrics.ENABLED:
+    app.add_middleware(metrics.MetricsMiddleware)
+
 # Add CORS middleware to allow frontend requests
 app.add_middleware(
     CORSMiddleware,
@@ -103,11 +357,20 @@ app.add_middleware(
 @app.on_event("startup")
 async def startup_event():
     """Load model when server starts."""
-    try:
-        load_model_and_vocab()
-    except Exception as e:
-        print(f"Error loading model: {e}")
-        print("Server will start but predictions will fail until model is loaded.")
+    global load_error
+    
+    if bundle is None:
+        # Not already preloaded by the serve.py master process
+        try:
+            load_model_and_vocab()
+        except Exception as e:
+            traceback.print_exc()
+            load_error = f"{type(e).__name__}: {e}"
+            print(f"Error loading model: {e}")
+            print("Server will start but predictions will fail until a model is loaded (see /health, POST /admin/reload).")
+    
+    if MODEL_WATCH_INTERVAL > 0:
+        asyncio.get_running_loop().create_task(watch_model_files())
 
 
 @app.get("/")
@@ -116,124 +379,336 @@ async def root():
     return {
         "status": "ok",
         "message": "Next-Item Prediction API",
-        "model_loaded": model is not None
+        "model_loaded": bundle is not None
     }
 
 
 @app.get("/health")
 async def health():
     """Detailed health check."""
+    current = bundle
     return {
-        "status": "healthy" if model is not None else "unhealthy",
-        "model_loaded": model is not None,
-        "vocabulary_loaded": vocabulary is not None,
-        "device": str(device) if device else None,
-        "num_items": vocabulary['num_items'] if vocabulary else None
+        "status": "healthy" if current is not None else "unhealthy",
+        "model_loaded": current is not None,
+        "vocabulary_loaded": current is not None,
+        "backend": current.info["backend"] if current else INFERENCE_BACKEND,
+        "device": str(current.device) if current else None,
+        "num_items": current.vocabulary.num_items if current else None,
+        "checkpoint": {
+            "path": current.info["model_path"],
+            "memory_mapped": current.info["memory_mapped"],
+            "model_type": current.info["model_type"],
+            "hierarchy": current.info["hierarchy"],
+            "beam_width": current.beam_width,
+            "qr_buckets": current.info["qr_buckets"],
+            "output_rank": current.info["output_rank"],
+            "max_cart_size": current.max_cart_size,
+            "candidates": current.info["candidates"],
+            "epoch": current.info["epoch"],
+            "val_loss": current.info["val_loss"],
+            "val_accuracy": current.info["val_accuracy"],
+            "personalized": current.info["personalized"],
+            "num_users": current.info["num_users"],
+            "loaded_at": current.info["loaded_at"],
+        } if current else None,
+        "load_error": load_error,
+        "reload": reload_status,
+        "coalescing": {
+            "in_flight": predictions.in_flight,
+            "cache_size": PREDICTION_CACHE_SIZE,
+            **predictions.stats,
+        },
     }
 
 
-@app.post("/predict", response_model=PredictResponse)
-async def predict(request: PredictRequest):
+@app.post("/admin/reload", status_code=202)
+async def admin_reload(request: Optional[ReloadRequest] = None, x_admin_token: Optional[str] = Header(default=None)):
+    """
+    Load a new checkpoint and vocabulary in the background and hot-swap them in.
+    
+    Defaults to reloading the currently served paths. Poll /health for progress.
+    """
+    require_admin(x_admin_token)
+    request = request or ReloadRequest()
+    model_path = bundle.info["model_path"] if bundle else MODEL_PATH
+    vocab_path = bundle.info["vocab_path"] if bundle else VOCAB_PATH
+    # Paths from the request must be under MODELS_DIR; the served ones were configured by the operator
+    if request.model_path:
+        model_path = models_dir_path(request.model_path)
+    if request.vocab_path:
+        vocab_path = models_dir_path(request.vocab_path)
+    
+    if not os.path.exists(model_path):
+        raise HTTPException(status_code=404, detail=f"Model file not found: {model_path}")
+    if not start_reload(model_path, vocab_path):
+        raise HTTPException(status_code=409, detail="A reload is already in progress")
+    
+    return {"status": "reloading", "model_path": model_path, "vocab_path": vocab_path}
+
+
+@app.post("/admin/stock")
+async def admin_stock(update: StockUpdate, x_admin_token: Optional[str] = Header(default=None)):
+    """Replace the out-of-stock list; those products are excluded from all predictions."""
+    require_admin(x_admin_token)
+    product_ids = []
+    for product_id in update.out_of_stock:
+        try:
+            product_ids.append(int(product_id))
+        except ValueError:
+            raise HTTPException(status_code=400, detail=f"Invalid product_id: {product_id}")
+    stock.replace(product_ids)
+    return {"out_of_stock": len(stock), "version": stock.version}
+
+
+@app.post(
+    "/predict",
+    response_model=PredictResponse,
+    openapi_extra={"requestBody": {"required": True, "content": {
+        "application/json": {"schema": inline_schema(PredictRequest)},
+        binary_protocol.CONTENT_TYPE: {"schema": {"type": "string", "format": "binary"}},
+    }}}
+)
+async def predict(http_request: Request):
     """
     Predict next items based on current cart.
     
     Args:
-        request: PredictRequest with cart items and optional user_id
+        http_request: JSON body matching PredictRequest (cart items and optional user_id),
+            or a batch of carts in the binary format (see binary_protocol.py)
     
     Returns:
-        PredictResponse with top-k predicted items and probabilities
+        PredictResponse with top-k predicted items and probabilities,
+        or a binary response for binary requests
     """
-    if model is None or vocabulary is None:
+    timer = metrics.stage_timer()
+    body = await http_request.body()
+    content_type = http_request.headers.get("content-type")
+    if is_binary_content_type(content_type):
+        return await predict_binary(body, timer)
+    
+    request = parse_body_fast(PredictRequest, body, content_type)
+    timer.mark("validate")
+    
+    current = bundle
+    if current is None:
         raise HTTPException(status_code=503, detail="Model not loaded")
     
-    # Handle empty cart
-    if not request.cart:
-        # Return top popular items (first N items by index as fallback)
-        top_items = list(range(1, min(request.top_k + 1, vocabulary['num_items'])))
-        predictions = [
-            PredictionItem(
-                product_id=str(vocabulary['idx_to_item'].get(idx, idx)),
-                probability=0.1,
-                score=0.1
-            )
-            for idx in top_items
-        ]
-        return PredictResponse(next_item_predictions=predictions)
+    if metrics.ENABLED:
+        metrics.CART_SIZE.observe(len(request.cart))
     
-    # Convert cart product IDs to indices
-    cart_indices = []
-    for item in request.cart:
-        try:
-            # Try to convert product_id to int (since our data uses integer IDs)
-            item_id = int(item.product_id)
-            idx = vocabulary['item_to_idx'].get(item_id, 0)
-            if idx > 0:  # Only add if item is in vocabulary
-                cart_indices.append(idx)
-        except (ValueError, KeyError):
-            # Skip items not in vocabulary
-            continue
+    # Convert cart product IDs to indices, skipping items not in the vocabulary
+    cart_indices = current.encode_cart(item.product_id for item in request.cart)
+    timer.mark("encode")
+    
+    mask = request_mask(current, request, cart_indices)
+    timer.mark("filter")
+    
+    mmr = None
+    if request.diversity > 0:
+        mmr = MMRConfig(request.diversity, request.diversity_candidates,
+                        request.aisle_penalty, request.department_penalty)
+    
+    # Unknown users (and non-personalized models) get row 0: no user vector
+    user_row = current.user_row(request.user_id)
+    
+    return json_response(await shared_predictions(current, cart_indices, request.top_k, timer, mask, mmr, user_row))
+
+
+def request_mask(current: BaseBundle, request: PredictRequest, cart_indices):
+    """Allowed-items mask for the request's business rules and the stock list (None = no rules)."""
+    exclude_indices = current.encode_cart(request.exclude_product_ids) if request.exclude_product_ids else None
+    try:
+        return current.filters.build_mask(
+            cart_indices,
+            exclude_cart_items=request.exclude_cart_items,
+            include_departments=request.include_departments,
+            exclude_departments=request.exclude_departments,
+            include_aisles=request.include_aisles,
+            exclude_aisles=request.exclude_aisles,
+            exclude_indices=exclude_indices,
+            stock=stock,
+        )
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+
+async def shared_predictions(current: BaseBundle, cart_indices, top_k: int, timer=metrics.NULL_TIMER,
+                             mask=None, mmr: Optional[MMRConfig] = None, user_row: int = 0,
+                             incremental: Optional[IncrementalCart] = None) -> bytes:
+    """
+    render_predictions, coalesced with identical in-flight requests.
+    
+    Carts are keyed by the item indices the model actually sees, so
+    spelling differences and unknown products don't split the key.
+    `incremental` only changes how the cart is encoded, not the result,
+    so it is not part of the key.
+    """
+    if len(cart_indices) == 0:
+        return current.encoder.encode_fallback(top_k, mask)
+    predictions.bind(current)
+    key = (id(current), top_k, cart_indices[-current.max_cart_size:].tobytes(),
+           np.packbits(mask).tobytes() if mask is not None else None, mmr, user_row)
+    return await predictions.run(
+        key, lambda: render_predictions(current, cart_indices, top_k, timer, mask, mmr, user_row, incremental)
+    )
+
+
+def render_predictions(current: BaseBundle, cart_indices, top_k: int, timer=metrics.NULL_TIMER,
+                       mask=None, mmr: Optional[MMRConfig] = None, user_row: int = 0,
+                       incremental: Optional[IncrementalCart] = None) -> bytes:
+    """
+    PredictResponse JSON body for an encoded cart (personalized when user_row > 0).
     
+    With a sequence model, `incremental` carries the encoder state of the
+    session's previous cart so appended items cost one encoder step each.
+    """
     # If no valid items in cart after filtering, return popular items
-    if not cart_indices:
-        top_items = list(range(1, min(request.top_k + 1, vocabulary['num_items'])))
-        predictions = [
-            PredictionItem(
-                product_id=str(vocabulary['idx_to_item'].get(idx, idx)),
-                probability=0.1,
-                score=0.1
-            )
-            for idx in top_items
-        ]
-        return PredictResponse(next_item_predictions=predictions)
+    if len(cart_indices) == 0:
+        return current.encoder.encode_fallback(top_k, mask)
     
-    # Pad cart to model's expected length (max 20 items)
-    max_cart_size = 20
-    padded_cart = [0] * max_cart_size
-    start_idx = max(0, len(cart_indices) - max_cart_size)
-    for i, idx in enumerate(cart_indices[start_idx:]):
-        padded_cart[i] = idx
+    # Re-ranking picks top_k out of a larger candidate set
+    num_candidates = top_k
+    if mmr is not None:
+        num_candidates = min(max(mmr.candidates, top_k), current.vocabulary.num_items)
     
-    # Convert to tensor
-    cart_tensor = torch.tensor([padded_cart], dtype=torch.long).to(device)
+    if incremental is not None and not user_row and current.supports_incremental:
+        top_items, top_probs = current.predict_incremental(cart_indices, incremental, num_candidates, timer, mask)
+    else:
+        # Pad cart to model's expected length (max 20 items) and get predictions
+        padded_cart = current.pad_carts([cart_indices])
+        timer.mark("pad")
+        user_vector = current.users.vector(user_row) if user_row else None
+        top_items, top_probs = current.predict(padded_cart, num_candidates, timer, mask, user_vector)
+    top_items, top_probs = top_items[0], top_probs[0]
+    if mask is not None:
+        # Fewer than top_k items passed the rules
+        allowed = np.isfinite(top_probs)
+        top_items, top_probs = top_items[allowed], top_probs[allowed]
     
-    # Get predictions
-    with torch.no_grad():
-        top_items, top_probs = model.predict_top_k(cart_tensor, k=request.top_k)
+    if mmr is not None:
+        top_items, top_probs = current.reranker(DIVERSITY_SIMILARITY).rerank(top_items, top_probs, top_k, mmr)
+        timer.mark("rerank")
     
-    # Convert to response format
-    predictions = []
-    product_info = vocabulary.get('product_info', {})
+    # Render ids, metadata and probabilities from pre-encoded per-item
+    # fragments; same bytes FastAPI would produce for PredictResponse
+    content = current.encoder.encode(top_items, top_probs)
+    timer.mark("serialize")
+    return content
+
+
+def json_response(content: bytes) -> Response:
+    return Response(content, media_type="application/json")
+
+
+@lru_cache(maxsize=64)
+def is_binary_content_type(content_type: Optional[str]) -> bool:
+    if not content_type:
+        return False
+    return content_type.split(";", 1)[0].strip().lower() == binary_protocol.CONTENT_TYPE
+
+
+async def predict_binary(body: bytes, timer) -> Response:
+    """
+    /predict for binary requests: all carts in the message share one forward pass.
     
-    for item_idx, prob in zip(top_items[0].cpu().numpy(), top_probs[0].cpu().numpy()):
-        item_id = vocabulary['idx_to_item'].get(int(item_idx), int(item_idx))
-        
-        # Get product metadata if available
-        metadata = product_info.get(item_id, {})
-        
-        predictions.append(
-            PredictionItem(
-                product_id=str(item_id),
-                probability=float(prob),
-                score=float(prob),
-                name=metadata.get('name'),
-                aisle=metadata.get('aisle'),
-                department=metadata.get('department')
-            )
-        )
+    The pass runs on the inference threads, like JSON predictions, so a
+    large batch doesn't block the event loop.
+    """
+    try:
+        carts, top_k = binary_protocol.decode_request(body)
+    except binary_protocol.ProtocolError as e:
+        raise HTTPException(status_code=400, detail=f"Invalid binary request: {e}")
+    timer.mark("validate")
+    
+    current = bundle
+    if current is None:
+        raise HTTPException(status_code=503, detail="Model not loaded")
+    
+    if metrics.ENABLED:
+        for cart in carts:
+            metrics.CART_SIZE.observe(len(cart))
     
-    return PredictResponse(next_item_predictions=predictions)
+    mask = current.filters.build_mask(stock=stock)
+    
+    def compute() -> bytes:
+        results = current.predict_product_ids(carts, top_k, timer, mask)
+        content = binary_protocol.encode_response(results, top_k)
+        timer.mark("serialize")
+        return content
+    
+    content = await asyncio.get_running_loop().run_in_executor(predictions.executor, compute)
+    return Response(content, media_type=binary_protocol.CONTENT_TYPE)
+
+
+@app.websocket("/ws/predict")
+async def predict_stream(websocket: WebSocket):
+    """
+    Streaming predictions over one persistent connection.
+    
+    The client sends cart deltas and gets the updated top-k list pushed
+    back after each one (message format in cart_session.py). Uses the
+    same model bundle and response encoding as /predict.
+    """
+    await websocket.accept()
+    session = CartSession()
+    # Sequence models extend the previous cart's encoding when items are added
+    encoded = IncrementalCart()
+    try:
+        while True:
+            message = await websocket.receive_text()
+            timer = metrics.stage_timer()
+            try:
+                session.apply(CartDelta.model_validate_json(message))
+            except ValidationError as e:
+                await send_stream_error(websocket, session, e.errors(include_url=False))
+                continue
+            except ValueError as e:
+                await send_stream_error(websocket, session, str(e))
+                continue
+            timer.mark("validate")
+            
+            current = bundle
+            if current is None:
+                await send_stream_error(websocket, session, "Model not loaded")
+                continue
+            
+            cart_indices = session.cart_indices(current)
+            timer.mark("encode")
+            mask = current.filters.build_mask(stock=stock)
+            timer.mark("filter")
+            content = await shared_predictions(current, cart_indices, session.top_k, timer, mask,
+                                               incremental=encoded)
+            # Same body as /predict, prefixed with the message sequence number
+            await websocket.send_text(f'{{"seq":{session.seq},{content[1:].decode("utf-8")}')
+            metrics.STREAM_MESSAGES.inc(1, ("ok",))
+    except WebSocketDisconnect:
+        pass
+
+
+async def send_stream_error(websocket: WebSocket, session: CartSession, detail):
+    metrics.STREAM_MESSAGES.inc(1, ("error",))
+    await websocket.send_text(json.dumps({"type": "error", "seq": session.seq, "detail": detail}, default=str))
+
+
+@app.get("/metrics")
+async def get_metrics():
+    """Prometheus text-format metrics (set METRICS_ENABLED=1)."""
+    if not metrics.ENABLED:
+        raise HTTPException(status_code=404, detail="Metrics disabled; set METRICS_ENABLED=1")
+    return PlainTextResponse(metrics.registry.render(), media_type="text/plain; version=0.0.4")
 
 
 @app.get("/stats")
 async def get_stats():
     """Get model statistics."""
-    if model is None or vocabulary is None:
+    current = bundle
+    if current is None:
         raise HTTPException(status_code=503, detail="Model not loaded")
     
     return {
-        "num_items": vocabulary['num_items'],
-        "vocabulary_size": len(vocabulary['item_to_idx']),
-        "model_parameters": sum(p.numel() for p in model.parameters()),
+        "num_items": current.vocabulary.num_items,
+        "vocabulary_size": current.vocabulary.num_items - 1,
+        "model_parameters": current.info["parameters"],
     }
 
 
@@ -251,7 +726,7 @@ async def get_products(
     Returns frequent grocery products (500+ occurrences) from the Instacart dataset.
     """
     # Load all products from JSON file
-    products_file = "./models/all_products.json"
+    products_file = PRODUCTS_PATH
     if not os.path.exists(products_file):
         raise HTTPException(status_code=404, detail="Products file not found. Run generate_vocab_instacart.py first.")
     
@@ -260,10 +735,11 @@ async def get_products(
         all_products = json.load(f)
     
     # Filter to only frequent products (those in the trained model)
-    if vocabulary and 'item_to_idx' in vocabulary:
+    current = bundle
+    if current is not None:
         # Only show products that are in the model's vocabulary
-        valid_product_ids = set(vocabulary['item_to_idx'].keys())
-        all_products = [p for p in all_products if int(p.get('id', 0)) in valid_product_ids]
+        in_vocabulary = current.vocabulary.contains([int(p.get('id', 0)) for p in all_products])
+        all_products = [p for p, keep in zip(all_products, in_vocabulary) if keep]
     
     # Filter by search query
     if search:
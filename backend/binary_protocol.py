@@ -0,0 +1,107 @@
+"""
+Compact binary prediction protocol (Content-Type: application/x-nextitem).
+
+For internal high-volume callers that only need (product_id, probability)
+pairs. One message can carry several carts, which are scored in a single
+forward pass. All integers are little-endian.
+
+Request:
+    header      magic b'NXIT', u8 version (1), u8 reserved, u16 top_k, u16 num_carts
+    lengths     u16 x num_carts         items in each cart
+    product_ids i64 x sum(lengths)      all carts' product IDs, concatenated
+
+Response:
+    header      magic b'NXIT', u8 version (1), u8 reserved, u16 top_k, u16 num_carts
+    counts      u16 x num_carts         results per cart (<= top_k)
+    results     sum(counts) records of (i64 product_id, f32 probability)
+
+Unknown product IDs are skipped, and carts with no known items get the
+popular-items fallback, exactly as in the JSON API.
+"""
+
+import struct
+from typing import List, Sequence, Tuple
+
+import numpy as np
+
+
+CONTENT_TYPE = 'application/x-nextitem'
+MAGIC = b'NXIT'
+VERSION = 1
+
+HEADER = struct.Struct('<4sBBHH')
+RESULT_DTYPE = np.dtype([('product_id', '<i8'), ('probability', '<f4')])
+
+MAX_TOP_K = 50
+MAX_CARTS = 1024
+
+
+class ProtocolError(ValueError):
+    """Malformed binary message."""
+
+
+def _read_header(data: bytes) -> Tuple[int, int]:
+    if len(data) < HEADER.size:
+        raise ProtocolError("message shorter than header")
+    magic, version, _, top_k, num_carts = HEADER.unpack_from(data)
+    if magic != MAGIC:
+        raise ProtocolError("bad magic")
+    if version != VERSION:
+        raise ProtocolError(f"unsupported version {version}")
+    return top_k, num_carts
+
+
+def encode_request(carts: Sequence[Sequence[int]], top_k: int = 10) -> bytes:
+    """Client side: build a request message from carts of product IDs."""
+    lengths = np.array([len(cart) for cart in carts], dtype='<u2')
+    ids = np.concatenate([np.asarray(cart, dtype='<i8') for cart in carts]) if len(carts) else np.empty(0, '<i8')
+    return HEADER.pack(MAGIC, VERSION, 0, top_k, len(carts)) + lengths.tobytes() + ids.astype('<i8').tobytes()
+
+
+def decode_request(data: bytes) -> Tuple[List[np.ndarray], int]:
+    """
+    Server side: parse a request message.
+    
+    Returns:
+        (carts, top_k) where carts is a list of int64 product-ID arrays
+    """
+    top_k, num_carts = _read_header(data)
+    if not 1 <= top_k <= MAX_TOP_K:
+        raise ProtocolError(f"top_k must be between 1 and {MAX_TOP_K}")
+    if num_carts > MAX_CARTS:
+        raise ProtocolError(f"at most {MAX_CARTS} carts per message")
+    
+    offset = HEADER.size
+    lengths_end = offset + 2 * num_carts
+    if len(data) < lengths_end:
+        raise ProtocolError("truncated cart lengths")
+    lengths = np.frombuffer(data, dtype='<u2', count=num_carts, offset=offset).astype(np.int64)
+    
+    total = int(lengths.sum())
+    if len(data) != lengths_end + 8 * total:
+        raise ProtocolError("product ID section does not match cart lengths")
+    ids = np.frombuffer(data, dtype='<i8', count=total, offset=lengths_end)
+    
+    carts = np.split(ids, np.cumsum(lengths)[:-1]) if num_carts else []
+    return carts, top_k
+
+
+def encode_response(results: Sequence[Tuple[np.ndarray, np.ndarray]], top_k: int) -> bytes:
+    """Server side: results is one (product_ids, probabilities) pair per cart."""
+    counts = np.array([len(ids) for ids, _ in results], dtype='<u2')
+    records = np.empty(int(counts.sum()), dtype=RESULT_DTYPE)
+    offset = 0
+    for ids, probs in results:
+        records['product_id'][offset:offset + len(ids)] = ids
+        records['probability'][offset:offset + len(ids)] = probs
+        offset += len(ids)
+    return HEADER.pack(MAGIC, VERSION, 0, top_k, len(results)) + counts.tobytes() + records.tobytes()
+
+
+def decode_response(data: bytes) -> List[np.ndarray]:
+    """Client side: one structured array of (product_id, probability) per cart."""
+    _, num_carts = _read_header(data)
+    offset = HEADER.size
+    counts = np.frombuffer(data, dtype='<u2', count=num_carts, offset=offset).astype(np.int64)
+    records = np.frombuffer(data, dtype=RESULT_DTYPE, count=int(counts.sum()), offset=offset + 2 * num_carts)
+    return np.split(records, np.cumsum(counts)[:-1]) if num_carts else []
@@ -0,0 +1,187 @@
+"""
+Backend-independent half of a served model bundle.
+
+Everything here works on numpy arrays only: mapping product IDs to item
+indices, padding carts, user rows, the popular-items fallback, business
+rule masks and diversity re-ranking. Scoring is left to the backends,
+inference.ModelBundle (PyTorch) and onnx_inference.OnnxModelBundle (ONNX
+Runtime), so a server on the ONNX backend never imports torch.
+"""
+
+from time import perf_counter
+from typing import Dict, Iterable, List, Optional, Sequence, Tuple
+
+import numpy as np
+
+from vocab_store import CompactVocabulary
+from response_encoding import FALLBACK_PROBABILITY, PredictionEncoder
+from filtering import ItemFilters
+from reranking import SIMILARITY_SOURCES, DiversityReranker
+from user_store import UserStore
+import metrics
+
+
+# Cart window of checkpoints that don't record their max_cart_size
+MAX_CART_SIZE = 20
+
+
+class IncrementalCart:
+    """
+    Encoder state of one growing cart, for sequence models.
+    
+    Holds the cart vector of the items encoded so far, so when the next
+    prediction is for the same cart plus appended items, only those
+    items go through the encoder (ModelBundle.predict_incremental).
+    """
+    
+    def __init__(self):
+        self.owner = None  # bundle the vector was computed with
+        self.indices = np.empty(0, dtype=np.int64)
+        self.vector = None
+
+
+class BaseBundle:
+    """
+    A loaded model with the vocabulary and checkpoint it came from.
+    
+    Subclasses implement predict() and item_vectors().
+    """
+    
+    # Two-stage scoring, beam search and incremental encoding are PyTorch-only
+    candidates = None
+    beam_width = 0
+    supports_incremental = False
+    
+    def __init__(self, vocabulary: CompactVocabulary, info: Dict, users: Optional[UserStore] = None):
+        self.vocabulary = vocabulary
+        self.info = info
+        # Carts are truncated to their last max_cart_size items, as in
+        # training; a GRU has no position embeddings past it
+        self.max_cart_size = info['max_cart_size']
+        # Per-user vectors of a personalized checkpoint (None otherwise)
+        self.users = users
+        # Pre-rendered JSON fragments per item for the /predict fast path
+        self.encoder = PredictionEncoder(vocabulary)
+        # Business-rule masks over this vocabulary's items
+        self.filters = ItemFilters(vocabulary)
+        self._rerankers: Dict[str, DiversityReranker] = {}
+    
+    def predict(self, padded_carts: np.ndarray, top_k: int,
+                timer=metrics.NULL_TIMER, mask: Optional[np.ndarray] = None,
+                user_vector: Optional[np.ndarray] = None) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        Run the model on a batch of padded carts.
+        
+        Args:
+            mask: optional allowed-items mask from ItemFilters.build_mask
+            user_vector: optional (embedding_dim,) user store vector,
+                applied to every cart in the batch
+        
+        Returns:
+            (items, probs): (batch, top_k) item indices and probabilities;
+            with a mask, probs are -inf past the last allowed item
+        """
+        raise NotImplementedError
+    
+    def item_vectors(self, source: str) -> np.ndarray:
+        """(num_items, dim) float32 item vectors: item_embeddings or fc_out rows."""
+        raise NotImplementedError
+    
+    def reranker(self, source: str = 'item_embeddings') -> DiversityReranker:
+        """MMR re-ranker over this model's item vectors, built on first use."""
+        reranker = self._rerankers.get(source)
+        if reranker is None:
+            if source not in SIMILARITY_SOURCES:
+                raise ValueError(f"Unknown similarity source: {source} (expected one of {SIMILARITY_SOURCES})")
+            reranker = self._rerankers[source] = DiversityReranker(self.item_vectors(source), self.vocabulary)
+        return reranker
+    
+    def encode_cart(self, product_ids: Iterable[str]) -> np.ndarray:
+        """
+        Map request product IDs to item indices.
+        
+        IDs that are not integers or not in the vocabulary are skipped.
+        """
+        parsed = []
+        for product_id in product_ids:
+            try:
+                # Our data uses integer IDs
+                value = int(product_id)
+            except ValueError:
+                continue
+            if 0 <= value < 2 ** 63:
+                parsed.append(value)
+        
+        indices = self.vocabulary.lookup(parsed)
+        return indices[indices > 0]
+    
+    def pad_carts(self, carts: Iterable[np.ndarray]) -> np.ndarray:
+        """Right-pad carts of item indices into a (batch, max_cart_size) int64 matrix."""
+        carts = list(carts)
+        padded = np.zeros((len(carts), self.max_cart_size), dtype=np.int64)
+        for row, cart in enumerate(carts):
+            cart = cart[-self.max_cart_size:]
+            padded[row, :len(cart)] = cart
+        return padded
+    
+    def user_row(self, user_id) -> int:
+        """The user's row in the user store; 0 for unknown users and non-personalized models."""
+        if self.users is None or user_id is None:
+            return 0
+        return self.users.row(user_id)
+    
+    def predict_product_ids(self, carts: Sequence[np.ndarray], top_k: int,
+                            timer=metrics.NULL_TIMER,
+                            mask: Optional[np.ndarray] = None) -> List[Tuple[np.ndarray, np.ndarray]]:
+        """
+        Score several carts of raw product IDs in one forward pass.
+        
+        Unknown IDs are skipped; carts left empty get the popular-items
+        fallback, as in the JSON endpoint.
+        
+        Args:
+            mask: optional allowed-items mask applied to every cart
+        
+        Returns:
+            One (product_ids, probabilities) pair per cart
+        """
+        encoded = []
+        for cart in carts:
+            indices = self.vocabulary.lookup(cart)
+            encoded.append(indices[indices > 0])
+        timer.mark('encode')
+        
+        scored = [row for row, cart in enumerate(encoded) if len(cart)]
+        if mask is None:
+            fallback_ids = np.asarray(self.vocabulary.item_ids[1:top_k + 1], dtype=np.int64)
+        else:
+            fallback_ids = np.asarray(self.vocabulary.item_ids)[np.flatnonzero(mask[1:])[:top_k] + 1]
+        fallback = (fallback_ids, np.full(len(fallback_ids), FALLBACK_PROBABILITY, dtype=np.float32))
+        results = [fallback] * len(encoded)
+        if scored:
+            padded = self.pad_carts(encoded[row] for row in scored)
+            timer.mark('pad')
+            top_items, top_probs = self.predict(padded, top_k, timer, mask)
+            item_ids = np.asarray(self.vocabulary.item_ids)
+            for position, row in enumerate(scored):
+                items, probs = top_items[position], top_probs[position]
+                if mask is not None:
+                    allowed = np.isfinite(probs)
+                    items, probs = items[allowed], probs[allowed]
+                results[row] = (item_ids[items], probs)
+        return results
+    
+    def warmup(self, num_carts: int = 64, top_k: int = 10, seed: int = 0):
+        """Run synthetic carts of every size through the model before it takes traffic."""
+        rng = np.random.default_rng(seed)
+        num_items = self.vocabulary.num_items
+        carts = [
+            rng.integers(1, num_items, size=rng.integers(1, self.max_cart_size + 1))
+            for _ in range(num_carts)
+        ]
+        padded = self.pad_carts(carts)
+        start = perf_counter()
+        # Single-cart and batched shapes both take the first-call hit
+        self.predict(padded[:1], top_k)
+        self.predict(padded, top_k)
+        metrics.MODEL_LOAD_SECONDS.observe(perf_counter() - start, ('warmup',))
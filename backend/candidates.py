@@ -0,0 +1,101 @@
+"""
+Candidate generation for two-stage (cascade) scoring.
+
+Full scoring multiplies every cart by all of fc_out and softmaxes over the
+whole catalog. With CANDIDATE_COUNT set, a cheap first stage picks that
+many candidates per cart and the model's head scores only their fc_out
+rows (NextItemPredictor.top_k_candidates):
+
+  * embedding:  dot product of the mean cart item embedding with every
+                item embedding (embedding_dim instead of hidden_dim wide,
+                no softmax over the catalog)
+  * copurchase: items most often added after the cart's items, from a
+                neighbor table built by scripts/build_copurchase_neighbors.py;
+                cost depends on cart size, not catalog size
+
+Probabilities are then a softmax over the candidates only, so they are
+higher than full-scoring ones; the order among candidates is the same.
+Business-rule masks apply in both stages. Compare recall against full
+scoring with scripts/benchmark_api.py --candidate-counts.
+"""
+
+from typing import NamedTuple, Optional
+
+import numpy as np
+import torch
+
+from vocab_store import CompactVocabulary
+
+
+CANDIDATE_SOURCES = ('embedding', 'copurchase')
+
+
+class CandidateConfig(NamedTuple):
+    count: int                       # candidates per cart (at least top_k are always taken)
+    source: str = 'embedding'
+    neighbors_path: Optional[str] = None  # copurchase neighbor table (.npz)
+
+
+def load_neighbors(path: str, vocabulary: CompactVocabulary) -> np.ndarray:
+    """
+    Load a neighbor table and check it was built for this vocabulary.
+    
+    Returns:
+        (num_items, num_neighbors) int64 item indices, most frequent first;
+        0 marks an empty slot
+    """
+    data = np.load(path)
+    if not np.array_equal(data['item_ids'], np.asarray(vocabulary.item_ids)[1:]):
+        raise ValueError(f"Co-purchase neighbors at {path} were built for a different vocabulary")
+    return data['neighbors'].astype(np.int64)
+
+
+class CandidateGenerator:
+    """First stage of the cascade for one model and vocabulary."""
+    
+    def __init__(self, model: torch.nn.Module, config: CandidateConfig,
+                 neighbors: Optional[np.ndarray] = None):
+        if config.source not in CANDIDATE_SOURCES:
+            raise ValueError(f"Unknown candidate source: {config.source} (expected one of {CANDIDATE_SOURCES})")
+        if config.source == 'copurchase' and neighbors is None:
+            raise ValueError("The copurchase candidate source needs a neighbor table")
+        self.config = config
+        self.num_items = model.num_items
+        self.item_embeddings = model.item_embeddings.weight
+        self.neighbors = None
+        if neighbors is not None:
+            self.neighbors = torch.from_numpy(neighbors).to(self.item_embeddings.device)
+            # Earlier neighbors count more; empty slots (item 0) are dropped below
+            num_neighbors = neighbors.shape[1]
+            self.neighbor_weights = torch.linspace(1.0, 1.0 / num_neighbors, num_neighbors,
+                                                   device=self.item_embeddings.device)
+    
+    def generate(self, cart_items: torch.Tensor, top_k: int,
+                 mask: Optional[torch.Tensor] = None) -> torch.Tensor:
+        """
+        Candidate item indices for padded carts.
+        
+        Args:
+            cart_items: (batch_size, seq_len) padded item indices
+            top_k: results wanted; at least this many candidates are returned
+            mask: optional allowed-items mask, (num_items,) or (batch_size, num_items)
+        
+        Returns:
+            (batch_size, count) item indices, best first
+        """
+        count = min(max(self.config.count, top_k), self.num_items)
+        with torch.no_grad():
+            if self.config.source == 'embedding':
+                present = (cart_items != 0).unsqueeze(-1).to(self.item_embeddings.dtype)
+                # Sum rather than mean: same ranking, one op less
+                query = (self.item_embeddings[cart_items] * present).sum(dim=1)
+                scores = query @ self.item_embeddings.T
+            else:
+                neighbors = self.neighbors[cart_items]  # (batch, seq_len, num_neighbors)
+                weights = self.neighbor_weights.expand_as(neighbors) * (cart_items != 0).unsqueeze(-1)
+                scores = torch.zeros(len(cart_items), self.num_items, device=cart_items.device)
+                scores.scatter_add_(1, neighbors.flatten(1), weights.flatten(1))
+            scores[:, 0] = float('-inf')  # padding
+            if mask is not None:
+                scores = scores.masked_fill(~mask, float('-inf'))
+            return torch.topk(scores, k=count, dim=-1).indices
@@ -0,0 +1,82 @@
+"""
+Per-connection cart state for the streaming /ws/predict endpoint.
+
+A client keeps one WebSocket open and sends cart deltas as JSON text
+messages; after each one the server pushes the updated top-k list:
+
+    {"type": "set", "cart": ["24852", "13176"], "top_k": 10}
+    {"type": "add", "product_id": "21137"}
+    {"type": "remove", "product_id": "24852"}
+    {"type": "clear"}
+
+The cart is a list like the /predict cart: "add" appends even an item
+already in it, and a repeated item counts once per occurrence, as a
+repeated product_id does in /predict. "remove" drops the item's latest
+occurrence.
+
+top_k may be given on any message and sticks for the session. Replies are
+the /predict JSON body with a leading "seq" (1-based count of messages
+processed on the connection), or {"type": "error", ...} for bad messages.
+"""
+
+from typing import List, Literal, Optional
+
+import numpy as np
+from pydantic import BaseModel, Field
+
+
+class CartDelta(BaseModel):
+    type: Literal["set", "add", "remove", "clear"]
+    cart: Optional[List[str]] = None
+    product_id: Optional[str] = None
+    top_k: Optional[int] = Field(default=None, ge=1, le=50)
+
+
+class CartSession:
+    """Cart contents for one connection, with item indices cached per model bundle."""
+    
+    def __init__(self, top_k: int = 10):
+        self.product_ids: List[str] = []
+        self.top_k = top_k
+        self.seq = 0
+        # Encoded cart and the bundle it was encoded with; a hot-swapped
+        # model may come with a different vocabulary
+        self._indices: Optional[np.ndarray] = None
+        self._encoded_for = None
+    
+    def apply(self, delta: CartDelta):
+        """Update the cart. Raises ValueError for deltas missing their payload."""
+        if delta.type == "set":
+            if delta.cart is None:
+                raise ValueError("'set' needs a cart")
+            self.product_ids = list(delta.cart)
+            self._indices = None
+        elif delta.type == "add":
+            if delta.product_id is None:
+                raise ValueError("'add' needs a product_id")
+            self.product_ids.append(delta.product_id)
+            if self._indices is not None:
+                # Appending only needs the new item encoded
+                new = self._encoded_for.encode_cart([delta.product_id])
+                self._indices = np.concatenate([self._indices, new])
+        elif delta.type == "remove":
+            if delta.product_id is None:
+                raise ValueError("'remove' needs a product_id")
+            if delta.product_id in self.product_ids:
+                last = len(self.product_ids) - 1 - self.product_ids[::-1].index(delta.product_id)
+                del self.product_ids[last]
+                self._indices = None
+        else:
+            self.product_ids = []
+            self._indices = None
+        
+        if delta.top_k is not None:
+            self.top_k = delta.top_k
+        self.seq += 1
+    
+    def cart_indices(self, bundle) -> np.ndarray:
+        """Item indices of the cart under `bundle`'s vocabulary."""
+        if self._indices is None or self._encoded_for is not bundle:
+            self._indices = bundle.encode_cart(self.product_ids)
+            self._encoded_for = bundle
+        return self._indices
@@ -0,0 +1,140 @@
+"""
+Memory-mappable model checkpoints.
+
+torch.load unpickles a checkpoint into freshly allocated tensors, in every
+process that loads it. The training scripts therefore also write the
+model weights to a flat file next to the .pt checkpoint:
+
+    best_model.safetensors
+        8 bytes    little-endian uint64 header size N
+        N bytes    JSON header: {name: {dtype, shape, data_offsets}} per
+                   tensor, and __metadata__ with the checkpoint's other
+                   entries (num_items, embedding_dim, val_accuracy, ...)
+        rest       raw little-endian tensor data, one contiguous slice each
+
+This is the safetensors layout, so the files also open with the
+safetensors package, but reading and writing them here needs numpy only.
+load_checkpoint() maps the file and wraps each tensor around its slice
+without copying; with build_model_from_checkpoint(assign=True) the model's
+parameters are those slices. Loading no longer depends on the model size,
+and every process serving the same file, including workers that reload
+it on their own, shares its pages through the OS page cache.
+"""
+
+import json
+import os
+import struct
+from typing import Dict, Optional
+
+import numpy as np
+import torch
+
+
+SUFFIX = '.safetensors'
+
+DTYPES = {
+    torch.float64: 'F64',
+    torch.float32: 'F32',
+    torch.float16: 'F16',
+    torch.bfloat16: 'BF16',
+    torch.int64: 'I64',
+    torch.int32: 'I32',
+    torch.int16: 'I16',
+    torch.int8: 'I8',
+    torch.uint8: 'U8',
+    torch.bool: 'BOOL',
+}
+TORCH_DTYPES = {name: dtype for dtype, name in DTYPES.items()}
+
+
+def mapped_path(model_path: str) -> str:
+    """Where the memory-mappable copy of a .pt checkpoint is written."""
+    return os.path.splitext(model_path)[0] + SUFFIX
+
+
+def save_mapped(checkpoint: Dict, path: str):
+    """
+    Write a checkpoint dict's model_state_dict and JSON-serializable
+    entries to a memory-mappable file.
+    
+    Written to a temporary file and renamed, so a server that has the
+    previous file mapped keeps serving it until it reloads.
+    """
+    tensors = {name: tensor.detach().cpu().contiguous()
+               for name, tensor in checkpoint['model_state_dict'].items()}
+    # Widest dtypes first, so every tensor starts aligned to its element size
+    names = sorted(tensors, key=lambda name: (-tensors[name].element_size(), name))
+    
+    header = {'__metadata__': {
+        key: json.dumps(value) for key, value in checkpoint.items() if key != 'model_state_dict'
+    }}
+    offset = 0
+    for name in names:
+        tensor = tensors[name]
+        size = tensor.numel() * tensor.element_size()
+        header[name] = {
+            'dtype': DTYPES[tensor.dtype],
+            'shape': list(tensor.shape),
+            'data_offsets': [offset, offset + size],
+        }
+        offset += size
+    encoded = json.dumps(header, separators=(',', ':')).encode('utf-8')
+    # Pad so the tensor data starts 8-byte aligned
+    encoded += b' ' * (-len(encoded) % 8)
+    
+    os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'wb') as f:
+        f.write(struct.pack('<Q', len(encoded)))
+        f.write(encoded)
+        for name in names:
+            f.write(tensors[name].reshape(-1).view(torch.uint8).numpy().tobytes())
+    os.replace(tmp_path, path)
+
+
+def save_checkpoint(checkpoint: Dict, model_path: str):
+    """Save a checkpoint dict with torch.save, plus its memory-mappable copy next to it."""
+    torch.save(checkpoint, model_path)
+    save_mapped(checkpoint, mapped_path(model_path))
+
+
+def load_mapped(path: str) -> Dict:
+    """
+    Open a memory-mappable checkpoint as a checkpoint dict.
+    
+    The model_state_dict tensors are CPU views of the mapped file. The
+    mapping is copy-on-write: pages stay shared until a tensor is written,
+    and writes never reach the file.
+    """
+    with open(path, 'rb') as f:
+        (header_size,) = struct.unpack('<Q', f.read(8))
+        header = json.loads(f.read(header_size))
+    metadata = header.pop('__metadata__', {})
+    
+    state_dict = {}
+    if header:
+        data = np.memmap(path, dtype=np.uint8, mode='c', offset=8 + header_size)
+        buffer = torch.from_numpy(data)
+        for name, entry in header.items():
+            start, end = entry['data_offsets']
+            state_dict[name] = buffer[start:end].view(TORCH_DTYPES[entry['dtype']]).reshape(entry['shape'])
+    
+    checkpoint = {key: json.loads(value) for key, value in metadata.items()}
+    # JSON keys are strings; checkpoints key accuracy by k
+    if checkpoint.get('val_accuracy') is not None:
+        checkpoint['val_accuracy'] = {int(k): v for k, v in checkpoint['val_accuracy'].items()}
+    checkpoint['model_state_dict'] = state_dict
+    return checkpoint
+
+
+def load_checkpoint(path: str, map_location: Optional[torch.device] = None) -> Dict:
+    """
+    Load a checkpoint dict from either format (.safetensors files are mapped, on the CPU).
+    
+    .pt files are unpickled with weights_only=True: checkpoints hold only
+    tensors, numbers, strings and plain containers, and anything else
+    (which could run code while unpickling) is refused.
+    """
+    if path.endswith(SUFFIX):
+        return load_mapped(path)
+    return torch.load(path, map_location=map_location, weights_only=True)
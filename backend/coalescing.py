@@ -0,0 +1,82 @@
+"""
+Single-flight coalescing of identical in-flight predictions.
+
+Concurrent requests for the same canonical cart (vocabulary indices after
+truncation) and top_k await one shared computation instead of each running
+a forward pass. The computation runs on a small thread pool, so the event
+loop keeps accepting requests (and joining them to the in-flight one)
+while the model runs.
+
+An optional LRU cache of finished results sits in front of this; with a
+cache size of 0 only in-flight work is shared.
+"""
+
+import asyncio
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Dict, Hashable
+
+import metrics
+
+
+class SingleFlight:
+    """Shares results between concurrent calls with the same key."""
+    
+    def __init__(self, max_workers: int = 4, cache_size: int = 0):
+        self.executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='inference')
+        self.cache_size = cache_size
+        self._cache: OrderedDict = OrderedDict()
+        self._in_flight: Dict[Hashable, asyncio.Future] = {}
+        # Model the cached results came from, and a counter bumped whenever
+        # it changes so results still computing for the old one are not cached
+        self._owner = None
+        self._generation = 0
+        self.stats = {'computed': 0, 'coalesced': 0, 'cache_hits': 0}
+    
+    @property
+    def in_flight(self) -> int:
+        return len(self._in_flight)
+    
+    def bind(self, owner):
+        """Drop cached results when the model serving them changes (call from the event loop)."""
+        if owner is not self._owner:
+            self._owner = owner
+            self._generation += 1
+            self._cache.clear()
+    
+    async def run(self, key: Hashable, compute: Callable[[], bytes]) -> bytes:
+        """Return compute()'s result, sharing it with concurrent calls for the same key."""
+        if self.cache_size:
+            cached = self._cache.get(key)
+            if cached is not None:
+                self._cache.move_to_end(key)
+                self.stats['cache_hits'] += 1
+                metrics.PREDICTION_CACHE.inc(1, ('hit',))
+                return cached
+            metrics.PREDICTION_CACHE.inc(1, ('miss',))
+        
+        future = self._in_flight.get(key)
+        if future is None:
+            # Not tied to this caller: if it goes away, the computation
+            # still completes for everyone else waiting on it
+            future = asyncio.get_running_loop().run_in_executor(self.executor, compute)
+            self._in_flight[key] = future
+            metrics.PREDICT_IN_FLIGHT.inc()
+            generation = self._generation
+            future.add_done_callback(lambda f: self._finish(key, f, generation))
+        else:
+            self.stats['coalesced'] += 1
+            metrics.PREDICT_COALESCED.inc()
+        return await asyncio.shield(future)
+    
+    def _finish(self, key: Hashable, future: asyncio.Future, generation: int):
+        del self._in_flight[key]
+        metrics.PREDICT_IN_FLIGHT.dec()
+        # exception() also marks a failure as retrieved; waiters re-raise it
+        if future.cancelled() or future.exception() is not None:
+            return
+        self.stats['computed'] += 1
+        if self.cache_size and generation == self._generation:
+            self._cache[key] = future.result()
+            if len(self._cache) > self.cache_size:
+                self._cache.popitem(last=False)
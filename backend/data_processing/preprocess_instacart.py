@@ -6,9 +6,78 @@ Dataset: orders.csv, products.csv, order_products__train.csv, order_products__pr
 import pandas as pd
 import numpy as np
 from typing import Dict, List, Tuple
+import hashlib
 import pickle
 import json
 import os
+from itertools import chain
+
+
+def carts_to_matrix(carts: List[List[int]], max_cart_size: int = 20) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Pack variable-length carts into a right-padded int32 matrix.
+    
+    Returns:
+        matrix: (num_examples, max_cart_size) item indices, 0 = padding
+        lengths: (num_examples,) number of real items in each row
+    """
+    lengths = np.fromiter((len(cart) for cart in carts), dtype=np.int64, count=len(carts))
+    lengths = np.minimum(lengths, max_cart_size)
+    flat = np.fromiter(
+        chain.from_iterable(cart[-max_cart_size:] for cart in carts),
+        dtype=np.int32,
+        count=int(lengths.sum())
+    )
+    matrix = np.zeros((len(carts), max_cart_size), dtype=np.int32)
+    # Row-major boolean assignment fills each row left to right
+    matrix[np.arange(max_cart_size) < lengths[:, None]] = flat
+    return matrix, lengths.astype(np.int32)
+
+
+def vocabulary_fingerprint(item_ids: np.ndarray) -> str:
+    """Hash of a vocabulary's product IDs in index order (index 1 onwards)."""
+    return hashlib.sha256(np.ascontiguousarray(item_ids, dtype=np.int64).tobytes()).hexdigest()
+
+
+def compact_examples(carts: np.ndarray, next_items: np.ndarray,
+                     order_invariant: bool = False) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """
+    Collapse identical (cart, next item) examples into one example with a count.
+    
+    Rows are hashed column by column (vectorized over examples), grouped by
+    hash, and checked against their group's first row; if a hash collision
+    shows up, rows are grouped by exact comparison instead.
+    
+    Args:
+        carts: (num_examples, max_cart_size) right-padded matrix from carts_to_matrix
+        next_items: (num_examples,) next item indices
+        order_invariant: treat carts holding the same items in any order as
+            identical (for models that pool the cart, like mean pooling)
+    
+    Returns:
+        (carts, next_items, counts): unique examples in order of first
+        occurrence and how many examples each stands for
+    """
+    if order_invariant:
+        # Sort each cart's items, keeping padding at the end
+        padding = np.iinfo(carts.dtype).max
+        carts = np.sort(np.where(carts == 0, padding, carts), axis=1)
+        carts[carts == padding] = 0
+    keys = np.concatenate([carts, next_items[:, None].astype(carts.dtype)], axis=1)
+    
+    hashes = np.zeros(len(keys), dtype=np.uint64)
+    for column in keys.T:
+        # FNV-1a step over whole items
+        hashes = (hashes ^ column.astype(np.uint64)) * np.uint64(0x100000001B3)
+    _, first, inverse, counts = np.unique(hashes, return_index=True, return_inverse=True, return_counts=True)
+    representative = first[inverse]
+    if not all(np.array_equal(column, column[representative]) for column in keys.T):
+        rows = np.ascontiguousarray(keys).view(np.dtype((np.void, keys.dtype.itemsize * keys.shape[1])))
+        _, first, counts = np.unique(rows.ravel(), return_index=True, return_counts=True)
+    
+    order = np.argsort(first)
+    first = first[order]
+    return carts[first], next_items[first], counts[order].astype(np.int32)
 
 
 class InstacartPreprocessor:
@@ -89,29 +158,7 @@ class InstacartPreprocessor:
             next_items: list of next item indices (labels)
             user_ids: list of user IDs for each example
         """
-        # Load data
-        data_df, products_df = self.load_data(data_dir)
-        
-        # Filter products by frequency - keep only popular products
-        print("Filtering products by frequency...")
-        product_counts = data_df['product_id'].value_counts()
-        popular_products = product_counts[product_counts >= min_product_count].index.tolist()
-        print(f"Keeping {len(popular_products)} products with >= {min_product_count} occurrences (from {len(product_counts)} total)")
-        
-        # Filter dataset to only popular products
-        data_df = data_df[data_df['product_id'].isin(popular_products)]
-        print(f"Filtered to {len(data_df)} order-product pairs")
-        
-        # Sample if needed
-        if sample_frac < 1.0:
-            print(f"Sampling {sample_frac*100}% of users...")
-            unique_users = data_df['user_id'].unique()
-            sampled_users = np.random.choice(unique_users, size=int(len(unique_users) * sample_frac), replace=False)
-            data_df = data_df[data_df['user_id'].isin(sampled_users)]
-            print(f"Sampled {len(data_df)} order-product pairs")
-        
-        # Build vocabulary
-        self.build_vocabulary(data_df)
+        data_df = self._load_filtered(data_dir, sample_frac, min_product_count)
         
         # Create training examples from user order sequences
         print("Creating training examples...")
@@ -119,9 +166,6 @@ class InstacartPreprocessor:
         next_items = []
         user_ids = []
         
-        # Sort by user and order number
-        data_df = data_df.sort_values(['user_id', 'order_number', 'add_to_cart_order'])
-        
         for user_id, user_orders in data_df.groupby('user_id'):
             # Get sequence of all products ordered by this user
             product_sequence = user_orders['product_id'].tolist()
@@ -147,6 +191,141 @@ class InstacartPreprocessor:
         print(f"Created {len(carts)} training examples from {data_df['user_id'].nunique()} users")
         return carts, next_items, user_ids
     
+    def process_baskets(
+        self,
+        data_dir='../data',
+        max_cart_size: int = 20,
+        sample_frac: float = 0.20,
+        min_product_count: int = 500
+    ) -> Tuple[List[List[int]], List[List[int]], List[int]]:
+        """
+        Process Instacart dataset into one example per order: the items
+        bought before it (the last max_cart_size, across orders) and every
+        item of the order as a multi-label target.
+        
+        Returns:
+            carts: list of carts (each cart is a list of item indices)
+            baskets: list of target baskets (item indices in add-to-cart order)
+            user_ids: list of user IDs for each example
+        """
+        data_df = self._load_filtered(data_dir, sample_frac, min_product_count)
+        
+        print("Creating basket examples...")
+        carts = []
+        baskets = []
+        user_ids = []
+        
+        for user_id, user_orders in data_df.groupby('user_id'):
+            # Every product is in the vocabulary, which was built from data_df
+            product_sequence = [self.item_to_idx[item] for item in user_orders['product_id'].tolist()]
+            
+            # Positions where each order after the user's first begins
+            order_starts = np.flatnonzero(np.diff(user_orders['order_number'].to_numpy())) + 1
+            order_ends = np.append(order_starts[1:], len(product_sequence))
+            for start, end in zip(order_starts.tolist(), order_ends.tolist()):
+                carts.append(product_sequence[max(0, start - max_cart_size):start])
+                baskets.append(product_sequence[start:end])
+                user_ids.append(user_id)
+        
+        print(f"Created {len(carts)} basket examples from {data_df['user_id'].nunique()} users")
+        return carts, baskets, user_ids
+    
+    def _load_filtered(self, data_dir, sample_frac, min_product_count):
+        """
+        Load orders, keep popular products and sampled users, and build the vocabulary.
+        
+        Returns:
+            order-product pairs sorted by user, order number and add-to-cart order
+        """
+        # Load data
+        data_df, products_df = self.load_data(data_dir)
+        
+        # Filter products by frequency - keep only popular products
+        print("Filtering products by frequency...")
+        product_counts = data_df['product_id'].value_counts()
+        popular_products = product_counts[product_counts >= min_product_count].index.tolist()
+        print(f"Keeping {len(popular_products)} products with >= {min_product_count} occurrences (from {len(product_counts)} total)")
+        
+        # Filter dataset to only popular products
+        data_df = data_df[data_df['product_id'].isin(popular_products)]
+        print(f"Filtered to {len(data_df)} order-product pairs")
+        
+        # Sample if needed
+        if sample_frac < 1.0:
+            print(f"Sampling {sample_frac*100}% of users...")
+            unique_users = data_df['user_id'].unique()
+            sampled_users = np.random.choice(unique_users, size=int(len(unique_users) * sample_frac), replace=False)
+            data_df = data_df[data_df['user_id'].isin(sampled_users)]
+            print(f"Sampled {len(data_df)} order-product pairs")
+        
+        # Build vocabulary
+        self.build_vocabulary(data_df)
+        
+        # Sort by user and order number
+        return data_df.sort_values(['user_id', 'order_number', 'add_to_cart_order'])
+    
+    def save_examples(self, path: str, carts, lengths, next_items, user_ids, params: Dict = None,
+                      target_offsets=None):
+        """
+        Save processed examples so later runs can skip preprocessing.
+        
+        Args:
+            carts: (num_examples, max_cart_size) int32 matrix from carts_to_matrix
+            lengths: (num_examples,) cart lengths
+            next_items: (num_examples,) next item indices, or for basket
+                examples every basket's items back to back
+            user_ids: (num_examples,) user IDs
+            params: preprocessing parameters, checked again on load
+            target_offsets: (num_examples + 1,) basket boundaries in
+                next_items, for basket examples only
+        """
+        item_ids = self.item_ids()
+        arrays = {}
+        if target_offsets is not None:
+            arrays['target_offsets'] = np.asarray(target_offsets, dtype=np.int64)
+        tmp_path = path + '.tmp'
+        with open(tmp_path, 'wb') as f:
+            np.savez(
+                f,
+                carts=carts,
+                lengths=lengths,
+                next_items=np.asarray(next_items, dtype=np.int32),
+                user_ids=np.asarray(user_ids, dtype=np.int64),
+                item_ids=item_ids,
+                params=json.dumps(params or {}, sort_keys=True),
+                **arrays
+            )
+        os.replace(tmp_path, path)
+        print(f"Saved {len(carts):,} examples to {path}")
+    
+    def load_examples(self, path: str, params: Dict = None):
+        """
+        Load examples written by save_examples and restore the matching vocabulary.
+        
+        Returns:
+            (carts, lengths, next_items, user_ids, target_offsets), with
+            target_offsets None unless these are basket examples; None if
+            the file was built with different parameters
+        """
+        data = np.load(path)
+        if params is not None and str(data['params']) != json.dumps(params, sort_keys=True):
+            print(f"Ignoring {path}: built with different parameters")
+            return None
+        
+        item_ids = data['item_ids'].tolist()
+        self.item_to_idx = {item: idx + 1 for idx, item in enumerate(item_ids)}
+        self.idx_to_item = {idx + 1: item for idx, item in enumerate(item_ids)}
+        self.idx_to_item[0] = 0
+        self.num_items = len(item_ids) + 1
+        
+        print(f"Loaded {len(data['carts']):,} cached examples from {path}")
+        target_offsets = data['target_offsets'] if 'target_offsets' in data.files else None
+        return data['carts'], data['lengths'], data['next_items'], data['user_ids'], target_offsets
+    
+    def item_ids(self) -> np.ndarray:
+        """Product ID of every vocabulary index from 1 to num_items - 1."""
+        return np.array([self.idx_to_item[idx] for idx in range(1, self.num_items)], dtype=np.int64)
+    
     def save_vocabulary(self, path: str):
         """Save vocabulary to pickle file."""
         vocab_data = {
@@ -0,0 +1,280 @@
+"""
+Distill a trained next-item model into a smaller one for serving.
+
+The teacher (usually the 512/1024 model from train_instacart.py) scores
+every training window once, in batches, and only its top-k items and
+their probabilities (softened by --temperature and renormalized over the
+k items) are kept, cached as int32 ids and float16 probabilities next to
+the examples cache. The student trains on a mix of cross-entropy against
+those soft targets and the usual cross-entropy against the true next
+item (--alpha), reading the teacher's targets from the cache instead of
+running the teacher every epoch.
+
+The best student is saved like any train_instacart.py model, so the API
+serves it with MODEL_PATH=./models/student_model.pt, and at the end its
+validation accuracy and predict_top_k latency are compared with the
+teacher's.
+"""
+
+import torch
+import torch.nn as nn
+import torch.nn.functional as F
+import numpy as np
+from model import MODEL_TYPES, build_model, build_model_from_checkpoint
+from checkpoint_store import load_checkpoint, save_checkpoint
+from train_instacart import (CartDataset, LengthBucketedBatchSampler, ResumableRandomSampler,
+                             collate_fn, evaluate, make_loader, train_val_split)
+import argparse
+import random
+import time
+import os
+
+class DistillationDataset(CartDataset):
+    """
+    Training windows with the teacher's top-k ids and probabilities.
+    
+    Batches are (carts, next_items, teacher_ids, teacher_probs).
+    """
+    
+    def __init__(self, carts, next_items, teacher_ids, teacher_probs):
+        super().__init__(carts, next_items)
+        self.teacher_ids = teacher_ids
+        self.teacher_probs = teacher_probs
+    
+    def __getitem__(self, idx):
+        return self.carts[idx], self.next_items[idx], self.teacher_ids[idx], self.teacher_probs[idx]
+    
+    def __getitems__(self, indices):
+        indices = np.asarray(indices)
+        return super().__getitems__(indices) + (self.teacher_ids[indices], self.teacher_probs[indices])
+
+def teacher_top_k(teacher, carts, top_k, temperature, batch_size, device):
+    """
+    Score every cart with the teacher in one batched pass.
+    
+    Returns:
+        (ids, probs): (num_carts, top_k) int32 item ids and float16
+        probabilities at the given temperature, renormalized over the k items
+    """
+    teacher.eval()
+    ids = np.empty((len(carts), top_k), dtype=np.int32)
+    probs = np.empty((len(carts), top_k), dtype=np.float16)
+    lengths = (carts != 0).sum(axis=1)
+    with torch.no_grad():
+        for start in range(0, len(carts), batch_size):
+            end = min(start + batch_size, len(carts))
+            max_len = max(int(lengths[start:end].max()), 1)
+            batch = torch.from_numpy(carts[start:end, :max_len].astype(np.int64)).to(device)
+            logits = teacher(batch)
+            # Padding is never a target
+            logits[:, 0] = float('-inf')
+            top_logits, top_ids = torch.topk(logits, top_k, dim=1)
+            ids[start:end] = top_ids.cpu().numpy()
+            probs[start:end] = F.softmax(top_logits / temperature, dim=1).cpu().numpy()
+    return ids, probs
+
+def load_teacher_targets(cache_path, teacher, checkpoint, carts, personalized, args, device):
+    """Teacher targets from cache_path, recomputed when the teacher, split or settings differ."""
+    fingerprint = np.array([checkpoint['num_items'], checkpoint.get('epoch') or 0,
+                            checkpoint.get('val_loss') or 0.0, args.top_k, args.temperature, len(carts),
+                            personalized])
+    if cache_path and os.path.exists(cache_path):
+        cached = np.load(cache_path)
+        if np.array_equal(cached['fingerprint'], fingerprint):
+            print(f"Loading teacher targets from {cache_path}...")
+            return cached['ids'], cached['probs']
+        print(f"{cache_path} was written for a different teacher or settings, recomputing")
+    
+    print(f"Scoring {len(carts):,} training windows with the teacher (top {args.top_k})...")
+    start_time = time.time()
+    ids, probs = teacher_top_k(teacher, carts, args.top_k, args.temperature, args.teacher_batch_size, device)
+    print(f"  {time.time() - start_time:.1f}s")
+    if cache_path:
+        np.savez(cache_path, ids=ids, probs=probs, fingerprint=fingerprint)
+        print(f"Cached teacher targets to {cache_path} ({os.path.getsize(cache_path) / 2**20:.1f} MB)")
+    return ids, probs
+
+def distillation_loss(logits, next_items, teacher_ids, teacher_probs, temperature, alpha):
+    """
+    alpha * soft cross-entropy against the teacher's top-k (scaled by T^2 so
+    its gradients stay comparable across temperatures) + (1 - alpha) * hard
+    cross-entropy against the true next item.
+    
+    The soft term compares the two distributions within the teacher's k
+    items only. Against the full softmax, the renormalized targets would
+    push the student's mass outside them to zero and leave it overconfident.
+    """
+    log_probs = F.log_softmax(logits.gather(1, teacher_ids) / temperature, dim=1)
+    soft = -(teacher_probs * log_probs).sum(dim=1).mean() * temperature ** 2
+    hard = F.cross_entropy(logits, next_items)
+    return alpha * soft + (1 - alpha) * hard
+
+def distill_epoch(model, dataloader, optimizer, device, temperature, alpha):
+    """Train the student for one epoch. Returns the average loss."""
+    model.train()
+    total_loss, num_batches = 0.0, 0
+    for batch_idx, batch in enumerate(dataloader):
+        carts, next_items, teacher_ids, teacher_probs = (t.to(device, non_blocking=True) for t in batch)
+        
+        optimizer.zero_grad()
+        loss = distillation_loss(model(carts), next_items, teacher_ids, teacher_probs, temperature, alpha)
+        loss.backward()
+        optimizer.step()
+        
+        total_loss += loss.item()
+        num_batches += 1
+        if (batch_idx + 1) % 100 == 0:
+            print(f"  Batch {batch_idx + 1}/{len(dataloader)}, Loss: {loss.item():.4f}")
+    return total_loss / max(num_batches, 1)
+
+def latency_ms(model, carts, iterations=50):
+    """Median predict_top_k latency on the CPU for one batch of carts."""
+    model = model.cpu().eval()
+    with torch.no_grad():
+        for _ in range(3):
+            model.predict_top_k(carts, k=10)
+        timings = []
+        for _ in range(iterations):
+            start = time.perf_counter()
+            model.predict_top_k(carts, k=10)
+            timings.append(time.perf_counter() - start)
+    return float(np.median(timings)) * 1000
+
+def main():
+    parser = argparse.ArgumentParser(description="Distill a trained model into a smaller student")
+    parser.add_argument("--teacher-path", type=str, default="./models/best_model.pt", help="Teacher checkpoint")
+    parser.add_argument("--examples-cache", type=str, default="./models/examples_cache.npz",
+                        help="Examples cache written by train_instacart.py")
+    parser.add_argument("--teacher-cache", type=str, default="./models/teacher_top_k.npz",
+                        help="Cache of the teacher's top-k targets ('' to disable)")
+    parser.add_argument("--model-save-path", type=str, default="./models/student_model.pt", help="Best student output path")
+    parser.add_argument("--model-type", type=str, default=None, choices=sorted(MODEL_TYPES),
+                        help="Student cart encoder (default: the teacher's)")
+    parser.add_argument("--embedding-dim", type=int, default=64, help="Student embedding dimension")
+    parser.add_argument("--hidden-dim", type=int, default=128, help="Student hidden layer dimension")
+    parser.add_argument("--top-k", type=int, default=32, help="Teacher items kept per training window")
+    parser.add_argument("--temperature", type=float, default=2.0, help="Softmax temperature for the soft targets")
+    parser.add_argument("--alpha", type=float, default=0.5,
+                        help="Weight of the soft targets (1 - alpha goes to the true next item)")
+    parser.add_argument("--teacher-batch-size", type=int, default=4096, help="Batch size of the teacher pass")
+    parser.add_argument("--batch-size", type=int, default=4096, help="Batch size")
+    parser.add_argument("--lr", type=float, default=0.001, help="Learning rate")
+    parser.add_argument("--epochs", type=int, default=8, help="Number of epochs")
+    parser.add_argument("--num-workers", type=int, default=2, help="DataLoader workers")
+    parser.add_argument("--prefetch-batches", type=int, default=4, help="Batches each DataLoader worker prepares ahead")
+    parser.add_argument("--bucket-pool", type=int, default=50,
+                        help="Batch carts of similar length, sorting within pools of N batches (0 = random batches)")
+    parser.add_argument("--seed", type=int, default=42, help="Random seed")
+    args = parser.parse_args()
+    
+    random.seed(args.seed)
+    np.random.seed(args.seed)
+    torch.manual_seed(args.seed)
+    
+    if torch.backends.mps.is_available():
+        device = torch.device('mps')
+    elif torch.cuda.is_available():
+        device = torch.device('cuda')
+    else:
+        device = torch.device('cpu')
+    print(f"Using device: {device}")
+    
+    print(f"Loading teacher from {args.teacher_path}...")
+    checkpoint = load_checkpoint(args.teacher_path, map_location=device)
+    teacher = build_model_from_checkpoint(checkpoint).to(device).eval()
+    
+    data = np.load(args.examples_cache)
+    if 'target_offsets' in data.files or len(data['item_ids']) + 1 != checkpoint['num_items']:
+        raise SystemExit(f"{args.examples_cache} does not hold next-item examples for the teacher's vocabulary")
+    carts, next_items = data['carts'], data['next_items']
+    # The teacher's own split, so its soft targets never cover validation
+    # windows (a personalized teacher is used without user vectors)
+    personalized = checkpoint.get('personalized', 'user_store' in checkpoint)
+    train_idx, val_idx = train_val_split(data['user_ids'], personalized)
+    teacher_ids, teacher_probs = load_teacher_targets(
+        args.teacher_cache, teacher, checkpoint, carts[train_idx], personalized, args, device)
+    train_dataset = DistillationDataset(carts[train_idx], next_items[train_idx], teacher_ids, teacher_probs)
+    val_dataset = CartDataset(carts[val_idx], next_items[val_idx])
+    print(f"\nTrain examples: {len(train_dataset):,}")
+    print(f"Val examples: {len(val_dataset):,}")
+    
+    if args.bucket_pool > 0:
+        train_sampler = LengthBucketedBatchSampler(train_dataset.lengths, args.batch_size,
+                                                   pool_batches=args.bucket_pool, seed=args.seed)
+        train_loader = make_loader(train_dataset, device, args.num_workers, args.prefetch_batches,
+                                   batch_sampler=train_sampler)
+    else:
+        train_sampler = ResumableRandomSampler(len(train_dataset), seed=args.seed)
+        train_loader = make_loader(train_dataset, device, args.num_workers, args.prefetch_batches,
+                                   batch_size=args.batch_size, sampler=train_sampler)
+    val_loader = make_loader(val_dataset, device, args.num_workers, args.prefetch_batches,
+                             batch_size=args.batch_size, shuffle=False)
+    
+    model_type = args.model_type or checkpoint.get('model_type', 'mlp')
+    max_cart_size = checkpoint.get('max_cart_size', 20)
+    model = build_model(model_type, num_items=checkpoint['num_items'], embedding_dim=args.embedding_dim,
+                        hidden_dim=args.hidden_dim, max_cart_size=max_cart_size).to(device)
+    teacher_params = sum(p.numel() for p in teacher.parameters())
+    student_params = sum(p.numel() for p in model.parameters())
+    print(f"Teacher has {teacher_params:,} parameters, student ({model_type}) {student_params:,}")
+    
+    criterion = nn.CrossEntropyLoss()
+    optimizer = torch.optim.Adam(model.parameters(), lr=args.lr)
+    best_val_loss = float('inf')
+    
+    for epoch in range(args.epochs):
+        print(f"\nEpoch {epoch + 1}/{args.epochs}")
+        print("-" * 60)
+        train_sampler.set_epoch(epoch)
+        
+        start_time = time.time()
+        train_loss = distill_epoch(model, train_loader, optimizer, device, args.temperature, args.alpha)
+        epoch_time = time.time() - start_time
+        print(f"Train loss: {train_loss:.4f}, Time: {epoch_time:.2f}s "
+              f"({len(train_dataset) / epoch_time:,.0f} examples/s)")
+        
+        val_loss, val_accuracy = evaluate(model, val_loader, criterion, device)
+        print(f"Val loss: {val_loss:.4f}")
+        print(f"Val accuracy - Top-1: {val_accuracy[1]*100:.2f}%, Top-5: {val_accuracy[5]*100:.2f}%, Top-10: {val_accuracy[10]*100:.2f}%")
+        
+        if val_loss < best_val_loss:
+            best_val_loss = val_loss
+            save_checkpoint({
+                'model_state_dict': model.state_dict(),
+                'val_loss': val_loss,
+                'val_accuracy': val_accuracy,
+                'model_type': model_type,
+                'hierarchy': 'none',
+                'objective': 'next-item',
+                'num_items': checkpoint['num_items'],
+                'embedding_dim': args.embedding_dim,
+                'hidden_dim': args.hidden_dim,
+                'max_cart_size': max_cart_size,
+                'epoch': epoch + 1,
+                'distilled_from': os.path.abspath(args.teacher_path),
+                'distillation': {'top_k': args.top_k, 'temperature': args.temperature, 'alpha': args.alpha},
+            }, args.model_save_path)
+            print(f"✓ Saved best model (val_loss: {val_loss:.4f})")
+    
+    # Teacher vs best student on the same validation split and one CPU thread
+    model.load_state_dict(load_checkpoint(args.model_save_path, map_location=device)['model_state_dict'])
+    rng = np.random.default_rng(args.seed)
+    latency_carts = {size: collate_fn(val_dataset.__getitems__(rng.integers(0, len(val_dataset), size=size)))[0]
+                     for size in (1, 32)}
+    teacher_loss, teacher_accuracy = evaluate(teacher, val_loader, criterion, device)
+    student_loss, student_accuracy = evaluate(model, val_loader, criterion, device)
+    torch.set_num_threads(1)
+    print("\n" + "="*60)
+    print("Teacher vs student")
+    print("="*60)
+    for name, candidate, params, loss, accuracy in (
+            ('teacher', teacher, teacher_params, teacher_loss, teacher_accuracy),
+            ('student', model, student_params, student_loss, student_accuracy)):
+        latency = {size: latency_ms(candidate, cart_tensor) for size, cart_tensor in latency_carts.items()}
+        print(f"{name}: {params / 1e6:.2f}M params, val loss {loss:.4f}, "
+              f"Top-1 {accuracy[1]*100:.2f}%, Top-5 {accuracy[5]*100:.2f}%, Top-10 {accuracy[10]*100:.2f}%, "
+              f"predict_top_k {latency[1]:.2f} ms (1 cart), {latency[32]:.2f} ms (32 carts)")
+    print(f"Student saved to: {args.model_save_path}")
+
+if __name__ == '__main__':
+    main()
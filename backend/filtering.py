@@ -0,0 +1,131 @@
+"""
+Business-rule filtering of predictions.
+
+Rules (exclude what's already in the cart, department/aisle allow and deny
+lists, excluded products, out-of-stock items) become one boolean mask over
+item indices, True = may be recommended. The model applies it to its
+probabilities before top-k, so a request gets top_k valid items from a
+single forward pass instead of over-fetching and filtering client-side.
+Probabilities of the surviving items are unchanged (not renormalized).
+"""
+
+from typing import Dict, Iterable, List, Optional, Tuple
+
+import numpy as np
+
+from vocab_store import CompactVocabulary
+
+
+class StockList:
+    """Out-of-stock product IDs, replaced as a whole by POST /admin/stock."""
+    
+    def __init__(self):
+        # (version, sorted unique product IDs); one attribute so readers on
+        # inference threads never see a version paired with the wrong IDs
+        self.state: Tuple[int, np.ndarray] = (0, np.empty(0, dtype=np.int64))
+    
+    def replace(self, product_ids: Iterable[int]):
+        version, _ = self.state
+        self.state = (version + 1, np.unique(np.asarray(list(product_ids), dtype=np.int64)))
+    
+    @property
+    def version(self) -> int:
+        return self.state[0]
+    
+    def __len__(self) -> int:
+        return len(self.state[1])
+
+
+class ItemFilters:
+    """Builds rule masks over one vocabulary's item indices."""
+    
+    def __init__(self, vocabulary: CompactVocabulary):
+        self.vocabulary = vocabulary
+        self.num_items = vocabulary.num_items
+        self._department_codes = {name.lower(): code for code, name in enumerate(vocabulary.departments)}
+        self._aisle_codes = {name.lower(): code for code, name in enumerate(vocabulary.aisles)}
+        # Plain arrays: vectorized ops on np.memmap views pay subclass overhead
+        self._department_column = np.asarray(vocabulary.department_codes)
+        self._aisle_column = np.asarray(vocabulary.aisle_codes)
+        self._stock_mask: Tuple[int, Optional[np.ndarray]] = (0, None)
+    
+    def _category_mask(self, names: List[str], kind: str) -> np.ndarray:
+        """Items whose department or aisle (`kind`) is one of `names`, case-insensitive."""
+        if kind == 'department':
+            lookup, categories, codes = self._department_codes, self.vocabulary.departments, self._department_column
+        else:
+            lookup, categories, codes = self._aisle_codes, self.vocabulary.aisles, self._aisle_column
+        selected = []
+        for name in names:
+            code = lookup.get(name.lower())
+            if code is None:
+                raise ValueError(f"Unknown {kind}: {name}")
+            selected.append(code)
+        
+        # A comparison per name is cheapest for the usual one or two names;
+        # long lists go through one gather from a per-code table, whose
+        # extra last slot is what code -1 (no product info) indexes
+        if len(selected) <= 8:
+            mask = codes == selected[0]
+            for code in selected[1:]:
+                mask |= codes == code
+            return mask
+        table = np.zeros(len(categories) + 1, dtype=bool)
+        table[selected] = True
+        return table[codes]
+    
+    def stock_mask(self, stock: StockList) -> Optional[np.ndarray]:
+        """In-stock items under this vocabulary (None if nothing is out of stock)."""
+        version, product_ids = stock.state
+        cached_version, mask = self._stock_mask
+        if cached_version != version:
+            mask = None
+            if len(product_ids):
+                mask = np.ones(self.num_items, dtype=bool)
+                mask[self.vocabulary.lookup(product_ids)] = False
+                mask[0] = True  # lookup maps unknown products to 0; padding is masked separately
+            self._stock_mask = (version, mask)
+        return mask
+    
+    def build_mask(self, cart_indices: Optional[np.ndarray] = None,
+                   exclude_cart_items: bool = False,
+                   include_departments: Optional[List[str]] = None,
+                   exclude_departments: Optional[List[str]] = None,
+                   include_aisles: Optional[List[str]] = None,
+                   exclude_aisles: Optional[List[str]] = None,
+                   exclude_indices: Optional[np.ndarray] = None,
+                   stock: Optional[StockList] = None) -> Optional[np.ndarray]:
+        """
+        Combine the given rules into an allowed-items mask.
+        
+        Returns:
+            Boolean array of shape (num_items,), or None when no rule applies
+            (so the unfiltered path stays as it was)
+        
+        Raises:
+            ValueError: for department or aisle names not in the vocabulary
+        """
+        stock_mask = self.stock_mask(stock) if stock is not None else None
+        if not (exclude_cart_items or include_departments or exclude_departments or include_aisles
+                or exclude_aisles or (exclude_indices is not None and len(exclude_indices))
+                or stock_mask is not None):
+            return None
+        
+        mask = np.ones(self.num_items, dtype=bool)
+        if include_departments:
+            mask &= self._category_mask(include_departments, 'department')
+        if exclude_departments:
+            mask &= ~self._category_mask(exclude_departments, 'department')
+        if include_aisles:
+            mask &= self._category_mask(include_aisles, 'aisle')
+        if exclude_aisles:
+            mask &= ~self._category_mask(exclude_aisles, 'aisle')
+        if exclude_cart_items and cart_indices is not None:
+            mask[cart_indices] = False
+        if exclude_indices is not None:
+            mask[exclude_indices] = False
+        if stock_mask is not None:
+            mask &= stock_mask
+        # Index 0 is padding, not a product
+        mask[0] = False
+        return mask
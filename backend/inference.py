@@ -0,0 +1,228 @@
+"""
+Inference core shared by the API endpoints (PyTorch backend).
+
+A ModelBundle holds everything a prediction needs (model, vocabulary,
+device and checkpoint info), so the server can replace all of it with a
+single reference assignment when a new checkpoint is hot-swapped in.
+The backend-independent parts live in bundle_base.py; onnx_inference.py
+serves exported models with ONNX Runtime instead.
+"""
+
+import os
+import time
+from time import perf_counter
+from typing import Dict, Optional, Tuple
+
+import numpy as np
+import torch
+
+from model import NextItemPredictor, build_model_from_checkpoint
+from checkpoint_store import SUFFIX as MAPPED_SUFFIX, load_checkpoint
+from vocab_store import CompactVocabulary, load_vocabulary
+from bundle_base import MAX_CART_SIZE, BaseBundle, IncrementalCart
+from user_store import UserStore
+from candidates import CandidateConfig, CandidateGenerator, load_neighbors
+import metrics
+
+
+class ModelBundle(BaseBundle):
+    """A PyTorch model with the vocabulary and checkpoint it came from."""
+    
+    def __init__(self, model: NextItemPredictor, vocabulary: CompactVocabulary,
+                 device: torch.device, info: Dict, users: Optional[UserStore] = None):
+        super().__init__(vocabulary, info, users)
+        self.model = model
+        self.device = device
+        # First stage of two-stage scoring (None = score every item)
+        self.candidates: Optional[CandidateGenerator] = None
+        # Beam width for hierarchical models' top-k (0 = score every item)
+        self.beam_width = 0
+    
+    def item_vectors(self, source: str) -> np.ndarray:
+        weight = self.model.item_embeddings.weight if source == 'item_embeddings' else self.model.item_output_weights()
+        # Shares memory with the CPU model's parameters (a copy on GPU, or
+        # for a hierarchical output layer, whose rows are grouped by cluster)
+        return weight.detach().float().cpu().numpy()
+    
+    def predict(self, padded_carts: np.ndarray, top_k: int,
+                timer=metrics.NULL_TIMER, mask: Optional[np.ndarray] = None,
+                user_vector: Optional[np.ndarray] = None) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        Run the model on a batch of padded carts.
+        
+        Args:
+            mask: optional allowed-items mask from ItemFilters.build_mask
+            user_vector: optional (embedding_dim,) user store vector,
+                applied to every cart in the batch
+        
+        Returns:
+            (items, probs): (batch, top_k) item indices and probabilities;
+            with a mask, probs are -inf past the last allowed item
+        """
+        cart_tensor = torch.from_numpy(padded_carts).to(self.device)
+        mask_tensor = torch.from_numpy(mask).to(self.device) if mask is not None else None
+        user_tensor = None
+        if user_vector is not None:
+            user_tensor = torch.from_numpy(np.array(user_vector, dtype=np.float32)).to(self.device)
+            user_tensor = user_tensor.expand(len(padded_carts), -1)
+        timer.mark('tensor')
+        with torch.no_grad():
+            if self.candidates is None and not self.beam_width:
+                top_items, top_probs = self.model.predict_top_k(cart_tensor, k=top_k, mask=mask_tensor,
+                                                                user_vectors=user_tensor)
+            else:
+                cart_vector = self.model.cart_vector(cart_tensor)
+                top_items, top_probs = self.top_k_from_vector(cart_tensor, cart_vector, top_k, timer,
+                                                              mask_tensor, user_tensor)
+        timer.mark('forward')
+        result = top_items.cpu().numpy(), top_probs.cpu().numpy()
+        timer.mark('to_numpy')
+        return result
+    
+    def top_k_from_vector(self, cart_tensor: torch.Tensor, cart_vector: torch.Tensor, top_k: int,
+                          timer=metrics.NULL_TIMER, mask_tensor: Optional[torch.Tensor] = None,
+                          user_tensor: Optional[torch.Tensor] = None) -> Tuple[torch.Tensor, torch.Tensor]:
+        """Top-k for encoded carts: two-stage, beam search or full scoring, as configured."""
+        if self.candidates is not None:
+            # Generate candidates, then score only those with the model's head
+            candidates = self.candidates.generate(cart_tensor, top_k, mask_tensor)
+            timer.mark('candidates')
+            return self.model.top_k_candidates(cart_vector, candidates, top_k, mask_tensor, user_tensor)
+        if self.beam_width:
+            return self.model.beam_top_k(cart_vector, top_k, self.beam_width, mask_tensor, user_tensor)
+        return self.model.top_k(self.model.score(cart_vector, user_tensor), top_k, mask_tensor)
+    
+    @property
+    def supports_incremental(self) -> bool:
+        return hasattr(self.model, 'extend')
+    
+    def predict_incremental(self, cart_indices: np.ndarray, state: IncrementalCart, top_k: int,
+                            timer=metrics.NULL_TIMER,
+                            mask: Optional[np.ndarray] = None) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        predict() for one cart, reusing and updating `state` (sequence models only).
+        
+        Only items appended since the cart `state` was computed for are
+        encoded. Anything else (items removed or reordered, a new model,
+        carts past max_cart_size whose window slides) re-encodes the cart.
+        
+        Returns:
+            (items, probs) of shape (1, top_k), as predict()
+        """
+        cart = np.array(cart_indices, dtype=np.int64)
+        known = len(state.indices)
+        reusable = (state.owner is self and 0 < known <= len(cart) <= self.max_cart_size
+                    and np.array_equal(state.indices, cart[:known]))
+        mask_tensor = torch.from_numpy(mask).to(self.device) if mask is not None else None
+        timer.mark('tensor')
+        with torch.no_grad():
+            if reusable:
+                vector = state.vector
+                if len(cart) > known:
+                    new_items = torch.from_numpy(cart[None, known:]).to(self.device)
+                    vector = self.model.extend(vector, new_items, known)
+            else:
+                cart = cart[-self.max_cart_size:]
+                vector = self.model.cart_vector(torch.from_numpy(cart[None]).to(self.device))
+            state.owner, state.indices, state.vector = self, cart, vector
+            cart_tensor = torch.from_numpy(cart[None]).to(self.device)
+            top_items, top_probs = self.top_k_from_vector(cart_tensor, vector, top_k, timer, mask_tensor)
+        timer.mark('forward')
+        result = top_items.cpu().numpy(), top_probs.cpu().numpy()
+        timer.mark('to_numpy')
+        return result
+
+
+def load_bundle(model_path: str, vocab_path: str, device_name: Optional[str] = None,
+                candidates: Optional[CandidateConfig] = None, beam_width: int = 8) -> ModelBundle:
+    """
+    Load a model checkpoint and its vocabulary.
+    
+    Args:
+        candidates: two-stage scoring settings (None or count 0 = full scoring)
+        beam_width: clusters searched for top-k by hierarchical models (0 = exact)
+    """
+    device = torch.device(device_name or ("cuda" if torch.cuda.is_available() else "cpu"))
+    print(f"Using device: {device}")
+    
+    # Load vocabulary (memory-mapped compact format, see vocab_store.py)
+    print(f"Loading vocabulary from {vocab_path}...")
+    start = perf_counter()
+    vocabulary = load_vocabulary(vocab_path)
+    metrics.MODEL_LOAD_SECONDS.observe(perf_counter() - start, ('vocabulary',))
+    print(f"Loaded vocabulary with {vocabulary.num_items} items")
+    
+    # Check if product metadata exists in vocabulary
+    if vocabulary.has_product_info:
+        print(f"Loaded product metadata for {vocabulary.num_items - 1} products")
+    
+    # Load model checkpoint
+    print(f"Loading model from {model_path}...")
+    start = perf_counter()
+    # .safetensors checkpoints are memory-mapped (checkpoint_store.py)
+    checkpoint = load_checkpoint(model_path, map_location=device)
+    
+    if checkpoint['num_items'] != vocabulary.num_items:
+        raise ValueError(
+            f"Checkpoint has {checkpoint['num_items']} items but vocabulary has {vocabulary.num_items}"
+        )
+    
+    # Create model with saved hyperparameters, keeping the loaded tensors
+    # as its parameters (on CPU, the mapped file's pages) rather than copies
+    model = build_model_from_checkpoint(checkpoint, assign=True)
+    model = model.to(device)
+    model.eval()
+    metrics.MODEL_LOAD_SECONDS.observe(perf_counter() - start, ('checkpoint',))
+    
+    users = None
+    if checkpoint.get('user_store'):
+        # Stored relative to the checkpoint so the pair can be moved together
+        store_path = os.path.join(os.path.dirname(os.path.abspath(model_path)), checkpoint['user_store'])
+        start = perf_counter()
+        users = UserStore.load(store_path)
+        if users.embedding_dim != checkpoint['embedding_dim']:
+            raise ValueError(
+                f"User store has {users.embedding_dim}-dim vectors but model has {checkpoint['embedding_dim']}"
+            )
+        if users.store_id != checkpoint.get('user_store_id'):
+            raise ValueError(f"User store at {store_path} was not exported with this checkpoint")
+        metrics.MODEL_LOAD_SECONDS.observe(perf_counter() - start, ('user_store',))
+        print(f"Loaded user store with {users.num_users:,} users")
+    
+    print(f"Model loaded successfully!")
+    print(f"  Validation loss: {checkpoint.get('val_loss', 'N/A')}")
+    if 'val_accuracy' in checkpoint:
+        print(f"  Top-k accuracy: {checkpoint['val_accuracy']}")
+    
+    info = {
+        'backend': 'torch',
+        'model_path': os.path.abspath(model_path),
+        'vocab_path': os.path.abspath(vocab_path),
+        'model_type': model.model_type,
+        'hierarchy': checkpoint.get('hierarchy'),
+        'qr_buckets': model.item_embeddings.buckets if model.compressed else 0,
+        'output_rank': model.output_rank,
+        'max_cart_size': checkpoint.get('max_cart_size', MAX_CART_SIZE),
+        'parameters': sum(p.numel() for p in model.parameters()),
+        'memory_mapped': model_path.endswith(MAPPED_SUFFIX) and device.type == 'cpu',
+        'epoch': checkpoint.get('epoch'),
+        'val_loss': checkpoint.get('val_loss'),
+        'val_accuracy': checkpoint.get('val_accuracy'),
+        'personalized': users is not None,
+        'num_users': users.num_users if users is not None else 0,
+        'loaded_at': time.time(),
+    }
+    bundle = ModelBundle(model, vocabulary, device, info, users)
+    if model.hierarchical:
+        bundle.beam_width = beam_width
+        print(f"Hierarchical output over {model.output.num_clusters} clusters, beam width {beam_width}")
+    if candidates is not None and candidates.count > 0:
+        if model.hierarchical:
+            raise ValueError("Two-stage scoring needs a flat output layer, not a hierarchical one")
+        neighbors = None
+        if candidates.source == 'copurchase':
+            neighbors = load_neighbors(candidates.neighbors_path, vocabulary)
+        bundle.candidates = CandidateGenerator(model, candidates, neighbors)
+        print(f"Two-stage scoring: {candidates.count} {candidates.source} candidates per cart")
+    info['candidates'] = bundle.candidates.config._asdict() if bundle.candidates is not None else None
+    return bundle
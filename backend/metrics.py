@@ -0,0 +1,223 @@
+"""
+Lightweight Prometheus-style metrics for the API.
+
+Enable with METRICS_ENABLED=1; the registry is then exposed in the
+Prometheus text format on GET /metrics. When disabled, request timing
+middleware is not installed and per-stage timers are a shared no-op
+object, so the hot path pays one attribute call per stage.
+
+With serve.py each worker keeps its own registry; a scrape sees the
+worker that happened to accept the connection.
+"""
+
+import os
+import threading
+from bisect import bisect_left
+from time import perf_counter
+from typing import Dict, Sequence, Tuple
+
+
+ENABLED = os.environ.get("METRICS_ENABLED", "0").lower() in ("1", "true", "yes")
+
+# Seconds; per-stage times are typically 10us-1ms, full requests up to ~100ms
+LATENCY_BUCKETS = (
+    0.00001, 0.000025, 0.00005, 0.0001, 0.00025, 0.0005,
+    0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5,
+)
+CART_SIZE_BUCKETS = (0, 1, 2, 3, 5, 8, 12, 20, 30, 50, 100)
+LOAD_BUCKETS = (0.01, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+
+def _format_labels(names: Sequence[str], values: Tuple, extra: str = '') -> str:
+    parts = [f'{name}="{value}"' for name, value in zip(names, values)]
+    if extra:
+        parts.append(extra)
+    return '{' + ','.join(parts) + '}' if parts else ''
+
+
+class Counter:
+    """Monotonic counter with optional labels."""
+    
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._values: Dict[Tuple, float] = {}
+        self._lock = threading.Lock()
+    
+    def inc(self, amount: float = 1, labels: Tuple = ()):
+        with self._lock:
+            self._values[labels] = self._values.get(labels, 0) + amount
+    
+    def render(self):
+        yield f'# HELP {self.name} {self.documentation}'
+        yield f'# TYPE {self.name} counter'
+        for labels, value in sorted(self._values.items()):
+            yield f'{self.name}{_format_labels(self.labelnames, labels)} {value}'
+
+
+class Gauge:
+    """Value that can go up and down (no labels)."""
+    
+    def __init__(self, name: str, documentation: str):
+        self.name = name
+        self.documentation = documentation
+        self.value = 0.0
+        self._lock = threading.Lock()
+    
+    def inc(self, amount: float = 1):
+        with self._lock:
+            self.value += amount
+    
+    def dec(self, amount: float = 1):
+        self.inc(-amount)
+    
+    def render(self):
+        yield f'# HELP {self.name} {self.documentation}'
+        yield f'# TYPE {self.name} gauge'
+        yield f'{self.name} {self.value}'
+
+
+class Histogram:
+    """Cumulative-bucket histogram with optional labels."""
+    
+    def __init__(self, name: str, documentation: str, buckets: Sequence[float], labelnames: Sequence[str] = ()):
+        self.name = name
+        self.documentation = documentation
+        self.buckets = tuple(buckets)
+        self.labelnames = tuple(labelnames)
+        # labels -> [per-bucket counts (+Inf last), sum, count]
+        self._values: Dict[Tuple, list] = {}
+        self._lock = threading.Lock()
+    
+    def observe(self, value: float, labels: Tuple = ()):
+        index = bisect_left(self.buckets, value)
+        with self._lock:
+            entry = self._values.get(labels)
+            if entry is None:
+                entry = self._values[labels] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+            entry[0][index] += 1
+            entry[1] += value
+            entry[2] += 1
+    
+    def render(self):
+        yield f'# HELP {self.name} {self.documentation}'
+        yield f'# TYPE {self.name} histogram'
+        for labels, (counts, total, count) in sorted(self._values.items()):
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets + (float('inf'),), counts):
+                cumulative += bucket_count
+                le = 'le="+Inf"' if bound == float('inf') else f'le="{bound!r}"'
+                yield f'{self.name}_bucket{_format_labels(self.labelnames, labels, le)} {cumulative}'
+            yield f'{self.name}_sum{_format_labels(self.labelnames, labels)} {total}'
+            yield f'{self.name}_count{_format_labels(self.labelnames, labels)} {count}'
+
+
+class Registry:
+    def __init__(self):
+        self.metrics = []
+    
+    def counter(self, *args, **kwargs) -> Counter:
+        metric = Counter(*args, **kwargs)
+        self.metrics.append(metric)
+        return metric
+    
+    def gauge(self, *args, **kwargs) -> Gauge:
+        metric = Gauge(*args, **kwargs)
+        self.metrics.append(metric)
+        return metric
+    
+    def histogram(self, *args, **kwargs) -> Histogram:
+        metric = Histogram(*args, **kwargs)
+        self.metrics.append(metric)
+        return metric
+    
+    def render(self) -> str:
+        """Prometheus text exposition format (version 0.0.4)."""
+        lines = []
+        for metric in self.metrics:
+            lines.extend(metric.render())
+        return '\n'.join(lines) + '\n'
+
+
+registry = Registry()
+
+REQUESTS = registry.counter(
+    'nextitem_requests_total', 'HTTP requests by route and status code', ('route', 'status'))
+REQUEST_SECONDS = registry.histogram(
+    'nextitem_request_seconds', 'End-to-end HTTP request latency by route', LATENCY_BUCKETS, ('route',))
+PREDICT_STAGE_SECONDS = registry.histogram(
+    'nextitem_predict_stage_seconds', 'Time spent in each /predict stage', LATENCY_BUCKETS, ('stage',))
+CART_SIZE = registry.histogram(
+    'nextitem_cart_size', 'Number of items in /predict carts', CART_SIZE_BUCKETS)
+MODEL_LOAD_SECONDS = registry.histogram(
+    'nextitem_model_load_seconds', 'Model loading time by phase', LOAD_BUCKETS, ('phase',))
+MODEL_LOADS = registry.counter(
+    'nextitem_model_loads_total', 'Model loads and reloads by result', ('result',))
+PREDICT_IN_FLIGHT = registry.gauge(
+    'nextitem_predict_in_flight', 'Distinct prediction computations currently running')
+PREDICT_COALESCED = registry.counter(
+    'nextitem_predict_coalesced_total', 'Predictions served by joining an identical in-flight computation')
+PREDICTION_CACHE = registry.counter(
+    'nextitem_prediction_cache_total', 'Prediction result cache lookups by result', ('result',))
+STREAM_MESSAGES = registry.counter(
+    'nextitem_stream_messages_total', 'Cart deltas received on /ws/predict by result', ('result',))
+
+
+class StageTimer:
+    """Records the time since the previous mark() under the given stage name."""
+    
+    __slots__ = ('last',)
+    
+    def __init__(self):
+        self.last = perf_counter()
+    
+    def mark(self, stage: str):
+        now = perf_counter()
+        PREDICT_STAGE_SECONDS.observe(now - self.last, (stage,))
+        self.last = now
+
+
+class NullTimer:
+    __slots__ = ()
+    
+    def mark(self, stage: str):
+        pass
+
+
+NULL_TIMER = NullTimer()
+
+
+def stage_timer():
+    """A StageTimer when metrics are enabled, otherwise the shared no-op timer."""
+    return StageTimer() if ENABLED else NULL_TIMER
+
+
+class MetricsMiddleware:
+    """ASGI middleware recording request counts and latency per route template."""
+    
+    def __init__(self, app):
+        self.app = app
+    
+    async def __call__(self, scope, receive, send):
+        if scope['type'] != 'http':
+            await self.app(scope, receive, send)
+            return
+        
+        start = perf_counter()
+        status = [500]
+        
+        async def send_wrapper(message):
+            if message['type'] == 'http.response.start':
+                status[0] = message['status']
+            await send(message)
+        
+        try:
+            await self.app(scope, receive, send_wrapper)
+        finally:
+            # The router stores the matched route in the scope; use its
+            # template so path parameters don't explode label cardinality
+            route = scope.get('route')
+            path = getattr(route, 'path', None) or 'unmatched'
+            REQUEST_SECONDS.observe(perf_counter() - start, (path,))
+            REQUESTS.inc(1, (path, str(status[0])))
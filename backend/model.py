@@ -1,30 +1,308 @@
 """
 PyTorch model for next-item prediction based on cart contents.
 Simple and efficient architecture optimized for grocery recommendations.
+
+Two cart encoders share the same MLP head: NextItemPredictor mean-pools
+the cart (order-free), SequenceNextItemPredictor runs a GRU over it in
+add-to-cart order. Checkpoints record which one they hold in 'model_type';
+build_model_from_checkpoint rebuilds either.
+
+Either can replace the flat fc_out softmax with a two-level one over
+item clusters (aisles or departments), see HierarchicalOutput, or
+replace the per-item embedding and output tables with compositional
+ones whose size grows with sqrt(num_items), see QREmbedding. A trained
+fc_out can also be factorized to low rank (LowRankOutput,
+scripts/compress_output_layer.py).
 """
 
+import math
+
 import torch
 import torch.nn as nn
 import torch.nn.functional as F
 
 
+class HierarchicalOutput(nn.Module):
+    """
+    Two-level softmax over items grouped into clusters (aisles or departments):
+        
+        P(item | x) = P(cluster | x) * P(item | cluster, x)
+    
+    Training scores the cluster layer and only the target's cluster, so
+    each example costs num_clusters + cluster size instead of num_items
+    (about 2 * sqrt(num_items) with Instacart's aisles). Top-k uses beam
+    search over the most likely clusters. Rows of item_out are grouped by
+    cluster, so each cluster's weights are one contiguous slice.
+    """
+    
+    def __init__(self, hidden_dim: int, item_clusters):
+        super().__init__()
+        item_clusters = torch.as_tensor(item_clusters, dtype=torch.long)
+        num_items = len(item_clusters)
+        self.num_clusters = int(item_clusters.max()) + 1
+        
+        order = torch.argsort(item_clusters, stable=True)
+        position = torch.empty_like(order)
+        position[order] = torch.arange(num_items)
+        sizes = torch.bincount(item_clusters, minlength=self.num_clusters)
+        starts = torch.zeros(self.num_clusters + 1, dtype=torch.long)
+        starts[1:] = sizes.cumsum(0)
+        self.register_buffer('item_clusters', item_clusters)
+        self.register_buffer('order', order)                        # row -> item
+        self.register_buffer('position', position)                  # item -> row
+        self.register_buffer('row_clusters', item_clusters[order])  # row -> cluster
+        self.register_buffer('cluster_starts', starts)
+        # Every row but padding (item 0), which sits in its own cluster
+        # (unknown metadata) and so would inherit that cluster's probability
+        servable = torch.ones(num_items, dtype=torch.bool)
+        servable[position[0]] = False
+        self.register_buffer('servable_rows', servable, persistent=False)
+        self.register_buffer('servable_counts', sizes - F.one_hot(item_clusters[0], self.num_clusters),
+                             persistent=False)
+        # Python copies for slicing without device syncs
+        self.bounds = starts.tolist()
+        self.sizes = sizes.tolist()
+        self.max_cluster_size = int(sizes.max())
+        
+        self.cluster_out = nn.Linear(hidden_dim, self.num_clusters)
+        self.item_out = nn.Linear(hidden_dim, num_items)
+        nn.init.xavier_uniform_(self.cluster_out.weight)
+        nn.init.xavier_uniform_(self.item_out.weight)
+    
+    def cluster_logits(self, x, cluster):
+        """Logits (batch, cluster size) of one cluster's items, in row order."""
+        start, end = self.bounds[cluster], self.bounds[cluster + 1]
+        return F.linear(x, self.item_out.weight[start:end], self.item_out.bias[start:end])
+    
+    def log_probs(self, x):
+        """Exact log P(item | x) for every item, (batch, num_items) in item order."""
+        cluster_logp = F.log_softmax(self.cluster_out(x), dim=-1)
+        logits = self.item_out(x)
+        # shape[0] rather than len(), which ONNX export would fix at the traced batch size
+        clusters = self.row_clusters.expand(x.shape[0], -1)
+        # Per-cluster logsumexp of the item logits
+        peak = logits.new_full(cluster_logp.shape, float('-inf')).scatter_reduce(
+            1, clusters, logits, 'amax', include_self=True)
+        total = torch.zeros_like(cluster_logp).scatter_add(1, clusters, (logits - peak.gather(1, clusters)).exp())
+        lse = peak + total.log()
+        log_probs = logits - lse.gather(1, clusters) + cluster_logp.gather(1, clusters)
+        return log_probs[:, self.position]
+    
+    def loss(self, x, targets, weights=None):
+        """
+        Mean negative log-likelihood of the targets, scoring only their clusters
+        (weighted by per-example weights if given).
+        """
+        target_clusters = self.item_clusters[targets]
+        if weights is None:
+            weights = torch.ones(len(targets), device=x.device)
+        loss = (F.cross_entropy(self.cluster_out(x), target_clusters, reduction='none') * weights).sum()
+        
+        # Group examples by target cluster. split() keeps the backward pass
+        # to one full-size gradient, where indexing or slicing per cluster
+        # would materialize one per cluster
+        grouped = torch.argsort(target_clusters)
+        clusters, counts = torch.unique_consecutive(target_clusters[grouped], return_counts=True)
+        counts = counts.tolist()
+        item_weights = self.item_out.weight.split(self.sizes)
+        item_biases = self.item_out.bias.split(self.sizes)
+        rows = self.position[targets[grouped]]
+        groups = zip(clusters.tolist(), x[grouped].split(counts), rows.split(counts), weights[grouped].split(counts))
+        for cluster, x_group, row_group, weight_group in groups:
+            logits = F.linear(x_group, item_weights[cluster], item_biases[cluster])
+            nll = F.cross_entropy(logits, row_group - self.bounds[cluster], reduction='none')
+            loss = loss + (nll * weight_group).sum()
+        return loss / weights.sum()
+    
+    def beam_top_k(self, x, k=10, beam=8, mask=None):
+        """
+        Top-k items from the `beam` most likely clusters.
+        
+        The beam widens until its clusters hold at least k (allowed) items,
+        and clusters without allowed items are skipped, so k results come
+        back whenever k items are allowed. Padding is never returned.
+        Probabilities are exact.
+        
+        Returns:
+            (top_items, top_probs) as NextItemPredictor.predict_top_k
+        """
+        batch_size = len(x)
+        cluster_logp = F.log_softmax(self.cluster_out(x), dim=-1)
+        if mask is None:
+            allowed_rows = self.servable_rows
+            counts = self.servable_counts.unsqueeze(0)
+        else:
+            allowed_rows = mask[..., self.order] & self.servable_rows
+            counts = torch.zeros(allowed_rows.shape[:-1] + (self.num_clusters,), device=x.device)
+            counts = counts.index_add_(-1, self.row_clusters, allowed_rows.float()).reshape(-1, self.num_clusters)
+        
+        ranked = torch.argsort(cluster_logp.masked_fill(counts == 0, float('-inf')), dim=-1, descending=True)
+        covered = counts.expand(batch_size, -1).gather(1, ranked).cumsum(1)
+        width = min(max(beam, int((covered < k).sum(1).max()) + 1), self.num_clusters)
+        selected = ranked[:, :width]
+        
+        # One block of max_cluster_size columns per beam slot
+        block = self.max_cluster_size
+        scores = x.new_full((batch_size, width * block), float('-inf'))
+        for cluster in torch.unique(selected).tolist():
+            carts, slots = (selected == cluster).nonzero(as_tuple=True)
+            log_probs = (F.log_softmax(self.cluster_logits(x[carts], cluster), dim=-1)
+                         + cluster_logp[carts, cluster].unsqueeze(1))
+            allowed = allowed_rows[..., self.bounds[cluster]:self.bounds[cluster + 1]]
+            log_probs = log_probs.masked_fill(~(allowed[carts] if allowed.dim() == 2 else allowed), float('-inf'))
+            columns = slots.unsqueeze(1) * block + torch.arange(log_probs.shape[1], device=x.device)
+            scores[carts.unsqueeze(1), columns] = log_probs
+        
+        top_logp, top_columns = torch.topk(scores, k=min(k, scores.shape[1]), dim=-1)
+        rows = self.cluster_starts[selected.gather(1, top_columns // block)] + top_columns % block
+        top_items = self.order[rows.clamp(max=len(self.order) - 1)]
+        top_probs = torch.where(torch.isfinite(top_logp), top_logp.exp(), top_logp)
+        return top_items, top_probs
+    
+    def item_weights(self):
+        """Output weights (num_items, hidden_dim) in item order."""
+        return self.item_out.weight[self.position]
+
+
+class QREmbedding(nn.Module):
+    """
+    Quotient-remainder compositional embedding:
+        
+        embedding(i) = quotient[i // buckets] * remainder[i % buckets]
+    
+    Two tables of num_items / buckets and buckets rows replace one of
+    num_items rows (with buckets ~ sqrt(num_items), 2 * sqrt(num_items)
+    rows), and every item still gets a distinct vector. Padding (item 0)
+    embeds to zeros, like nn.Embedding's padding_idx.
+    """
+    
+    def __init__(self, num_items: int, embedding_dim: int, buckets: int):
+        super().__init__()
+        self.num_items = num_items
+        self.embedding_dim = embedding_dim
+        self.buckets = buckets
+        self.quotient = nn.Embedding(math.ceil(num_items / buckets), embedding_dim)
+        self.remainder = nn.Embedding(buckets, embedding_dim)
+        # Products start close to the quotient vectors, at xavier scale
+        nn.init.xavier_uniform_(self.quotient.weight)
+        nn.init.normal_(self.remainder.weight, mean=1.0, std=0.1)
+    
+    def forward(self, items):
+        embeddings = self.quotient(items // self.buckets) * self.remainder(items % self.buckets)
+        return embeddings * (items != 0).unsqueeze(-1).to(embeddings.dtype)
+    
+    @property
+    def weight(self):
+        """Every item's vector, (num_items, embedding_dim); materialized on each access."""
+        table = self.quotient.weight.unsqueeze(1) * self.remainder.weight.unsqueeze(0)
+        return table.reshape(-1, self.embedding_dim)[:self.num_items]
+
+
+class CompositionalOutput(nn.Module):
+    """
+    Output layer tied to a QREmbedding: logits are a projection of the
+    features dotted with every item's compositional vector, plus a bias
+    per item. For small batches the logits come straight from the two
+    tables, ((x * quotient) @ remainder.T), without building the
+    (num_items, embedding_dim) table.
+    """
+    
+    def __init__(self, hidden_dim: int, embedding: QREmbedding):
+        super().__init__()
+        self.embedding = embedding
+        self.project = nn.Linear(hidden_dim, embedding.embedding_dim, bias=False)
+        self.bias = nn.Parameter(torch.zeros(embedding.num_items))
+        nn.init.xavier_uniform_(self.project.weight)
+    
+    def rows(self, items):
+        """Item vectors that projected features are dotted with."""
+        return self.embedding(items)
+    
+    def forward(self, x):
+        x = self.project(x)
+        quotient = self.embedding.quotient.weight
+        if len(x) * len(quotient) < self.embedding.num_items:
+            # (batch, quotients, dim) @ (dim, buckets) -> item q * buckets + r at [q, r]
+            logits = torch.matmul(x.unsqueeze(1) * quotient, self.embedding.remainder.weight.T).flatten(1)
+            logits = logits[:, :self.embedding.num_items]
+        else:
+            logits = x @ self.embedding.weight.T
+        return logits + self.bias
+
+
+class LowRankOutput(nn.Module):
+    """
+    Rank-r factorization of fc_out: logits = (x @ project.T) @ item_factors.T + bias,
+    costing (hidden_dim + num_items) * rank instead of hidden_dim * num_items.
+    """
+    
+    def __init__(self, hidden_dim: int, num_items: int, rank: int):
+        super().__init__()
+        self.project = nn.Linear(hidden_dim, rank, bias=False)
+        self.item_factors = nn.Parameter(torch.empty(num_items, rank))
+        self.bias = nn.Parameter(torch.zeros(num_items))
+        nn.init.xavier_uniform_(self.project.weight)
+        nn.init.xavier_uniform_(self.item_factors)
+    
+    @classmethod
+    def from_linear(cls, linear: nn.Linear, rank: int) -> 'LowRankOutput':
+        """Best rank-r approximation of a trained layer's weight (truncated SVD)."""
+        num_items, hidden_dim = linear.weight.shape
+        layer = cls(hidden_dim, num_items, rank)
+        with torch.no_grad():
+            U, S, Vh = torch.linalg.svd(linear.weight.float(), full_matrices=False)
+            # Singular values go with the items, so project stays orthonormal
+            layer.item_factors.copy_(U[:, :rank] * S[:rank])
+            layer.project.weight.copy_(Vh[:rank])
+            layer.bias.copy_(linear.bias)
+        return layer.to(linear.weight.device)
+    
+    def rows(self, items):
+        """Item factors that projected features are dotted with."""
+        return self.item_factors[items]
+    
+    def forward(self, x):
+        return F.linear(self.project(x), self.item_factors, self.bias)
+
+
 class NextItemPredictor(nn.Module):
     """
     Simple but effective model for next-item prediction.
     Uses embeddings + deep MLP with skip connections.
     """
     
-    def __init__(self, num_items: int, embedding_dim: int = 128, hidden_dim: int = 256):
+    model_type = 'mlp'
+    # Mean pooling: a cart's item order does not change its prediction
+    order_invariant = True
+    
+    def __init__(self, num_items: int, embedding_dim: int = 128, hidden_dim: int = 256,
+                 item_clusters=None, qr_buckets: int = 0, output_rank: int = 0):
+        """
+        Args:
+            item_clusters: optional cluster id per item index; replaces the
+                flat fc_out with a HierarchicalOutput
+            qr_buckets: if > 0, compress item embeddings into a QREmbedding
+                with this many remainder buckets and tie fc_out to it
+            output_rank: if > 0, fc_out is a LowRankOutput of this rank
+        """
         super().__init__()
         self.num_items = num_items
         self.embedding_dim = embedding_dim
+        self.hierarchical = item_clusters is not None
+        self.compressed = qr_buckets > 0
+        self.output_rank = output_rank
+        if (self.hierarchical + self.compressed + (output_rank > 0)) > 1:
+            raise ValueError("Hierarchical, compressed and low-rank output layers are mutually exclusive")
         
         # Item embeddings
-        self.item_embeddings = nn.Embedding(
-            num_embeddings=num_items,
-            embedding_dim=embedding_dim,
-            padding_idx=0
-        )
+        if self.compressed:
+            self.item_embeddings = QREmbedding(num_items, embedding_dim, qr_buckets)
+        else:
+            self.item_embeddings = nn.Embedding(
+                num_embeddings=num_items,
+                embedding_dim=embedding_dim,
+                padding_idx=0
+            )
         
         # Deep MLP with residual connections
         self.fc1 = nn.Linear(embedding_dim, hidden_dim)
@@ -36,26 +314,41 @@ class NextItemPredictor(nn.Module):
         self.fc3 = nn.Linear(hidden_dim, hidden_dim)
         self.bn3 = nn.BatchNorm1d(hidden_dim)
         
-        self.fc_out = nn.Linear(hidden_dim, num_items)
+        if self.hierarchical:
+            self.output = HierarchicalOutput(hidden_dim, item_clusters)
+        elif self.compressed:
+            self.fc_out = CompositionalOutput(hidden_dim, self.item_embeddings)
+        elif output_rank > 0:
+            self.fc_out = LowRankOutput(hidden_dim, num_items, output_rank)
+        else:
+            self.fc_out = nn.Linear(hidden_dim, num_items)
         
         self.dropout = nn.Dropout(0.4)
         
-        # Initialize
-        nn.init.xavier_uniform_(self.item_embeddings.weight)
+        # Initialize (compositional layers initialize themselves)
+        if not self.compressed:
+            nn.init.xavier_uniform_(self.item_embeddings.weight)
         nn.init.xavier_uniform_(self.fc1.weight)
         nn.init.xavier_uniform_(self.fc2.weight)
         nn.init.xavier_uniform_(self.fc3.weight)
-        nn.init.xavier_uniform_(self.fc_out.weight)
+        if not (self.hierarchical or self.compressed or self.output_rank):
+            nn.init.xavier_uniform_(self.fc_out.weight)
     
-    def forward(self, cart_items):
+    def forward(self, cart_items, user_vectors=None):
         """
         Forward pass.
         
         Args:
             cart_items: (batch_size, seq_len)
+            user_vectors: optional (batch_size, embedding_dim) per-user vectors
+                          added to the cart vector (personalized models)
         Returns:
             logits: (batch_size, num_items)
         """
+        return self.score(self.cart_vector(cart_items), user_vectors)
+    
+    def cart_vector(self, cart_items):
+        """Encode padded carts (batch_size, seq_len) as (batch_size, embedding_dim)."""
         # Get embeddings
         embeddings = self.item_embeddings(cart_items)
         
@@ -63,7 +356,42 @@ class NextItemPredictor(nn.Module):
         mask = (cart_items != 0).float().unsqueeze(-1)
         cart_sum = (embeddings * mask).sum(dim=1)
         cart_count = mask.sum(dim=1).clamp(min=1)
-        cart_vector = cart_sum / cart_count
+        return cart_sum / cart_count
+    
+    def score(self, cart_vector, user_vectors=None):
+        """Logits (batch_size, num_items) for encoded carts (log-probabilities if hierarchical)."""
+        features = self.features(cart_vector, user_vectors)
+        if self.hierarchical:
+            return self.output.log_probs(features)
+        return self.fc_out(features)
+    
+    def hierarchical_loss(self, cart_items, targets, user_vectors=None, weights=None):
+        """Training loss of a hierarchical model, without scoring the whole catalog."""
+        return self.output.loss(self.features(self.cart_vector(cart_items), user_vectors), targets, weights)
+    
+    def beam_top_k(self, cart_vector, k=10, beam=8, mask=None, user_vectors=None):
+        """Approximate top-k of a hierarchical model by beam search (HierarchicalOutput.beam_top_k)."""
+        with torch.no_grad():
+            return self.output.beam_top_k(self.features(cart_vector, user_vectors), k, beam, mask)
+    
+    def item_output_weights(self):
+        """
+        Output-layer row of every item, (num_items, hidden_dim) in item order
+        ((num_items, embedding_dim) item vectors when compressed, and
+        (num_items, rank) factors when low-rank).
+        """
+        if self.hierarchical:
+            return self.output.item_weights()
+        if self.compressed:
+            return self.item_embeddings.weight
+        if self.output_rank:
+            return self.fc_out.item_factors
+        return self.fc_out.weight
+    
+    def features(self, cart_vector, user_vectors=None):
+        """MLP output (batch_size, hidden_dim) that fc_out turns into logits."""
+        if user_vectors is not None:
+            cart_vector = cart_vector + user_vectors
         
         # Deep MLP with residual connections
         x = F.relu(self.bn1(self.fc1(cart_vector)))
@@ -77,28 +405,173 @@ class NextItemPredictor(nn.Module):
         x3 = self.dropout(x3)
         x = x + x3  # Residual
         
-        logits = self.fc_out(x)
-        
-        return logits
+        return x
     
-    def predict_top_k(self, cart_items, k=10):
+    def predict_top_k(self, cart_items, k=10, mask=None, user_vectors=None):
         """
         Predict top-k next items with probabilities.
         
         Args:
             cart_items: tensor of shape (batch_size, max_cart_size)
             k: number of top predictions to return
+            mask: optional bool tensor of shape (num_items,) or (batch_size, num_items);
+                  only items where it is True are returned
+            user_vectors: optional (batch_size, embedding_dim), see forward
+        
+        Hierarchical models score every item exactly here; see beam_top_k.
         
         Returns:
             top_items: tensor of shape (batch_size, k) with item IDs
             top_probs: tensor of shape (batch_size, k) with probabilities
+                       (-inf where fewer than k items are allowed)
         """
         with torch.no_grad():
-            logits = self.forward(cart_items)
-            probs = F.softmax(logits, dim=-1)
-            top_probs, top_items = torch.topk(probs, k=k, dim=-1)
+            return self.top_k(self.forward(cart_items, user_vectors), k, mask)
+    
+    @staticmethod
+    def top_k(logits, k=10, mask=None):
+        """(top_items, top_probs) from logits; see predict_top_k."""
+        probs = F.softmax(logits, dim=-1)
+        if mask is not None:
+            # Softmax over all items first, so allowed items keep their probabilities
+            probs = probs.masked_fill(~mask, float('-inf'))
+        top_probs, top_items = torch.topk(probs, k=k, dim=-1)
         
         return top_items, top_probs
+    
+    def top_k_candidates(self, cart_vector, candidates, k=10, mask=None, user_vectors=None):
+        """
+        Top-k among candidate items, scoring only their rows of fc_out.
+        
+        Args:
+            cart_vector: (batch_size, embedding_dim) from cart_vector
+            candidates: (batch_size, num_candidates) item indices (candidates.py)
+            mask: optional allowed-items mask over all items, as in predict_top_k
+        
+        Returns:
+            (top_items, top_probs) as predict_top_k, with probabilities
+            normalized over the candidates
+        """
+        with torch.no_grad():
+            features = self.features(cart_vector, user_vectors)
+            if isinstance(self.fc_out, nn.Linear):
+                weights = self.fc_out.weight[candidates]  # (batch, num_candidates, hidden_dim)
+            else:
+                # Factored layers: candidate rows in the projected space
+                features = self.fc_out.project(features)
+                weights = self.fc_out.rows(candidates)
+            logits = torch.baddbmm(self.fc_out.bias[candidates].unsqueeze(-1),
+                                   weights, features.unsqueeze(-1)).squeeze(-1)
+            if mask is not None:
+                mask = mask.expand(len(candidates), -1).gather(1, candidates)
+            positions, top_probs = self.top_k(logits, min(k, candidates.shape[1]), mask)
+        return candidates.gather(1, positions), top_probs
+
+
+class SequenceNextItemPredictor(NextItemPredictor):
+    """
+    Order-aware variant: a GRU over item + position embeddings replaces
+    mean pooling; the MLP head is the same.
+    
+    Carts are padded at the end, so the GRU output at the last real item
+    is the cart vector. Because the encoder is causal, a cart that grows
+    by one item needs one GRU step from the previous cart vector
+    (extend) instead of re-encoding the whole cart.
+    """
+    
+    model_type = 'gru'
+    order_invariant = False
+    
+    def __init__(self, num_items: int, embedding_dim: int = 128, hidden_dim: int = 256,
+                 max_cart_size: int = 20, item_clusters=None, qr_buckets: int = 0, output_rank: int = 0):
+        super().__init__(num_items, embedding_dim, hidden_dim, item_clusters, qr_buckets, output_rank)
+        self.max_cart_size = max_cart_size
+        self.position_embeddings = nn.Embedding(max_cart_size, embedding_dim)
+        # Single layer, so the output at each step is also the hidden state
+        self.gru = nn.GRU(embedding_dim, embedding_dim, batch_first=True)
+        
+        nn.init.normal_(self.position_embeddings.weight, std=0.02)
+    
+    def cart_vector(self, cart_items):
+        """GRU state after each cart's last item (zeros for empty carts)."""
+        seq_len = cart_items.shape[1]
+        positions = torch.arange(seq_len, device=cart_items.device)
+        embeddings = self.item_embeddings(cart_items) + self.position_embeddings(positions)
+        outputs, _ = self.gru(embeddings)
+        
+        lengths = (cart_items != 0).sum(dim=1)
+        last = (lengths - 1).clamp(min=0)
+        # gather rather than outputs[arange(batch), last], which ONNX export would fix at the traced batch size
+        cart_vector = outputs.gather(1, last.view(-1, 1, 1).expand(-1, 1, outputs.shape[-1])).squeeze(1)
+        return cart_vector * (lengths > 0).unsqueeze(-1).to(cart_vector.dtype)
+    
+    def extend(self, cart_vector, new_items, start_position):
+        """
+        Cart vector after appending items to already-encoded carts.
+        
+        Args:
+            cart_vector: (batch_size, embedding_dim) from cart_vector or extend
+                         (None for empty carts)
+            new_items: (batch_size, num_new) items appended, in order
+            start_position: position of the first new item (the old cart length)
+        """
+        positions = torch.arange(start_position, start_position + new_items.shape[1], device=new_items.device)
+        embeddings = self.item_embeddings(new_items) + self.position_embeddings(positions)
+        hidden = cart_vector.unsqueeze(0).contiguous() if cart_vector is not None else None
+        _, hidden = self.gru(embeddings, hidden)
+        return hidden[0]
+
+
+MODEL_TYPES = {
+    NextItemPredictor.model_type: NextItemPredictor,
+    SequenceNextItemPredictor.model_type: SequenceNextItemPredictor,
+}
+
+
+def build_model(model_type: str, num_items: int, embedding_dim: int, hidden_dim: int,
+                max_cart_size: int = 20, item_clusters=None, qr_buckets: int = 0,
+                output_rank: int = 0) -> NextItemPredictor:
+    """
+    Instantiate a next-item model by type name ('mlp' or 'gru').
+    
+    item_clusters (cluster id per item) selects the hierarchical output
+    layer, qr_buckets > 0 compressed (QREmbedding) item tables and
+    output_rank > 0 a low-rank fc_out.
+    """
+    if model_type not in MODEL_TYPES:
+        raise ValueError(f"Unknown model type: {model_type} (expected one of {sorted(MODEL_TYPES)})")
+    if model_type == SequenceNextItemPredictor.model_type:
+        return SequenceNextItemPredictor(num_items, embedding_dim, hidden_dim, max_cart_size, item_clusters,
+                                         qr_buckets, output_rank)
+    return MODEL_TYPES[model_type](num_items=num_items, embedding_dim=embedding_dim, hidden_dim=hidden_dim,
+                                   item_clusters=item_clusters, qr_buckets=qr_buckets, output_rank=output_rank)
+
+
+def build_model_from_checkpoint(checkpoint: dict, assign: bool = False) -> NextItemPredictor:
+    """
+    Rebuild and load the model saved in a checkpoint dict (pre-'model_type' checkpoints are MLPs).
+    
+    With assign=True the model's parameters become the checkpoint's
+    tensors instead of copies, e.g. to keep a memory-mapped checkpoint
+    (checkpoint_store.py) mapped.
+    """
+    state_dict = checkpoint['model_state_dict']
+    remainder = state_dict.get('item_embeddings.remainder.weight')
+    item_factors = state_dict.get('fc_out.item_factors')
+    model = build_model(
+        checkpoint.get('model_type', NextItemPredictor.model_type),
+        num_items=checkpoint['num_items'],
+        embedding_dim=checkpoint['embedding_dim'],
+        hidden_dim=checkpoint['hidden_dim'],
+        max_cart_size=checkpoint.get('max_cart_size', 20),
+        # Hierarchical models carry their clustering as a buffer
+        item_clusters=state_dict.get('output.item_clusters'),
+        # So do compressed and low-rank ones their sizes, as table shapes
+        qr_buckets=len(remainder) if remainder is not None else 0,
+        output_rank=item_factors.shape[1] if item_factors is not None else 0
+    )
+    model.load_state_dict(state_dict, assign=assign)
+    return model
 
 
 class CoPurchasePredictor(nn.Module):
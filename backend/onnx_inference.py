@@ -0,0 +1,158 @@
+"""
+ONNX Runtime backend for serving exported models on the CPU.
+
+scripts/export_onnx.py writes a checkpoint's predict_top_k (forward
+pass, softmax, business-rule mask and top-k) as one ONNX graph:
+    
+    inputs:  carts (batch, cart_len) int64, mask (num_items,) bool,
+             user_vectors (batch, embedding_dim) float32, k (1,) int64
+    outputs: items (batch, k) int64, probs (batch, k) float32
+
+with the checkpoint's info in the model metadata and the item vectors
+for diversity re-ranking in .npy files next to it, memory-mapped on
+first use. Nothing here imports torch, so a server started with
+INFERENCE_BACKEND=onnx starts faster and needs less memory. Two-stage
+scoring, beam search and incremental encoding need the PyTorch backend;
+hierarchical models score every item exactly.
+"""
+
+import json
+import os
+import time
+from time import perf_counter
+from typing import Dict, Optional, Tuple
+
+import numpy as np
+import onnxruntime as ort
+
+from bundle_base import MAX_CART_SIZE, BaseBundle
+from vocab_store import CompactVocabulary, load_vocabulary
+from user_store import UserStore
+import metrics
+
+
+# Model metadata key holding the checkpoint info written by the exporter
+METADATA_KEY = 'checkpoint'
+
+
+def item_vectors_path(model_path: str, source: str) -> str:
+    """Where the exporter writes an exported model's item vectors (item_embeddings or fc_out)."""
+    return f"{os.path.splitext(model_path)[0]}.{source}.npy"
+
+
+class OnnxModelBundle(BaseBundle):
+    """An exported model in an ONNX Runtime session, with its vocabulary."""
+    
+    # Reported by /health and used when reloading
+    device = 'cpu'
+    
+    def __init__(self, session: ort.InferenceSession, vocabulary: CompactVocabulary,
+                 info: Dict, users: Optional[UserStore] = None):
+        super().__init__(vocabulary, info, users)
+        self.session = session
+        self.embedding_dim = info['embedding_dim']
+        self.all_items = np.ones(vocabulary.num_items, dtype=bool)
+    
+    def predict(self, padded_carts: np.ndarray, top_k: int,
+                timer=metrics.NULL_TIMER, mask: Optional[np.ndarray] = None,
+                user_vector: Optional[np.ndarray] = None) -> Tuple[np.ndarray, np.ndarray]:
+        batch_size = len(padded_carts)
+        if user_vector is None:
+            user_vectors = np.zeros((batch_size, self.embedding_dim), dtype=np.float32)
+        else:
+            # Added to the cart vector, so zeros are the same as no user
+            user_vectors = np.broadcast_to(np.asarray(user_vector, dtype=np.float32),
+                                           (batch_size, self.embedding_dim))
+        inputs = {
+            'carts': np.ascontiguousarray(padded_carts, dtype=np.int64),
+            'mask': self.all_items if mask is None else mask,
+            'user_vectors': np.ascontiguousarray(user_vectors),
+            'k': np.array([min(top_k, self.vocabulary.num_items)], dtype=np.int64),
+        }
+        timer.mark('tensor')
+        top_items, top_probs = self.session.run(['items', 'probs'], inputs)
+        timer.mark('forward')
+        return top_items, top_probs
+    
+    def item_vectors(self, source: str) -> np.ndarray:
+        path = item_vectors_path(self.info['model_path'], source)
+        if not os.path.exists(path):
+            raise ValueError(f"No {source} vectors next to {self.info['model_path']}; re-export the model")
+        return np.load(path, mmap_mode='r')
+
+
+def load_onnx_bundle(model_path: str, vocab_path: str, threads: int = 0) -> OnnxModelBundle:
+    """
+    Load an exported model (scripts/export_onnx.py) and its vocabulary.
+    
+    Args:
+        threads: ONNX Runtime intra-op threads per prediction (0 = all cores)
+    """
+    print("Using ONNX Runtime on cpu")
+    
+    print(f"Loading vocabulary from {vocab_path}...")
+    start = perf_counter()
+    vocabulary = load_vocabulary(vocab_path)
+    metrics.MODEL_LOAD_SECONDS.observe(perf_counter() - start, ('vocabulary',))
+    print(f"Loaded vocabulary with {vocabulary.num_items} items")
+    
+    print(f"Loading model from {model_path}...")
+    start = perf_counter()
+    options = ort.SessionOptions()
+    options.intra_op_num_threads = threads
+    session = ort.InferenceSession(model_path, options, providers=['CPUExecutionProvider'])
+    metadata = session.get_modelmeta().custom_metadata_map
+    if METADATA_KEY not in metadata:
+        raise ValueError(f"{model_path} was not written by scripts/export_onnx.py")
+    checkpoint = json.loads(metadata[METADATA_KEY])
+    if checkpoint['num_items'] != vocabulary.num_items:
+        raise ValueError(
+            f"Checkpoint has {checkpoint['num_items']} items but vocabulary has {vocabulary.num_items}"
+        )
+    metrics.MODEL_LOAD_SECONDS.observe(perf_counter() - start, ('checkpoint',))
+    
+    users = None
+    if checkpoint.get('user_store'):
+        # Stored relative to the exported model, as for checkpoints
+        store_path = os.path.join(os.path.dirname(os.path.abspath(model_path)), checkpoint['user_store'])
+        start = perf_counter()
+        users = UserStore.load(store_path)
+        if users.embedding_dim != checkpoint['embedding_dim']:
+            raise ValueError(
+                f"User store has {users.embedding_dim}-dim vectors but model has {checkpoint['embedding_dim']}"
+            )
+        if users.store_id != checkpoint.get('user_store_id'):
+            raise ValueError(f"User store at {store_path} was not exported with this checkpoint")
+        metrics.MODEL_LOAD_SECONDS.observe(perf_counter() - start, ('user_store',))
+        print(f"Loaded user store with {users.num_users:,} users")
+    
+    # JSON keys are strings; checkpoints key accuracy by k
+    val_accuracy = checkpoint.get('val_accuracy')
+    if val_accuracy is not None:
+        val_accuracy = {int(k): v for k, v in val_accuracy.items()}
+    print(f"Model loaded successfully!")
+    print(f"  Validation loss: {checkpoint.get('val_loss', 'N/A')}")
+    if val_accuracy is not None:
+        print(f"  Top-k accuracy: {val_accuracy}")
+    
+    info = {
+        'backend': 'onnx',
+        'model_path': os.path.abspath(model_path),
+        'vocab_path': os.path.abspath(vocab_path),
+        'model_type': checkpoint['model_type'],
+        'hierarchy': checkpoint.get('hierarchy'),
+        'qr_buckets': checkpoint.get('qr_buckets', 0),
+        'output_rank': checkpoint.get('output_rank', 0),
+        'max_cart_size': checkpoint.get('max_cart_size', MAX_CART_SIZE),
+        'parameters': checkpoint['parameters'],
+        'memory_mapped': False,
+        'embedding_dim': checkpoint['embedding_dim'],
+        'epoch': checkpoint.get('epoch'),
+        'val_loss': checkpoint.get('val_loss'),
+        'val_accuracy': val_accuracy,
+        'personalized': users is not None,
+        'num_users': users.num_users if users is not None else 0,
+        'candidates': None,
+        'loaded_at': time.time(),
+    }
+    return OnnxModelBundle(session, vocabulary, info, users)
@@ -0,0 +1,88 @@
+"""
+Diversity-aware re-ranking of predictions (maximal marginal relevance).
+
+The model's top-k often clusters in one aisle. MMR takes the top-M
+candidates and picks results greedily, trading each candidate's relevance
+against its similarity to what has already been picked:
+    
+    score(i) = (1 - diversity) * relevance(i) - diversity * max_j sim(i, j)
+
+Relevance is the candidate's probability relative to the best one.
+sim is the cosine similarity between item vectors (rows of
+item_embeddings or fc_out.weight), plus optional penalties for sharing an
+aisle or department. MMR only ever needs the similarities to the k items
+it picks, so each pick costs one matrix-vector product over the gathered
+candidate rows (k x M x d instead of the full M x M matrix), and the
+catalog's vectors are never copied.
+"""
+
+from typing import NamedTuple, Tuple
+
+import numpy as np
+
+from vocab_store import CompactVocabulary
+
+
+SIMILARITY_SOURCES = ('item_embeddings', 'fc_out')
+
+
+class MMRConfig(NamedTuple):
+    diversity: float           # 0 = plain top-k, 1 = only dissimilarity counts
+    candidates: int = 200      # M: how many top items to re-rank
+    aisle_penalty: float = 0.1
+    department_penalty: float = 0.0
+
+
+class DiversityReranker:
+    """MMR re-ranking using one model's item vectors and one vocabulary's categories."""
+    
+    def __init__(self, vectors: np.ndarray, vocabulary: CompactVocabulary):
+        """
+        Args:
+            vectors: (num_items, dim) item vectors in item order, from the
+                bundle (see BaseBundle.item_vectors); not copied
+        """
+        self.vectors = vectors
+        self.norms = np.maximum(np.linalg.norm(self.vectors, axis=1), 1e-12)
+        self.aisle_codes = np.asarray(vocabulary.aisle_codes)
+        self.department_codes = np.asarray(vocabulary.department_codes)
+    
+    def rerank(self, items: np.ndarray, probs: np.ndarray, top_k: int,
+               config: MMRConfig) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        Pick top_k of the candidates (sorted by probability, best first) by MMR.
+        
+        Returns:
+            (items, probs) in MMR order, with the model's probabilities
+        """
+        count = min(top_k, len(items))
+        if count == 0 or config.diversity <= 0:
+            return items[:count], probs[:count]
+        
+        vectors = self.vectors[items] / self.norms[items][:, None]
+        aisles = self.aisle_codes[items]
+        departments = self.department_codes[items]
+        relevance = (1.0 - config.diversity) * (probs / max(float(probs[0]), 1e-12))
+        
+        # Highest similarity to anything picked so far
+        redundancy = np.full(len(items), -np.inf, dtype=np.float32)
+        available = np.ones(len(items), dtype=bool)
+        picked = np.empty(count, dtype=np.int64)
+        choice = 0  # nothing to be redundant with yet: the most relevant
+        for position in range(count):
+            picked[position] = choice
+            available[choice] = False
+            if position == count - 1:
+                break
+            
+            similarity = vectors @ vectors[choice]
+            if config.aisle_penalty and aisles[choice] >= 0:
+                similarity += config.aisle_penalty * (aisles == aisles[choice])
+            if config.department_penalty and departments[choice] >= 0:
+                similarity += config.department_penalty * (departments == departments[choice])
+            np.maximum(redundancy, similarity, out=redundancy)
+            
+            scores = relevance - config.diversity * redundancy
+            scores[~available] = -np.inf
+            choice = int(np.argmax(scores))
+        return items[picked], probs[picked]
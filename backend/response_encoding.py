@@ -0,0 +1,89 @@
+"""
+Pre-rendered JSON encoding for /predict responses.
+
+Building PredictionItem models and running them through FastAPI's
+generic encoder costs more than the forward pass for small models. The
+per-item parts of the response never change for a given vocabulary, so
+PredictionEncoder renders them once per item index at load time and a
+response is assembled by joining byte fragments around the formatted
+probabilities.
+
+The output is byte-identical to JSONResponse(PredictResponse(...)):
+same key order, compact separators, ensure_ascii=False and Python float
+repr.
+"""
+
+import json
+from typing import Dict, List, Optional
+
+import numpy as np
+
+from vocab_store import CompactVocabulary
+
+
+def _json_value(value: Optional[str]) -> str:
+    return json.dumps(value, ensure_ascii=False)
+
+
+RESPONSE_PREFIX = b'{"next_item_predictions":['
+RESPONSE_SUFFIX = b'],"co_purchase":[]}'
+
+# Probability given to every item in the popular-items fallback
+FALLBACK_PROBABILITY = 0.1
+
+
+class PredictionEncoder:
+    """Renders prediction lists for one vocabulary straight to JSON bytes."""
+    
+    def __init__(self, vocabulary: CompactVocabulary):
+        self.vocabulary = vocabulary
+        num_items = vocabulary.num_items
+        self.product_ids: List[str] = [str(int(item_id)) for item_id in vocabulary.item_ids]
+        
+        # Each item renders as head + prob + SCORE + prob + tail
+        self.heads: List[bytes] = []
+        self.tails: List[bytes] = []
+        for idx in range(num_items):
+            metadata = vocabulary.metadata(idx)
+            self.heads.append(
+                f'{{"product_id":{_json_value(self.product_ids[idx])},"probability":'.encode('utf-8')
+            )
+            self.tails.append((
+                f',"name":{_json_value(metadata["name"])}'
+                f',"aisle":{_json_value(metadata["aisle"])}'
+                f',"department":{_json_value(metadata["department"])}}}'
+            ).encode('utf-8'))
+        
+        self._fallback_cache: Dict[int, bytes] = {}
+    
+    def encode(self, items: np.ndarray, probs: np.ndarray) -> bytes:
+        """Render one prediction list (item indices and probabilities) as a full response body."""
+        heads, tails = self.heads, self.tails
+        parts = []
+        for idx, prob in zip(items.tolist(), probs.tolist()):
+            formatted = repr(prob).encode()
+            parts.append(heads[idx] + formatted + b',"score":' + formatted + tails[idx])
+        return RESPONSE_PREFIX + b','.join(parts) + RESPONSE_SUFFIX
+    
+    def encode_fallback(self, top_k: int, mask: Optional[np.ndarray] = None) -> bytes:
+        """
+        Popular-items fallback (first N items by index), without metadata as before.
+        
+        With an allowed-items mask, the first N allowed items (not cached).
+        """
+        if mask is not None:
+            return self._render_fallback(np.flatnonzero(mask[1:])[:top_k] + 1)
+        cached = self._fallback_cache.get(top_k)
+        if cached is None:
+            cached = self._render_fallback(range(1, min(top_k + 1, self.vocabulary.num_items)))
+            self._fallback_cache[top_k] = cached
+        return cached
+    
+    def _render_fallback(self, indices) -> bytes:
+        formatted = repr(FALLBACK_PROBABILITY)
+        parts = [
+            f'{{"product_id":{_json_value(self.product_ids[idx])},"probability":{formatted},'
+            f'"score":{formatted},"name":null,"aisle":null,"department":null}}'
+            for idx in indices
+        ]
+        return RESPONSE_PREFIX + ','.join(parts).encode('utf-8') + RESPONSE_SUFFIX
@@ -0,0 +1,709 @@
+"""
+Latency and throughput benchmark for the prediction API.
+
+Starts the API against a synthetic model and vocabulary (or existing
+artifacts), then measures:
+  
+  * cold start: process launch -> healthy, and the first /predict
+  * /predict and /products latency (p50/p95/p99) and throughput at
+    several concurrency levels, with a configurable cart-size distribution
+  * JSON vs binary /predict (binary_protocol.py): bytes on the wire and
+    decode cost per message, for several carts per binary message
+  * interactive sessions: per-delta latency on /ws/predict vs a /predict
+    call per cart change (new connection, and keep-alive)
+  * in-process NextItemPredictor.predict_top_k latency across batch sizes
+  * two-stage scoring (candidates.py): latency and recall@top_k against
+    full scoring for several candidate counts
+  * model types (mlp vs gru) in-process: training examples/s, single-cart
+    serving latency, and the cost of one appended item with incremental
+    encoder state; with --qr-buckets, also dense vs compressed
+    (quotient-remainder) item tables, with parameter counts and the peak
+    RSS of a fresh process serving each model
+
+Results are written as JSON so runs can be diffed in review.
+
+Usage:
+    python scripts/benchmark_api.py --output benchmark.json
+    python scripts/benchmark_api.py --concurrency 1,8,32 --cart-sizes geometric:4 --workers 4
+    python scripts/benchmark_api.py --artifacts-dir ./models --skip-micro
+    python scripts/benchmark_api.py --skip-http --cold-start-runs 0 --model-type gru
+"""
+
+import sys
+import os
+BACKEND_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.append(BACKEND_DIR)
+
+import argparse
+import http.client
+import json
+import multiprocessing
+import platform
+import socket
+import subprocess
+import tempfile
+import threading
+import time
+
+import numpy as np
+
+import binary_protocol
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def summarize(latencies_s, elapsed_s=None, errors=0):
+    """Percentiles in milliseconds plus throughput."""
+    latencies_ms = np.asarray(latencies_s) * 1000
+    result = {
+        'requests': int(len(latencies_ms)),
+        'errors': errors,
+        'mean_ms': float(latencies_ms.mean()) if len(latencies_ms) else None,
+    }
+    for p in (50, 95, 99):
+        result[f'p{p}_ms'] = float(np.percentile(latencies_ms, p)) if len(latencies_ms) else None
+    if elapsed_s:
+        result['throughput_rps'] = len(latencies_ms) / elapsed_s
+    return result
+
+
+def cart_size_sampler(spec: str, rng: np.random.Generator):
+    """
+    Parse a cart-size distribution:
+        fixed:N          always N items
+        uniform:A-B      uniform between A and B items (inclusive)
+        geometric:MEAN   geometric with the given mean (many short carts, long tail)
+    """
+    kind, _, value = spec.partition(':')
+    if kind == 'fixed':
+        size = int(value)
+        return lambda: size
+    if kind == 'uniform':
+        low, high = (int(v) for v in value.split('-'))
+        return lambda: int(rng.integers(low, high + 1))
+    if kind == 'geometric':
+        p = 1.0 / float(value)
+        return lambda: int(rng.geometric(p))
+    raise ValueError(f"Unknown cart size distribution: {spec}")
+
+
+class Server:
+    """API server subprocess bound to a free local port."""
+    
+    def __init__(self, artifacts_dir, workers=1, env=None):
+        self.port = free_port()
+        self.artifacts_dir = artifacts_dir
+        self.workers = workers
+        self.env = env or {}
+        self.process = None
+    
+    def start(self):
+        env = dict(os.environ, **self.env)
+        env['MODEL_PATH'] = os.path.join(self.artifacts_dir, 'best_model.pt')
+        env['VOCAB_PATH'] = os.path.join(self.artifacts_dir, 'vocabulary.pkl')
+        env['PRODUCTS_PATH'] = os.path.join(self.artifacts_dir, 'all_products.json')
+        if self.workers > 1:
+            command = [sys.executable, 'serve.py', '--host', '127.0.0.1', '--port', str(self.port),
+                       '--workers', str(self.workers), '--log-level', 'warning']
+        else:
+            command = [sys.executable, '-m', 'uvicorn', 'api:app', '--host', '127.0.0.1',
+                       '--port', str(self.port), '--log-level', 'warning', '--no-access-log']
+        self.process = subprocess.Popen(command, cwd=BACKEND_DIR, env=env,
+                                        stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        return self
+    
+    def wait_healthy(self, timeout=120):
+        deadline = time.time() + timeout
+        while time.time() < deadline:
+            if self.process.poll() is not None:
+                raise RuntimeError(f"server exited with code {self.process.returncode}")
+            try:
+                status, body = request(self.port, 'GET', '/health')
+                if status == 200 and json.loads(body)['model_loaded']:
+                    return
+            except OSError:
+                pass
+            time.sleep(0.01)
+        raise RuntimeError("server did not become healthy")
+    
+    def stop(self):
+        if self.process and self.process.poll() is None:
+            self.process.terminate()
+            self.process.wait(timeout=30)
+
+
+def request(port, method, path, body=None, connection=None, headers=None):
+    """One HTTP request; reuses `connection` when given (keep-alive)."""
+    conn = connection or http.client.HTTPConnection('127.0.0.1', port, timeout=30)
+    try:
+        conn.request(method, path, body=body, headers=headers or {})
+        response = conn.getresponse()
+        return response.status, response.read()
+    finally:
+        if connection is None:
+            conn.close()
+
+
+def run_load(port, make_request, total_requests, concurrency):
+    """
+    Drive `total_requests` requests from `concurrency` threads, each with its
+    own keep-alive connection. make_request(rng) -> (method, path, body, headers).
+    """
+    latencies = []
+    errors = [0]
+    remaining = [total_requests]
+    lock = threading.Lock()
+    
+    def worker(seed):
+        rng = np.random.default_rng(seed)
+        connection = http.client.HTTPConnection('127.0.0.1', port, timeout=30)
+        local = []
+        while True:
+            with lock:
+                if remaining[0] <= 0:
+                    break
+                remaining[0] -= 1
+            method, path, body, headers = make_request(rng)
+            start = time.perf_counter()
+            try:
+                status, _ = request(port, method, path, body, connection, headers)
+                ok = status == 200
+            except (OSError, http.client.HTTPException):
+                connection.close()
+                connection = http.client.HTTPConnection('127.0.0.1', port, timeout=30)
+                ok = False
+            if ok:
+                local.append(time.perf_counter() - start)
+            else:
+                with lock:
+                    errors[0] += 1
+        connection.close()
+        with lock:
+            latencies.extend(local)
+    
+    threads = [threading.Thread(target=worker, args=(seed,)) for seed in range(concurrency)]
+    start = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - start
+    return summarize(latencies, elapsed, errors[0])
+
+
+def benchmark_cold_start(artifacts_dir, runs, product_ids):
+    """Time from process launch to healthy, and the first prediction after that."""
+    startup, first_predict = [], []
+    body = json.dumps({'cart': [{'product_id': str(p)} for p in product_ids[:3]], 'top_k': 10})
+    for _ in range(runs):
+        server = Server(artifacts_dir)
+        start = time.perf_counter()
+        server.start()
+        try:
+            server.wait_healthy()
+            startup.append(time.perf_counter() - start)
+            t0 = time.perf_counter()
+            request(server.port, 'POST', '/predict', body, headers={'Content-Type': 'application/json'})
+            first_predict.append(time.perf_counter() - t0)
+        finally:
+            server.stop()
+    return {'startup': summarize(startup), 'first_predict': summarize(first_predict)}
+
+
+def benchmark_http(artifacts_dir, args, product_ids, products):
+    sample_cart_size = cart_size_sampler(args.cart_sizes, np.random.default_rng(args.seed))
+    search_terms = sorted({p['name'].split()[0].lower() for p in products[:200] if p.get('name')}) or ['a']
+    
+    # A featured bundle that a fraction of clients submit verbatim (exercises coalescing)
+    hot_cart = np.random.default_rng(args.seed).choice(product_ids, size=5)
+    
+    def predict_request(rng):
+        if rng.random() < args.hot_cart_fraction:
+            cart = hot_cart
+        else:
+            cart = rng.choice(product_ids, size=sample_cart_size())
+        body = json.dumps({'cart': [{'product_id': str(p)} for p in cart], 'top_k': args.top_k})
+        return 'POST', '/predict', body, {'Content-Type': 'application/json'}
+    
+    def binary_request(rng):
+        carts = [rng.choice(product_ids, size=sample_cart_size()) for _ in range(args.binary_batch)]
+        body = binary_protocol.encode_request(carts, args.top_k)
+        return 'POST', '/predict', body, {'Content-Type': binary_protocol.CONTENT_TYPE}
+    
+    def products_request(rng):
+        term = search_terms[int(rng.integers(len(search_terms)))]
+        page = int(rng.integers(1, 4))
+        return 'GET', f'/products?search={term}&page={page}&page_size=50', None, {}
+    
+    results = {}
+    server = Server(artifacts_dir, workers=args.workers).start()
+    try:
+        server.wait_healthy()
+        endpoints = (('/predict', predict_request),
+                     (f'/predict binary x{args.binary_batch}', binary_request),
+                     ('/products', products_request))
+        for name, make_request in endpoints:
+            results[name] = {}
+            # Warm up connections and code paths before measuring
+            run_load(server.port, make_request, args.warmup_requests, max(args.concurrency))
+            for concurrency in args.concurrency:
+                result = run_load(server.port, make_request, args.requests, concurrency)
+                results[name][f'concurrency_{concurrency}'] = result
+                print(f"  {name:20s} c={concurrency:<3d} p50 {result['p50_ms']:7.2f} ms  "
+                      f"p95 {result['p95_ms']:7.2f} ms  p99 {result['p99_ms']:7.2f} ms  "
+                      f"{result['throughput_rps']:8.1f} req/s  errors {result['errors']}")
+        
+        status, body = request(server.port, 'GET', '/health')
+        results['coalescing'] = json.loads(body).get('coalescing')
+        print(f"  coalescing: {results['coalescing']}")
+        
+        print("\nJSON vs binary /predict")
+        results['protocols'] = benchmark_protocols(server.port, args, product_ids)
+        
+        print("\nInteractive sessions: /ws/predict vs /predict per cart change")
+        results['streaming'] = benchmark_streaming(server.port, args, product_ids)
+    finally:
+        server.stop()
+    return results
+
+
+def time_call(function, iterations):
+    """Median seconds per call."""
+    timings = []
+    for _ in range(iterations):
+        start = time.perf_counter()
+        function()
+        timings.append(time.perf_counter() - start)
+    return float(np.median(timings))
+
+
+def benchmark_protocols(port, args, product_ids):
+    """
+    Compare JSON and binary /predict for the same carts: request/response
+    bytes, client-side encode/decode time and server-side request decoding.
+    Sizes and times are per cart; a JSON request carries one cart.
+    """
+    from api import PredictRequest, parse_body_fast
+    
+    rng = np.random.default_rng(args.seed)
+    sample_cart_size = cart_size_sampler(args.cart_sizes, rng)
+    connection = http.client.HTTPConnection('127.0.0.1', port, timeout=30)
+    json_headers = {'Content-Type': 'application/json'}
+    binary_headers = {'Content-Type': binary_protocol.CONTENT_TYPE}
+    
+    results = {}
+    try:
+        for carts_per_message in args.binary_batch_sizes:
+            carts = [[int(p) for p in rng.choice(product_ids, size=sample_cart_size())]
+                     for _ in range(carts_per_message)]
+            
+            json_bodies = [json.dumps({'cart': [{'product_id': str(p)} for p in cart], 'top_k': args.top_k})
+                           for cart in carts]
+            json_responses = [request(port, 'POST', '/predict', body, connection, json_headers)[1]
+                              for body in json_bodies]
+            binary_body = binary_protocol.encode_request(carts, args.top_k)
+            status, binary_response = request(port, 'POST', '/predict', binary_body, connection, binary_headers)
+            if status != 200:
+                raise RuntimeError(f"binary /predict returned {status}")
+            
+            iterations = args.micro_iterations
+            result = {
+                'json': {
+                    'request_bytes': sum(map(len, json_bodies)) / carts_per_message,
+                    'response_bytes': sum(map(len, json_responses)) / carts_per_message,
+                    'client_encode_us': time_call(lambda: [json.dumps({'cart': [{'product_id': str(p)} for p in cart],
+                                                                       'top_k': args.top_k}) for cart in carts],
+                                                  iterations) * 1e6 / carts_per_message,
+                    'client_decode_us': time_call(lambda: [json.loads(r) for r in json_responses],
+                                                  iterations) * 1e6 / carts_per_message,
+                    'server_decode_us': time_call(lambda: [parse_body_fast(PredictRequest, b.encode(), 'application/json')
+                                                           for b in json_bodies],
+                                                  iterations) * 1e6 / carts_per_message,
+                },
+                'binary': {
+                    'request_bytes': len(binary_body) / carts_per_message,
+                    'response_bytes': len(binary_response) / carts_per_message,
+                    'client_encode_us': time_call(lambda: binary_protocol.encode_request(carts, args.top_k),
+                                                  iterations) * 1e6 / carts_per_message,
+                    'client_decode_us': time_call(lambda: binary_protocol.decode_response(binary_response),
+                                                  iterations) * 1e6 / carts_per_message,
+                    'server_decode_us': time_call(lambda: binary_protocol.decode_request(binary_body),
+                                                  iterations) * 1e6 / carts_per_message,
+                },
+            }
+            results[f'carts_per_message_{carts_per_message}'] = result
+            for name in ('json', 'binary'):
+                row = result[name]
+                print(f"  {name:6s} x{carts_per_message:<4d} per cart: request {row['request_bytes']:7.0f} B  "
+                      f"response {row['response_bytes']:7.0f} B  client encode {row['client_encode_us']:7.1f} us  "
+                      f"decode {row['client_decode_us']:7.1f} us  server decode {row['server_decode_us']:7.1f} us")
+    finally:
+        connection.close()
+    return results
+
+
+def benchmark_streaming(port, args, product_ids):
+    """
+    Simulate shopping sessions (items added one at a time, an occasional
+    removal) and time each cart update over /ws/predict and over /predict.
+    """
+    try:
+        from websockets.sync.client import connect
+    except ImportError:
+        print("  skipped: install websockets (uvicorn[standard]) to benchmark /ws/predict")
+        return None
+    
+    rng = np.random.default_rng(args.seed)
+    sessions = []
+    for _ in range(args.sessions):
+        cart, deltas = [], []
+        for _ in range(args.session_length):
+            if cart and rng.random() < 0.2:
+                product_id = cart.pop(int(rng.integers(len(cart))))
+                deltas.append(({'type': 'remove', 'product_id': product_id}, list(cart)))
+            else:
+                product_id = str(rng.choice(product_ids))
+                cart.append(product_id)
+                deltas.append(({'type': 'add', 'product_id': product_id, 'top_k': args.top_k}, list(cart)))
+        sessions.append(deltas)
+    
+    def predict_body(cart):
+        return json.dumps({'cart': [{'product_id': p} for p in cart], 'top_k': args.top_k})
+    
+    headers = {'Content-Type': 'application/json'}
+    timings = {'websocket': [], 'http_keep_alive': [], 'http_new_connection': []}
+    for deltas in sessions:
+        with connect(f'ws://127.0.0.1:{port}/ws/predict') as websocket:
+            for delta, _ in deltas:
+                start = time.perf_counter()
+                websocket.send(json.dumps(delta))
+                websocket.recv()
+                timings['websocket'].append(time.perf_counter() - start)
+        
+        connection = http.client.HTTPConnection('127.0.0.1', port, timeout=30)
+        for _, cart in deltas:
+            start = time.perf_counter()
+            request(port, 'POST', '/predict', predict_body(cart), connection, headers)
+            timings['http_keep_alive'].append(time.perf_counter() - start)
+        connection.close()
+        
+        for _, cart in deltas:
+            start = time.perf_counter()
+            request(port, 'POST', '/predict', predict_body(cart), headers=headers)
+            timings['http_new_connection'].append(time.perf_counter() - start)
+    
+    results = {}
+    for name, values in timings.items():
+        results[name] = summarize(values)
+        print(f"  {name:20s} p50 {results[name]['p50_ms']:7.2f} ms  p95 {results[name]['p95_ms']:7.2f} ms  "
+              f"p99 {results[name]['p99_ms']:7.2f} ms")
+    return results
+
+
+def benchmark_predict_top_k(artifacts_dir, args):
+    """In-process predict_top_k latency per batch size."""
+    import torch
+    from inference import load_bundle
+    
+    torch.set_num_threads(args.torch_threads)
+    bundle = load_bundle(os.path.join(artifacts_dir, 'best_model.pt'),
+                         os.path.join(artifacts_dir, 'vocabulary.pkl'), device_name='cpu')
+    rng = np.random.default_rng(args.seed)
+    sample_cart_size = cart_size_sampler(args.cart_sizes, rng)
+    
+    results = {}
+    for batch_size in args.batch_sizes:
+        carts = [rng.integers(1, bundle.vocabulary.num_items, size=min(sample_cart_size(), bundle.max_cart_size))
+                 for _ in range(batch_size)]
+        cart_tensor = torch.from_numpy(bundle.pad_carts(carts))
+        for _ in range(3):
+            bundle.model.predict_top_k(cart_tensor, k=args.top_k)
+        timings = []
+        for _ in range(args.micro_iterations):
+            start = time.perf_counter()
+            bundle.model.predict_top_k(cart_tensor, k=args.top_k)
+            timings.append(time.perf_counter() - start)
+        result = summarize(timings)
+        result['carts_per_second'] = batch_size / float(np.median(timings))
+        results[f'batch_{batch_size}'] = result
+        print(f"  batch {batch_size:<5d} p50 {result['p50_ms']:8.3f} ms  "
+              f"p99 {result['p99_ms']:8.3f} ms  {result['carts_per_second']:10.0f} carts/s")
+    return results
+
+
+def benchmark_cascade(artifacts_dir, args):
+    """Single-cart latency and recall@top_k of two-stage scoring vs scoring every item."""
+    import torch
+    from candidates import CandidateConfig, CandidateGenerator, load_neighbors
+    from inference import load_bundle
+    
+    torch.set_num_threads(args.torch_threads)
+    bundle = load_bundle(os.path.join(artifacts_dir, 'best_model.pt'),
+                         os.path.join(artifacts_dir, 'vocabulary.pkl'), device_name='cpu')
+    neighbors = None
+    if args.candidate_source == 'copurchase':
+        neighbors = load_neighbors(args.copurchase_neighbors, bundle.vocabulary)
+    rng = np.random.default_rng(args.seed)
+    sample_cart_size = cart_size_sampler(args.cart_sizes, rng)
+    carts = [bundle.pad_carts([rng.integers(1, bundle.vocabulary.num_items,
+                                            size=min(sample_cart_size(), bundle.max_cart_size))])
+             for _ in range(args.micro_iterations)]
+    
+    def measure():
+        for padded in carts[:3]:
+            bundle.predict(padded, args.top_k)
+        timings, top_items = [], []
+        for padded in carts:
+            start = time.perf_counter()
+            items, _ = bundle.predict(padded, args.top_k)
+            timings.append(time.perf_counter() - start)
+            top_items.append(items[0])
+        return summarize(timings), top_items
+    
+    bundle.candidates = None
+    full, exact = measure()
+    results = {'full': full}
+    print(f"  full scoring      p50 {full['p50_ms']:7.3f} ms")
+    for count in args.candidate_counts:
+        config = CandidateConfig(count, args.candidate_source, args.copurchase_neighbors)
+        bundle.candidates = CandidateGenerator(bundle.model, config, neighbors)
+        result, approximate = measure()
+        result['recall'] = float(np.mean([
+            len(np.intersect1d(a, b)) / len(a) for a, b in zip(exact, approximate)
+        ]))
+        results[f'{args.candidate_source}_{count}'] = result
+        print(f"  {count:5d} candidates  p50 {result['p50_ms']:7.3f} ms  recall@{args.top_k} {result['recall']:.3f}")
+    return results
+
+
+def serving_peak_rss_mb(model_type, num_items, embedding_dim, hidden_dim, qr_buckets, top_k):
+    """
+    Peak RSS of this (fresh) process after building a model and serving a
+    few carts; with model_type None, after importing torch only.
+    """
+    import resource
+    import torch
+    
+    if model_type is not None:
+        from model import build_model
+        model = build_model(model_type, num_items, embedding_dim, hidden_dim, qr_buckets=qr_buckets).eval()
+        with torch.no_grad():
+            for batch_size in (1, 8):
+                model.predict_top_k(torch.randint(1, num_items, (batch_size, 10)), k=top_k)
+    if os.path.exists('/proc/self/status'):
+        # ru_maxrss would include the parent's peak, inherited through fork before exec
+        with open('/proc/self/status') as f:
+            peak_kb = next(int(line.split()[1]) for line in f if line.startswith('VmHWM:'))
+        return peak_kb / 2**10
+    # Bytes on macOS
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 2**20
+
+
+def benchmark_model_types(num_items, args):
+    """
+    Training throughput, serving latency and memory of each model type
+    (and item-table compression), same sizes and carts.
+    """
+    import torch
+    import torch.nn as nn
+    from inference import MAX_CART_SIZE
+    from model import build_model
+    
+    torch.set_num_threads(args.torch_threads)
+    rng = np.random.default_rng(args.seed)
+    sample_cart_size = cart_size_sampler(args.cart_sizes, rng)
+    
+    def padded_batch(batch_size):
+        carts = np.zeros((batch_size, MAX_CART_SIZE), dtype=np.int64)
+        for row in range(batch_size):
+            size = min(sample_cart_size(), MAX_CART_SIZE)
+            carts[row, :size] = rng.integers(1, num_items, size=size)
+        return torch.from_numpy(carts)
+    
+    train_carts = padded_batch(args.train_batch_size)
+    train_targets = torch.from_numpy(rng.integers(1, num_items, size=args.train_batch_size))
+    serve_carts = [padded_batch(1) for _ in range(args.micro_iterations)]
+    
+    # Each measurement gets a new process, so peaks don't carry over
+    spawn = multiprocessing.get_context('spawn')
+    with spawn.Pool(1, maxtasksperchild=1) as pool:
+        import_rss_mb = pool.apply(serving_peak_rss_mb, (None, num_items, 0, 0, 0, 0))
+    
+    results = {}
+    configs = [(model_type, qr_buckets) for model_type in args.model_types for qr_buckets in args.qr_buckets]
+    for model_type, qr_buckets in configs:
+        name = model_type if not qr_buckets else f"{model_type}_qr{qr_buckets}"
+        torch.manual_seed(args.seed)
+        model = build_model(model_type, num_items, args.embedding_dim, args.hidden_dim, qr_buckets=qr_buckets)
+        optimizer = torch.optim.Adam(model.parameters(), lr=1e-3)
+        criterion = nn.CrossEntropyLoss()
+        
+        def train_step():
+            optimizer.zero_grad()
+            criterion(model(train_carts), train_targets).backward()
+            optimizer.step()
+        
+        model.train()
+        for _ in range(2):
+            train_step()
+        train_seconds = time_call(train_step, args.train_iterations)
+        
+        model.eval()
+        with torch.no_grad():
+            for cart in serve_carts[:3]:
+                model.predict_top_k(cart, k=args.top_k)
+            timings = []
+            for cart in serve_carts:
+                start = time.perf_counter()
+                model.predict_top_k(cart, k=args.top_k)
+                timings.append(time.perf_counter() - start)
+        with spawn.Pool(1, maxtasksperchild=1) as pool:
+            rss_mb = pool.apply(serving_peak_rss_mb, (model_type, num_items, args.embedding_dim,
+                                                      args.hidden_dim, qr_buckets, args.top_k))
+        result = {
+            'parameters': sum(p.numel() for p in model.parameters()),
+            'qr_buckets': qr_buckets,
+            'train_examples_per_second': args.train_batch_size / train_seconds,
+            'predict': summarize(timings),
+            'serving_peak_rss_mb': rss_mb,
+            'serving_rss_over_torch_mb': rss_mb - import_rss_mb,
+        }
+        line = (f"  {name:<10s} {result['parameters'] / 1e6:7.2f}M params  "
+                f"RSS +{result['serving_rss_over_torch_mb']:7.1f} MB  "
+                f"train {result['train_examples_per_second']:9.0f} ex/s  "
+                f"predict p50 {result['predict']['p50_ms']:7.3f} ms")
+        
+        if hasattr(model, 'extend'):
+            # Shopping session: each prediction follows one appended item
+            timings = []
+            with torch.no_grad():
+                vector = model.cart_vector(serve_carts[0][:, :1])
+                for position in range(1, MAX_CART_SIZE):
+                    new_item = torch.from_numpy(rng.integers(1, num_items, size=(1, 1)))
+                    start = time.perf_counter()
+                    vector = model.extend(vector, new_item, position)
+                    model.top_k(model.score(vector), args.top_k)
+                    timings.append(time.perf_counter() - start)
+            result['predict_after_append'] = summarize(timings)
+            line += f"  after append p50 {result['predict_after_append']['p50_ms']:7.3f} ms"
+        results[name] = result
+        print(line)
+    return results
+
+
+def int_list(value):
+    return [int(v) for v in value.split(',') if v]
+
+
+def str_list(value):
+    return [v for v in value.split(',') if v]
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the prediction API")
+    parser.add_argument("--output", type=str, default="benchmark_results.json", help="JSON results file")
+    parser.add_argument("--artifacts-dir", type=str, default=None,
+                        help="Directory with best_model.pt, vocabulary.pkl and all_products.json "
+                             "(default: generate a synthetic model)")
+    parser.add_argument("--num-items", type=int, default=1094, help="Synthetic catalog size")
+    parser.add_argument("--embedding-dim", type=int, default=512, help="Synthetic embedding dimension")
+    parser.add_argument("--hidden-dim", type=int, default=1024, help="Synthetic hidden dimension")
+    parser.add_argument("--model-type", type=str, default="mlp", help="Synthetic model type served over HTTP")
+    parser.add_argument("--concurrency", type=int_list, default=[1, 8, 32], help="Comma-separated concurrency levels")
+    parser.add_argument("--requests", type=int, default=1000, help="Requests per concurrency level")
+    parser.add_argument("--warmup-requests", type=int, default=100, help="Unmeasured warm-up requests per endpoint")
+    parser.add_argument("--cart-sizes", type=str, default="uniform:1-20",
+                        help="Cart size distribution: fixed:N, uniform:A-B or geometric:MEAN")
+    parser.add_argument("--top-k", type=int, default=10, help="top_k for /predict")
+    parser.add_argument("--hot-cart-fraction", type=float, default=0.0,
+                        help="Fraction of /predict requests sending the same featured cart")
+    parser.add_argument("--binary-batch", type=int, default=8, help="Carts per binary /predict message in the load test")
+    parser.add_argument("--binary-batch-sizes", type=int_list, default=[1, 8, 32],
+                        help="Carts per binary message for the JSON vs binary comparison")
+    parser.add_argument("--sessions", type=int, default=20, help="Simulated sessions for the streaming benchmark")
+    parser.add_argument("--session-length", type=int, default=25, help="Cart changes per simulated session")
+    parser.add_argument("--workers", type=int, default=1, help="Server workers (>1 uses serve.py)")
+    parser.add_argument("--cold-start-runs", type=int, default=3, help="Cold starts to measure (0 = skip)")
+    parser.add_argument("--batch-sizes", type=int_list, default=[1, 8, 32, 128, 512],
+                        help="Batch sizes for the predict_top_k micro-benchmark")
+    parser.add_argument("--micro-iterations", type=int, default=50, help="Timed iterations per batch size")
+    parser.add_argument("--torch-threads", type=int, default=1, help="torch threads for the micro-benchmark")
+    parser.add_argument("--skip-http", action="store_true", help="Skip the HTTP load test")
+    parser.add_argument("--skip-micro", action="store_true", help="Skip the predict_top_k micro-benchmark")
+    parser.add_argument("--candidate-counts", type=int_list, default=[100, 200, 500, 1000],
+                        help="Candidate counts for the two-stage scoring benchmark (empty = skip)")
+    parser.add_argument("--candidate-source", type=str, default="embedding", help="embedding or copurchase")
+    parser.add_argument("--copurchase-neighbors", type=str, default=None,
+                        help="Neighbor table for --candidate-source copurchase")
+    parser.add_argument("--model-types", type=str_list, default=["mlp", "gru"],
+                        help="Model types to compare in-process (empty = skip)")
+    parser.add_argument("--qr-buckets", type=int_list, default=[0],
+                        help="Item-table variants for the model-type comparison (0 = dense, N = QR with N buckets)")
+    parser.add_argument("--train-batch-size", type=int, default=1024, help="Batch size for training throughput")
+    parser.add_argument("--train-iterations", type=int, default=10, help="Timed training steps per model type")
+    parser.add_argument("--seed", type=int, default=0, help="Random seed")
+    args = parser.parse_args()
+    
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        artifacts_dir = args.artifacts_dir
+        if artifacts_dir is None:
+            artifacts_dir = tmp_dir
+            subprocess.check_call([
+                sys.executable, os.path.join(BACKEND_DIR, 'scripts', 'make_synthetic_model.py'),
+                '--output-dir', artifacts_dir, '--num-items', str(args.num_items),
+                '--embedding-dim', str(args.embedding_dim), '--hidden-dim', str(args.hidden_dim),
+                '--model-type', args.model_type, '--seed', str(args.seed)
+            ])
+        artifacts_dir = os.path.abspath(artifacts_dir)
+        
+        with open(os.path.join(artifacts_dir, 'all_products.json')) as f:
+            products = json.load(f)
+        product_ids = np.array([p['id'] for p in products])
+        
+        import torch
+        results = {
+            'config': vars(args),
+            'environment': {
+                'python': platform.python_version(),
+                'torch': torch.__version__,
+                'numpy': np.__version__,
+                'platform': platform.platform(),
+                'cpu_count': os.cpu_count(),
+            },
+        }
+        
+        if args.cold_start_runs:
+            print("\nCold start")
+            results['cold_start'] = benchmark_cold_start(artifacts_dir, args.cold_start_runs, product_ids)
+            startup = results['cold_start']['startup']
+            print(f"  startup p50 {startup['p50_ms']:.0f} ms, first /predict "
+                  f"{results['cold_start']['first_predict']['p50_ms']:.2f} ms")
+        
+        if not args.skip_http:
+            print("\nHTTP load")
+            results['http'] = benchmark_http(artifacts_dir, args, product_ids, products)
+        
+        if not args.skip_micro:
+            print("\nNextItemPredictor.predict_top_k")
+            results['predict_top_k'] = benchmark_predict_top_k(artifacts_dir, args)
+        
+        if args.candidate_counts:
+            print(f"\nTwo-stage scoring ({args.candidate_source} candidates)")
+            results['cascade'] = benchmark_cascade(artifacts_dir, args)
+        
+        if args.model_types:
+            print("\nModel types")
+            num_items = len(product_ids) + 1
+            results['model_types'] = benchmark_model_types(num_items, args)
+    
+    with open(args.output, 'w') as f:
+        json.dump(results, f, indent=2)
+    print(f"\nResults written to {args.output}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,104 @@
+"""
+Build the co-purchase neighbor table for two-stage scoring (candidates.py).
+
+For every item, lists the items most often added next to a cart holding
+it, counted over the training examples cached by train_instacart.py.
+Only the training split is counted (the first 80% of examples, or with
+--personalized each user's earlier examples, as train_instacart.py
+splits them), so validation targets don't leak into the candidates that
+recall is measured against.
+The table is stored with the item IDs it was built for, so the API can
+refuse it if the vocabulary changes.
+
+Usage:
+    python scripts/build_copurchase_neighbors.py
+    python scripts/build_copurchase_neighbors.py --neighbors 100 --output ./models/copurchase_neighbors.npz
+    python scripts/build_copurchase_neighbors.py --personalized   # for models trained with --personalized
+"""
+
+import sys
+import os
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import argparse
+import time
+
+import numpy as np
+
+from train_instacart import train_val_split
+
+
+def count_pairs(carts, next_items, num_items, chunk_size=1_000_000):
+    """
+    Count (cart item, next item) pairs.
+    
+    Returns:
+        (codes, counts): unique pair codes cart_item * num_items + next_item
+        and how often each occurred
+    """
+    codes = np.empty(0, dtype=np.int64)
+    counts = np.empty(0, dtype=np.int64)
+    for start in range(0, len(carts), chunk_size):
+        chunk = carts[start:start + chunk_size]
+        present = chunk > 0
+        pairs = (chunk[present].astype(np.int64) * num_items
+                 + np.repeat(next_items[start:start + chunk_size].astype(np.int64), present.sum(axis=1)))
+        chunk_codes, chunk_counts = np.unique(pairs, return_counts=True)
+        # Merge with the running totals
+        codes, inverse = np.unique(np.concatenate([codes, chunk_codes]), return_inverse=True)
+        counts = np.bincount(inverse, weights=np.concatenate([counts, chunk_counts]),
+                             minlength=len(codes)).astype(np.int64)
+    return codes, counts
+
+
+def top_neighbors(codes, counts, num_items, num_neighbors):
+    """(num_items, num_neighbors) table of each item's most frequent next items, 0-padded."""
+    sources, targets = codes // num_items, codes % num_items
+    # Repeat purchases put the next item in its own cart; an item is never its own candidate
+    distinct = sources != targets
+    sources, targets, counts = sources[distinct], targets[distinct], counts[distinct]
+    # Group by source item, most frequent first (ties: lower index first)
+    order = np.lexsort((targets, -counts, sources))
+    sources, targets = sources[order], targets[order]
+    rank = np.arange(len(sources)) - np.searchsorted(sources, sources)
+    keep = rank < num_neighbors
+    table = np.zeros((num_items, num_neighbors), dtype=np.int32)
+    table[sources[keep], rank[keep]] = targets[keep]
+    return table
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Build co-purchase neighbors for candidate generation")
+    parser.add_argument("--examples-cache", type=str, default="./models/examples_cache.npz",
+                        help="Examples cache written by train_instacart.py")
+    parser.add_argument("--neighbors", type=int, default=50, help="Neighbors kept per item")
+    parser.add_argument("--personalized", action="store_true",
+                        help="Count each user's earlier examples, matching train_instacart.py --personalized")
+    parser.add_argument("--output", type=str, default="./models/copurchase_neighbors.npz", help="Output file")
+    args = parser.parse_args()
+    
+    start = time.perf_counter()
+    data = np.load(args.examples_cache)
+    if 'target_offsets' in data.files:
+        raise SystemExit(f"{args.examples_cache} holds basket examples; use the next-item examples cache")
+    item_ids = data['item_ids']
+    num_items = len(item_ids) + 1
+    carts, next_items = data['carts'], data['next_items']
+    train_idx, _ = train_val_split(data['user_ids'], args.personalized)
+    carts, next_items = carts[train_idx], next_items[train_idx]
+    print(f"Counting pairs over {len(carts):,} training examples and {num_items - 1:,} items...")
+    
+    codes, counts = count_pairs(carts, next_items, num_items)
+    table = top_neighbors(codes, counts, num_items, args.neighbors)
+    filled = (table > 0).sum(axis=1)
+    
+    tmp_path = args.output + '.tmp'
+    with open(tmp_path, 'wb') as f:
+        np.savez(f, neighbors=table, item_ids=item_ids)
+    os.replace(tmp_path, args.output)
+    print(f"Wrote {args.output}: {len(codes):,} distinct pairs, "
+          f"median {int(np.median(filled[1:]))} neighbors per item ({time.perf_counter() - start:.1f}s)")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,171 @@
+"""
+Check that serve.py workers share model memory instead of copying it.
+
+Starts serve.py with 1 and N workers against a large synthetic model,
+sends prediction traffic, then sums PSS (proportional set size) over the
+master and all workers. With copy-on-write sharing the total grows by the
+per-worker runtime overhead only, not by the model size per worker.
+Exits non-zero if the per-worker growth exceeds --max-growth-fraction of
+the checkpoint size.
+
+--reload also makes every worker hot-swap the model (through the file
+watcher) before measuring. Workers reload independently, so a reloaded
+.pt checkpoint is a private copy in each of them, while a memory-mapped
+.safetensors one stays shared through the page cache.
+
+Linux only (reads /proc/<pid>/smaps_rollup). tests/test_shared_memory.py
+runs the same measurement with 2 workers under pytest.
+
+Usage:
+    python scripts/check_shared_memory.py --workers 4
+    python scripts/check_shared_memory.py --workers 4 --format pt --reload
+"""
+
+import sys
+import os
+BACKEND_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.append(BACKEND_DIR)
+
+import argparse
+import json
+import socket
+import subprocess
+import tempfile
+import threading
+import time
+import urllib.request
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def memory_kb(pid):
+    """(PSS, private) in KB for a process."""
+    values = {}
+    with open(f'/proc/{pid}/smaps_rollup') as f:
+        for line in f:
+            parts = line.split()
+            if len(parts) >= 2 and parts[1].isdigit():
+                values[parts[0].rstrip(':')] = int(parts[1])
+    return values.get('Pss', 0), values.get('Private_Clean', 0) + values.get('Private_Dirty', 0)
+
+
+def child_pids(pid):
+    with open(f'/proc/{pid}/task/{pid}/children') as f:
+        return [int(p) for p in f.read().split()]
+
+
+def wait_healthy(port, timeout=120):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        try:
+            with urllib.request.urlopen(f'http://127.0.0.1:{port}/health', timeout=1) as response:
+                if json.load(response)['model_loaded']:
+                    return
+        except OSError:
+            pass
+        time.sleep(0.2)
+    raise RuntimeError("server did not become healthy")
+
+
+def send_traffic(port, num_requests, product_ids):
+    body = json.dumps({'cart': [{'product_id': str(p)} for p in product_ids], 'top_k': 10}).encode()
+    for _ in range(num_requests):
+        request = urllib.request.Request(
+            f'http://127.0.0.1:{port}/predict', data=body, headers={'Content-Type': 'application/json'}
+        )
+        with urllib.request.urlopen(request, timeout=10) as response:
+            response.read()
+
+
+def count_swaps(stream, swaps):
+    """Echo server output, collecting the lines that report a hot-swapped model."""
+    for line in stream:
+        print(line, end='')
+        # Workers share the pipe, so their lines can run together
+        swaps.extend([line] * line.count('Swapped in model'))
+
+
+def measure(workers, model_path, artifacts_dir, requests_per_worker, reload=False):
+    """Start serve.py, warm every worker with traffic, return memory stats."""
+    port = free_port()
+    env = dict(os.environ, MODEL_WATCH_INTERVAL='0.5') if reload else None
+    process = subprocess.Popen(
+        [sys.executable, os.path.join(BACKEND_DIR, 'serve.py'),
+         '--host', '127.0.0.1', '--port', str(port), '--workers', str(workers),
+         '--model-path', model_path,
+         '--vocab-path', os.path.join(artifacts_dir, 'vocabulary'),
+         '--log-level', 'warning'],
+        cwd=BACKEND_DIR, env=env, stdout=subprocess.PIPE, text=True
+    )
+    swaps = []
+    threading.Thread(target=count_swaps, args=(process.stdout, swaps), daemon=True).start()
+    try:
+        wait_healthy(port)
+        with open(os.path.join(artifacts_dir, 'all_products.json')) as f:
+            product_ids = [p['id'] for p in json.load(f)[:5]]
+        send_traffic(port, requests_per_worker * workers, product_ids)
+        if reload:
+            # Every worker's watcher sees the new mtime and loads the model again
+            os.utime(model_path)
+            deadline = time.time() + 300
+            while len(swaps) < workers:
+                if time.time() > deadline:
+                    raise RuntimeError("workers did not reload the model")
+                time.sleep(0.2)
+            send_traffic(port, requests_per_worker * workers, product_ids)
+        
+        pids = [process.pid] + child_pids(process.pid)
+        stats = [memory_kb(pid) for pid in pids]
+        return {
+            'workers': workers,
+            'total_pss_mb': sum(pss for pss, _ in stats) / 1024,
+            'worker_private_mb': [private / 1024 for _, private in stats[1:]],
+        }
+    finally:
+        process.terminate()
+        process.wait(timeout=30)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Verify serve.py workers share model memory")
+    parser.add_argument("--workers", type=int, default=4, help="Worker count to compare against 1 worker")
+    parser.add_argument("--num-items", type=int, default=50000, help="Synthetic catalog size")
+    parser.add_argument("--requests-per-worker", type=int, default=50, help="Warm-up requests per worker")
+    parser.add_argument("--max-growth-fraction", type=float, default=0.25,
+                        help="Allowed PSS growth per extra worker, as a fraction of the checkpoint size")
+    parser.add_argument("--format", choices=['safetensors', 'pt'], default='safetensors',
+                        help="Checkpoint file to serve: memory-mapped .safetensors or pickled .pt")
+    parser.add_argument("--reload", action='store_true', help="Measure after every worker hot-swaps the model")
+    args = parser.parse_args()
+    
+    with tempfile.TemporaryDirectory() as artifacts_dir:
+        subprocess.check_call([
+            sys.executable, os.path.join(BACKEND_DIR, 'scripts', 'make_synthetic_model.py'),
+            '--output-dir', artifacts_dir, '--num-items', str(args.num_items)
+        ])
+        model_path = os.path.join(artifacts_dir, f'best_model.{args.format}')
+        model_mb = os.path.getsize(model_path) / 2**20
+        
+        single = measure(1, model_path, artifacts_dir, args.requests_per_worker, args.reload)
+        multi = measure(args.workers, model_path, artifacts_dir, args.requests_per_worker, args.reload)
+    
+    growth_per_worker = (multi['total_pss_mb'] - single['total_pss_mb']) / (args.workers - 1)
+    print(f"\nCheckpoint size:              {model_mb:8.1f} MB")
+    for result in (single, multi):
+        private = ', '.join(f'{mb:.0f}' for mb in result['worker_private_mb'])
+        print(f"{result['workers']} worker(s): total PSS {result['total_pss_mb']:8.1f} MB  (private per worker: {private} MB)")
+    print(f"PSS growth per extra worker:  {growth_per_worker:8.1f} MB")
+    
+    limit = args.max_growth_fraction * model_mb
+    if growth_per_worker > limit:
+        print(f"FAIL: each worker adds more than {limit:.1f} MB; weights are being duplicated")
+        sys.exit(1)
+    print("OK: model weights are shared across workers")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,174 @@
+"""
+Compress a trained model's output layer (fc_out) to low rank.
+
+fc_out is hidden_dim x num_items and dominates both scoring cost and
+checkpoint size. For each rank r this replaces it with its truncated SVD
+(model.LowRankOutput), optionally fine-tunes the whole model for a few
+steps on the training split, and reports parameters, predict_top_k
+latency and top-k accuracy on the validation split next to the original
+model. Every compressed model is written as a checkpoint the API loads
+like any other (MODEL_PATH=./models/best_model_rank64.pt).
+
+Usage:
+    python scripts/compress_output_layer.py --ranks 32,64,128,256
+    python scripts/compress_output_layer.py --ranks 64 --finetune-steps 200
+"""
+
+import sys
+import os
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import argparse
+import copy
+import json
+import time
+
+import numpy as np
+import torch
+import torch.nn as nn
+
+from model import LowRankOutput, build_model_from_checkpoint
+from checkpoint_store import load_checkpoint, mapped_path, save_checkpoint
+from train_instacart import CartDataset, collate_fn, evaluate, make_loader, train_val_split
+
+
+def int_list(value):
+    return [int(v) for v in value.split(',') if v]
+
+
+def latency_ms(model, carts, iterations):
+    """Median predict_top_k latency for one batch of carts."""
+    with torch.no_grad():
+        for _ in range(3):
+            model.predict_top_k(carts, k=10)
+        timings = []
+        for _ in range(iterations):
+            start = time.perf_counter()
+            model.predict_top_k(carts, k=10)
+            timings.append(time.perf_counter() - start)
+    return float(np.median(timings)) * 1000
+
+
+def finetune(model, dataset, steps, batch_size, lr, seed):
+    """A few Adam steps on random training batches."""
+    rng = np.random.default_rng(seed)
+    optimizer = torch.optim.Adam(model.parameters(), lr=lr)
+    criterion = nn.CrossEntropyLoss()
+    model.train()
+    for _ in range(steps):
+        carts, next_items = collate_fn(dataset.__getitems__(rng.integers(0, len(dataset), size=batch_size)))
+        optimizer.zero_grad()
+        criterion(model(carts), next_items).backward()
+        optimizer.step()
+    model.eval()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Replace fc_out with a low-rank factorization")
+    parser.add_argument("--model-path", type=str, default="./models/best_model.pt", help="Trained checkpoint")
+    parser.add_argument("--examples-cache", type=str, default="./models/examples_cache.npz",
+                        help="Examples cache written by train_instacart.py (for accuracy and fine-tuning)")
+    parser.add_argument("--ranks", type=int_list, default=[32, 64, 128, 256], help="Comma-separated ranks")
+    parser.add_argument("--finetune-steps", type=int, default=0, help="Fine-tuning steps after the SVD")
+    parser.add_argument("--finetune-lr", type=float, default=1e-4, help="Fine-tuning learning rate")
+    parser.add_argument("--batch-size", type=int, default=1024, help="Fine-tuning and evaluation batch size")
+    parser.add_argument("--latency-iterations", type=int, default=50, help="Timed predict_top_k calls per batch size")
+    parser.add_argument("--torch-threads", type=int, default=1, help="torch threads for latency")
+    parser.add_argument("--output", type=str, default="./models/best_model_rank{rank}.pt",
+                        help="Output checkpoint path; {rank} is replaced by the rank")
+    parser.add_argument("--report", type=str, default=None, help="Optional JSON file for the sweep results")
+    parser.add_argument("--seed", type=int, default=0, help="Random seed")
+    args = parser.parse_args()
+    
+    torch.manual_seed(args.seed)
+    torch.set_num_threads(args.torch_threads)
+    device = torch.device('cpu')
+    
+    checkpoint = load_checkpoint(args.model_path, map_location=device)
+    model = build_model_from_checkpoint(checkpoint).eval()
+    if not isinstance(getattr(model, 'fc_out', None), nn.Linear):
+        raise SystemExit(f"{args.model_path} has no dense fc_out to compress")
+    
+    data = np.load(args.examples_cache)
+    if 'target_offsets' in data.files or len(data['item_ids']) + 1 != checkpoint['num_items']:
+        raise SystemExit(f"{args.examples_cache} does not hold next-item examples for this model's vocabulary")
+    # The model's own split (personalized models are evaluated without user vectors)
+    carts, next_items = data['carts'], data['next_items']
+    train_idx, val_idx = train_val_split(data['user_ids'], checkpoint.get('personalized', 'user_store' in checkpoint))
+    train_dataset = CartDataset(carts[train_idx], next_items[train_idx])
+    val_dataset = CartDataset(carts[val_idx], next_items[val_idx])
+    val_loader = make_loader(val_dataset, device, 0, 0, batch_size=args.batch_size, shuffle=False)
+    criterion = nn.CrossEntropyLoss()
+    
+    rng = np.random.default_rng(args.seed)
+    latency_carts = {
+        batch_size: collate_fn(val_dataset.__getitems__(rng.integers(0, len(val_dataset), size=batch_size)))[0]
+        for batch_size in (1, 32)
+    }
+    
+    def measure(candidate):
+        val_loss, accuracy = evaluate(candidate, val_loader, criterion, device)
+        return {
+            'parameters': sum(p.numel() for p in candidate.parameters()),
+            'output_parameters': sum(p.numel() for p in candidate.fc_out.parameters()),
+            'val_loss': val_loss,
+            'val_accuracy': accuracy,
+            'latency_ms': {f'batch_{size}': latency_ms(candidate, cart_tensor, args.latency_iterations)
+                           for size, cart_tensor in latency_carts.items()},
+        }
+    
+    def report_line(name, result):
+        accuracy = result['val_accuracy']
+        print(f"{name:>8s}  {result['output_parameters'] / 1e6:7.2f}M fc_out  "
+              f"batch 1 {result['latency_ms']['batch_1']:7.3f} ms  batch 32 {result['latency_ms']['batch_32']:7.3f} ms  "
+              f"top-1 {accuracy[1]*100:5.2f}%  top-10 {accuracy[10]*100:5.2f}%")
+    
+    print(f"Evaluating on {len(val_dataset):,} validation examples")
+    results = {'dense': measure(model)}
+    report_line('dense', results['dense'])
+    
+    hidden_dim = model.fc_out.in_features
+    for rank in args.ranks:
+        if rank >= hidden_dim:
+            print(f"Skipping rank {rank}: not below hidden_dim {hidden_dim}")
+            continue
+        compressed = copy.deepcopy(model)
+        compressed.fc_out = LowRankOutput.from_linear(model.fc_out, rank)
+        compressed.output_rank = rank
+        compressed.eval()
+        result = measure(compressed)
+        report_line(f"r={rank}", result)
+        if args.finetune_steps:
+            finetune(compressed, train_dataset, args.finetune_steps, args.batch_size, args.finetune_lr, args.seed)
+            result['finetuned'] = measure(compressed)
+            report_line(f"+tuned", result['finetuned'])
+        results[f'rank_{rank}'] = result
+        
+        final = result.get('finetuned', result)
+        output_path = args.output.format(rank=rank)
+        compressed_checkpoint = dict(checkpoint)
+        compressed_checkpoint.update({
+            'model_state_dict': compressed.state_dict(),
+            'val_loss': final['val_loss'],
+            'val_accuracy': final['val_accuracy'],
+            'output_rank': rank,
+            'finetune_steps': args.finetune_steps,
+            'compressed_from': os.path.abspath(args.model_path),
+        })
+        if checkpoint.get('user_store'):
+            # Stored relative to the checkpoint's directory, which may change
+            store_path = os.path.join(os.path.dirname(os.path.abspath(args.model_path)), checkpoint['user_store'])
+            compressed_checkpoint['user_store'] = os.path.relpath(
+                store_path, os.path.dirname(os.path.abspath(output_path)))
+        save_checkpoint(compressed_checkpoint, output_path)
+        print(f"          wrote {output_path} ({os.path.getsize(output_path) / 2**20:.1f} MB) "
+              f"and {mapped_path(output_path)}")
+    
+    if args.report:
+        with open(args.report, 'w') as f:
+            json.dump(results, f, indent=2)
+        print(f"Results written to {args.report}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,92 @@
+"""
+Convert vocabulary.pkl into the compact, memory-mappable format used by the API.
+
+Usage:
+    python scripts/convert_vocabulary.py
+    python scripts/convert_vocabulary.py --benchmark   # compare cold-start time and RSS
+"""
+
+import sys
+import os
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import argparse
+import json
+import subprocess
+
+from vocab_store import CompactVocabulary, compact_vocabulary_dir
+
+
+# Runs in a fresh interpreter so each format is measured from a cold start
+LOAD_PROBE = r'''
+import json, sys, time
+sys.path.insert(0, sys.argv[3])
+
+def rss_kb():
+    with open('/proc/self/status') as f:
+        for line in f:
+            if line.startswith('VmRSS:'):
+                return int(line.split()[1])
+    import resource
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+import numpy, pickle
+from vocab_store import CompactVocabulary
+
+before = rss_kb()
+start = time.perf_counter()
+if sys.argv[1] == 'pickle':
+    with open(sys.argv[2], 'rb') as f:
+        vocab = pickle.load(f)
+    idx = vocab['item_to_idx'].get(vocab['idx_to_item'][1], 0)
+else:
+    vocab = CompactVocabulary.load(sys.argv[2])
+    idx = int(vocab.lookup([vocab.item_id(1)])[0])
+elapsed = time.perf_counter() - start
+print(json.dumps({'load_ms': elapsed * 1000, 'rss_delta_kb': rss_kb() - before}))
+'''
+
+
+def measure(kind, path, repeats=5):
+    """Median load time and RSS growth over several cold starts."""
+    backend_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    runs = []
+    for _ in range(repeats):
+        output = subprocess.check_output([sys.executable, '-c', LOAD_PROBE, kind, path, backend_dir])
+        runs.append(json.loads(output))
+    runs.sort(key=lambda r: r['load_ms'])
+    return runs[len(runs) // 2]
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Convert vocabulary.pkl to the compact serving format")
+    parser.add_argument("--input", type=str, default="./models/vocabulary.pkl", help="Vocabulary pickle")
+    parser.add_argument("--output", type=str, default=None, help="Output directory (default: next to the pickle)")
+    parser.add_argument("--benchmark", action="store_true", help="Report cold-start time and RSS for both formats")
+    args = parser.parse_args()
+    
+    output_dir = args.output or compact_vocabulary_dir(args.input)
+    
+    print(f"Converting {args.input} -> {output_dir}")
+    vocab = CompactVocabulary.from_pickle(args.input)
+    vocab.save(output_dir)
+    
+    # Round-trip check against the original dicts
+    loaded = CompactVocabulary.load(output_dir)
+    import pickle
+    with open(args.input, 'rb') as f:
+        original = pickle.load(f)
+    ids = list(original['item_to_idx'].keys())
+    expected = [original['item_to_idx'][item] for item in ids]
+    assert loaded.lookup(ids).tolist() == expected, "id -> idx mapping mismatch"
+    print(f"Saved {loaded.num_items} items, {len(loaded.aisles)} aisles, {len(loaded.departments)} departments")
+    
+    if args.benchmark:
+        print("\nCold-start load (median of 5 fresh processes):")
+        for kind, path in (('pickle', args.input), ('compact', output_dir)):
+            result = measure(kind, path)
+            print(f"  {kind:8s} {result['load_ms']:8.2f} ms   RSS +{result['rss_delta_kb'] / 1024:.1f} MB")
+
+
+if __name__ == '__main__':
+    main()
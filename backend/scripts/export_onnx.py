@@ -0,0 +1,291 @@
+"""
+Export a checkpoint to ONNX for the ONNX Runtime serving backend.
+
+The graph is the model's predict_top_k in eval mode (forward pass,
+softmax, allowed-items mask, top-k) with dynamic batch and cart length
+axes; k is an input too, so one file serves any top_k. The checkpoint's
+info goes into the model metadata and the item vectors used for
+diversity re-ranking into .npy files next to it (see onnx_inference.py).
+
+After exporting, the script checks that ONNX Runtime returns the same
+items and probabilities as PyTorch on random carts, masks and user
+vectors, and compares predict latency and, with --vocab-path, server
+import time, load time and peak memory of the two backends.
+
+Usage:
+    python scripts/export_onnx.py --model-path ./models/best_model.pt
+    INFERENCE_BACKEND=onnx MODEL_PATH=./models/best_model.onnx python api.py
+"""
+
+import sys
+import os
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import argparse
+import json
+import subprocess
+import time
+
+import numpy as np
+import onnx
+import onnxruntime as ort
+import torch
+import torch.nn as nn
+import torch.nn.functional as F
+
+from bundle_base import MAX_CART_SIZE
+from model import build_model_from_checkpoint
+from checkpoint_store import load_checkpoint
+from onnx_inference import METADATA_KEY, item_vectors_path
+
+
+class TopKGraph(nn.Module):
+    """predict_top_k as a module, with k fixed for tracing (see make_k_an_input)."""
+    
+    def __init__(self, model, k):
+        super().__init__()
+        self.model = model
+        self.k = k
+    
+    def forward(self, carts, mask, user_vectors):
+        return self.model.top_k(self.model(carts, user_vectors), self.k, mask)
+
+
+def make_k_an_input(model_proto):
+    """Replace the constant k of the graph's TopK node (and outputs) with an int64 input 'k' of shape (1,)."""
+    graph = model_proto.graph
+    top_k_nodes = [node for node in graph.node if node.op_type == 'TopK']
+    if len(top_k_nodes) != 1:
+        raise RuntimeError(f"Expected one TopK node in the exported graph, found {len(top_k_nodes)}")
+    constant = top_k_nodes[0].input[1]
+    top_k_nodes[0].input[1] = 'k'
+    graph.input.append(onnx.helper.make_tensor_value_info('k', onnx.TensorProto.INT64, [1]))
+    for output in graph.output:
+        output.type.tensor_type.shape.dim[1].dim_param = 'k'
+    
+    # Drop the constant unless something else uses it
+    if not any(constant in node.input for node in graph.node):
+        kept_nodes = [node for node in graph.node if constant not in node.output]
+        kept_initializers = [init for init in graph.initializer if init.name != constant]
+        del graph.node[:], graph.initializer[:]
+        graph.node.extend(kept_nodes)
+        graph.initializer.extend(kept_initializers)
+
+
+def clear_traced_shapes(graph):
+    """
+    Drop intermediate shapes recorded at the traced batch size, including
+    the outputs of subgraphs (If branches); ONNX Runtime infers them.
+    """
+    del graph.value_info[:]
+    for node in graph.node:
+        for attribute in node.attribute:
+            subgraphs = [attribute.g] if attribute.HasField('g') else list(attribute.graphs)
+            for subgraph in subgraphs:
+                for output in subgraph.output:
+                    output.type.tensor_type.ClearField('shape')
+                clear_traced_shapes(subgraph)
+
+
+def export(checkpoint, model, model_path, output_path):
+    """Write the ONNX graph with its metadata, and the item vectors next to it."""
+    num_items = checkpoint['num_items']
+    embedding_dim = checkpoint['embedding_dim']
+    example = (
+        torch.randint(1, num_items, (2, checkpoint.get('max_cart_size', MAX_CART_SIZE))),
+        torch.ones(num_items, dtype=torch.bool),
+        torch.zeros(2, embedding_dim),
+    )
+    # TorchScript exporter: it maps nn.GRU to the ONNX GRU op, keeping both axes dynamic
+    torch.onnx.export(
+        TopKGraph(model, k=10).eval(), example, output_path,
+        input_names=['carts', 'mask', 'user_vectors'],
+        output_names=['items', 'probs'],
+        dynamic_axes={'carts': {0: 'batch', 1: 'cart_len'}, 'user_vectors': {0: 'batch'},
+                      'items': {0: 'batch'}, 'probs': {0: 'batch'}},
+        opset_version=17,
+        dynamo=False,
+    )
+    model_proto = onnx.load(output_path)
+    make_k_an_input(model_proto)
+    clear_traced_shapes(model_proto.graph)
+    
+    info = {
+        'num_items': num_items,
+        'embedding_dim': embedding_dim,
+        'model_type': model.model_type,
+        'hierarchy': checkpoint.get('hierarchy'),
+        'qr_buckets': model.item_embeddings.buckets if model.compressed else 0,
+        'output_rank': model.output_rank,
+        'max_cart_size': checkpoint.get('max_cart_size', MAX_CART_SIZE),
+        'parameters': sum(p.numel() for p in model.parameters()),
+        'epoch': checkpoint.get('epoch'),
+        'val_loss': checkpoint.get('val_loss'),
+        'val_accuracy': checkpoint.get('val_accuracy'),
+        'exported_from': os.path.abspath(model_path),
+    }
+    if checkpoint.get('user_store'):
+        # Stored relative to the model file, whose directory may change
+        store_path = os.path.join(os.path.dirname(os.path.abspath(model_path)), checkpoint['user_store'])
+        info['user_store'] = os.path.relpath(store_path, os.path.dirname(os.path.abspath(output_path)))
+        info['user_store_id'] = checkpoint.get('user_store_id')
+    model_proto.metadata_props.append(onnx.StringStringEntryProto(key=METADATA_KEY, value=json.dumps(info)))
+    onnx.save(model_proto, output_path)
+    
+    with torch.no_grad():
+        np.save(item_vectors_path(output_path, 'item_embeddings'),
+                model.item_embeddings.weight.float().numpy())
+        np.save(item_vectors_path(output_path, 'fc_out'), model.item_output_weights().float().numpy())
+
+
+def random_carts(rng, batch_size, num_items, max_cart_size):
+    carts = np.zeros((batch_size, max_cart_size), dtype=np.int64)
+    for row in range(batch_size):
+        size = rng.integers(1, max_cart_size + 1)
+        carts[row, :size] = rng.integers(1, num_items, size=size)
+    return carts
+
+
+def check_parity(model, session, num_items, embedding_dim, max_cart_size, seed):
+    """
+    Largest probability difference between PyTorch and ONNX Runtime top-k,
+    and the fraction of positions where they return a different item.
+    
+    The difference also covers the PyTorch probability of every item ONNX
+    Runtime returned, so items swapped between tied probabilities pass.
+    """
+    rng = np.random.default_rng(seed)
+    worst, mismatched, total = 0.0, 0, 0
+    for batch_size, k, masked in ((1, 10, False), (7, 10, True), (64, 200, False), (64, 50, True)):
+        carts = random_carts(rng, batch_size, num_items, max_cart_size)
+        mask = rng.random(num_items) < 0.5 if masked else np.ones(num_items, dtype=bool)
+        user_vectors = rng.normal(0, 0.1, (batch_size, embedding_dim)).astype(np.float32)
+        
+        ort_items, ort_probs = session.run(['items', 'probs'], {
+            'carts': carts, 'mask': mask, 'user_vectors': user_vectors, 'k': np.array([k], dtype=np.int64)})
+        with torch.no_grad():
+            logits = model(torch.from_numpy(carts), torch.from_numpy(user_vectors))
+            torch_items, torch_probs = model.top_k(logits, k, torch.from_numpy(mask))
+            probs = F.softmax(logits, dim=-1).masked_fill(~torch.from_numpy(mask), float('-inf'))
+        torch_probs = torch_probs.numpy()
+        for other in (ort_probs, np.take_along_axis(probs.numpy(), ort_items, axis=1)):
+            finite = np.isfinite(torch_probs)
+            if not np.array_equal(finite, np.isfinite(other)):
+                return float('inf'), 1.0
+            worst = max(worst, float(np.abs(other[finite] - torch_probs[finite]).max(initial=0)))
+        mismatched += int((ort_items != torch_items.numpy()).sum())
+        total += torch_items.numel()
+    return worst, mismatched / total
+
+
+def latency_ms(predict, carts, iterations):
+    for _ in range(3):
+        predict(carts)
+    timings = []
+    for _ in range(iterations):
+        start = time.perf_counter()
+        predict(carts)
+        timings.append(time.perf_counter() - start)
+    return float(np.median(timings)) * 1000
+
+
+# Run in a fresh interpreter per backend, so imports and memory are the server's
+FOOTPRINT = """
+import json, sys, time
+start = time.perf_counter()
+import {module} as backend
+imported = time.perf_counter() - start
+bundle = backend.{loader}(sys.argv[1], sys.argv[2], {argument})
+bundle.warmup()
+loaded = time.perf_counter() - start
+with open('/proc/self/status') as f:
+    peak_kb = next(int(line.split()[1]) for line in f if line.startswith('VmHWM:'))
+print(json.dumps({{'import_s': imported, 'ready_s': loaded, 'peak_rss_mb': peak_kb / 2**10,
+                  'torch_imported': 'torch' in sys.modules}}))
+"""
+
+
+def serving_footprint(module, loader, argument, model_path, vocab_path):
+    """Import time, time until warmed up and peak RSS of a fresh process serving the model."""
+    code = FOOTPRINT.format(module=module, loader=loader, argument=argument)
+    backend_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    result = subprocess.run([sys.executable, '-c', code, os.path.abspath(model_path), os.path.abspath(vocab_path)],
+                            cwd=backend_dir, capture_output=True, text=True, check=True)
+    return json.loads(result.stdout.strip().splitlines()[-1])
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Export a checkpoint for the ONNX Runtime backend")
+    parser.add_argument("--model-path", type=str, default="./models/best_model.pt", help="Checkpoint to export")
+    parser.add_argument("--output", type=str, default=None, help="ONNX file (default: the checkpoint path with .onnx)")
+    parser.add_argument("--vocab-path", type=str, default=None,
+                        help="Vocabulary; when given, also compare server startup and memory of both backends")
+    parser.add_argument("--atol", type=float, default=1e-5, help="Largest probability difference accepted")
+    parser.add_argument("--latency-iterations", type=int, default=100, help="Timed predictions per batch size")
+    parser.add_argument("--threads", type=int, default=1, help="torch and ONNX Runtime threads for latency")
+    parser.add_argument("--report", type=str, default=None, help="Optional JSON file for the results")
+    parser.add_argument("--seed", type=int, default=0, help="Random seed")
+    args = parser.parse_args()
+    output_path = args.output or os.path.splitext(args.model_path)[0] + '.onnx'
+    
+    checkpoint = load_checkpoint(args.model_path)
+    model = build_model_from_checkpoint(checkpoint).eval()
+    num_items, embedding_dim = checkpoint['num_items'], checkpoint['embedding_dim']
+    max_cart_size = checkpoint.get('max_cart_size', MAX_CART_SIZE)
+    
+    print(f"Exporting {args.model_path} ({model.model_type}, {num_items:,} items)...")
+    start = time.perf_counter()
+    export(checkpoint, model, args.model_path, output_path)
+    print(f"Wrote {output_path} ({os.path.getsize(output_path) / 2**20:.1f} MB) in {time.perf_counter() - start:.1f}s")
+    
+    torch.set_num_threads(args.threads)
+    options = ort.SessionOptions()
+    options.intra_op_num_threads = args.threads
+    session = ort.InferenceSession(output_path, options, providers=['CPUExecutionProvider'])
+    
+    worst, mismatched = check_parity(model, session, num_items, embedding_dim, max_cart_size, args.seed)
+    print(f"\nParity: max probability difference {worst:.2e}, {mismatched * 100:.2f}% of positions "
+          f"with a different (tied) item")
+    if worst > args.atol:
+        raise SystemExit(f"ONNX Runtime differs from PyTorch by more than {args.atol}")
+    results = {'max_probability_difference': worst, 'mismatched_positions': mismatched}
+    
+    print(f"\nLatency (top 10, {args.threads} thread(s)):")
+    rng = np.random.default_rng(args.seed)
+    all_items = np.ones(num_items, dtype=bool)
+    k = np.array([10], dtype=np.int64)
+    
+    def predict_torch(carts):
+        with torch.no_grad():
+            model.predict_top_k(torch.from_numpy(carts), k=10)
+    
+    def predict_onnx(carts):
+        user_vectors = np.zeros((len(carts), embedding_dim), dtype=np.float32)
+        session.run(['items', 'probs'], {'carts': carts, 'mask': all_items, 'user_vectors': user_vectors, 'k': k})
+    
+    results['latency_ms'] = {}
+    for batch_size in (1, 32):
+        carts = random_carts(rng, batch_size, num_items, max_cart_size)
+        timings = {name: latency_ms(predict, carts, args.latency_iterations)
+                   for name, predict in (('torch', predict_torch), ('onnx', predict_onnx))}
+        results['latency_ms'][f'batch_{batch_size}'] = timings
+        print(f"  batch {batch_size:2d}: torch {timings['torch']:7.3f} ms  onnx {timings['onnx']:7.3f} ms")
+    
+    if args.vocab_path:
+        print("\nServer footprint (fresh process: import, load, warm up):")
+        results['footprint'] = {
+            'torch': serving_footprint('inference', 'load_bundle', "'cpu'", args.model_path, args.vocab_path),
+            'onnx': serving_footprint('onnx_inference', 'load_onnx_bundle', args.threads, output_path, args.vocab_path),
+        }
+        for name, footprint in results['footprint'].items():
+            print(f"  {name:5s}: import {footprint['import_s']:5.2f}s, ready {footprint['ready_s']:5.2f}s, "
+                  f"peak RSS {footprint['peak_rss_mb']:6.1f} MB, torch imported: {footprint['torch_imported']}")
+    
+    if args.report:
+        with open(args.report, 'w') as f:
+            json.dump(results, f, indent=2)
+        print(f"Results written to {args.report}")
+
+
+if __name__ == '__main__':
+    main()
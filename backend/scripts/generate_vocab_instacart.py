@@ -7,6 +7,7 @@ import os
 sys.path.append(os.path.dirname(os.path.dirname(__file__)))
 
 from data_processing.preprocess_instacart import InstacartPreprocessor
+from vocab_store import CompactVocabulary
 import json
 
 def main():
@@ -37,6 +38,10 @@ def main():
     os.makedirs('./models', exist_ok=True)
     preprocessor.save_vocabulary('./models/vocabulary.pkl')
     
+    # Compact memory-mapped copy used by the API server
+    CompactVocabulary.from_pickle('./models/vocabulary.pkl').save('./models/vocabulary')
+    print("Saved compact vocabulary to ./models/vocabulary")
+    
     # Export only the frequent products for frontend
     print("\nExporting frequent products...")
     all_products = []
@@ -0,0 +1,114 @@
+"""
+Generate a randomly initialised model and matching vocabulary.
+
+Useful for benchmarks and memory checks without the Instacart data or a
+trained checkpoint. Writes best_model.pt and best_model.safetensors,
+vocabulary.pkl, the compact vocabulary directory and all_products.json
+into --output-dir.
+
+Usage:
+    python scripts/make_synthetic_model.py --output-dir /tmp/synthetic --num-items 50000
+"""
+
+import sys
+import os
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import argparse
+import json
+import pickle
+
+import numpy as np
+import torch
+
+from model import MODEL_TYPES, build_model
+from checkpoint_store import save_checkpoint
+from vocab_store import CompactVocabulary
+
+
+def make_vocabulary(num_products: int, rng: np.random.Generator):
+    """Vocabulary dict in the same layout as InstacartPreprocessor.save_vocabulary."""
+    product_ids = np.sort(rng.choice(num_products * 4, size=num_products, replace=False) + 1)
+    num_aisles = max(1, int(np.sqrt(num_products)))
+    num_departments = max(1, num_aisles // 6)
+    aisle_ids = rng.integers(1, num_aisles + 1, size=num_products)
+    
+    item_to_idx = {}
+    idx_to_item = {0: 0}
+    product_info = {}
+    for idx, (product_id, aisle_id) in enumerate(zip(product_ids.tolist(), aisle_ids.tolist()), start=1):
+        department_id = aisle_id % num_departments + 1
+        item_to_idx[product_id] = idx
+        idx_to_item[idx] = product_id
+        product_info[product_id] = {
+            'name': f'Product {product_id}',
+            'aisle': f'aisle {aisle_id}',
+            'department': f'department {department_id}',
+            'aisle_id': aisle_id,
+            'department_id': department_id,
+        }
+    
+    return {
+        'item_to_idx': item_to_idx,
+        'idx_to_item': idx_to_item,
+        'num_items': num_products + 1,
+        'product_info': product_info,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Generate a synthetic model and vocabulary")
+    parser.add_argument("--output-dir", type=str, required=True, help="Directory to write artifacts to")
+    parser.add_argument("--num-items", type=int, default=1094, help="Number of products")
+    parser.add_argument("--model-type", type=str, default="mlp", choices=sorted(MODEL_TYPES), help="Model type")
+    parser.add_argument("--embedding-dim", type=int, default=512, help="Embedding dimension")
+    parser.add_argument("--hidden-dim", type=int, default=1024, help="Hidden layer dimension")
+    parser.add_argument("--qr-buckets", type=int, default=0, help="Quotient-remainder item tables (0 = dense)")
+    parser.add_argument("--seed", type=int, default=0, help="Random seed")
+    args = parser.parse_args()
+    
+    os.makedirs(args.output_dir, exist_ok=True)
+    rng = np.random.default_rng(args.seed)
+    torch.manual_seed(args.seed)
+    
+    vocab_data = make_vocabulary(args.num_items, rng)
+    vocab_path = os.path.join(args.output_dir, 'vocabulary.pkl')
+    with open(vocab_path, 'wb') as f:
+        pickle.dump(vocab_data, f)
+    CompactVocabulary.from_pickle(vocab_path).save(os.path.join(args.output_dir, 'vocabulary'))
+    
+    products = [
+        {'id': product_id, **{key: info[key] for key in ('name', 'aisle', 'department', 'aisle_id', 'department_id')}}
+        for product_id, info in vocab_data['product_info'].items()
+    ]
+    with open(os.path.join(args.output_dir, 'all_products.json'), 'w') as f:
+        json.dump(products, f)
+    
+    model = build_model(
+        args.model_type,
+        num_items=vocab_data['num_items'],
+        embedding_dim=args.embedding_dim,
+        hidden_dim=args.hidden_dim,
+        qr_buckets=args.qr_buckets
+    )
+    model.eval()
+    checkpoint = {
+        'model_state_dict': model.state_dict(),
+        'val_loss': None,
+        'val_accuracy': {1: 0.0, 5: 0.0, 10: 0.0},
+        'model_type': args.model_type,
+        'num_items': vocab_data['num_items'],
+        'embedding_dim': args.embedding_dim,
+        'hidden_dim': args.hidden_dim,
+        'epoch': 0
+    }
+    model_path = os.path.join(args.output_dir, 'best_model.pt')
+    save_checkpoint(checkpoint, model_path)
+    
+    num_params = sum(p.numel() for p in model.parameters())
+    print(f"Wrote synthetic model ({num_params:,} parameters, "
+          f"{os.path.getsize(model_path) / 2**20:.1f} MB) and vocabulary to {args.output_dir}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,146 @@
+"""
+Multi-worker API server with copy-on-write shared model weights.
+
+The master process loads the model and vocabulary once, then forks N
+uvicorn workers that all accept on the same listening socket. Workers
+inherit the weights through fork: inference never writes to parameter
+storage, so those pages stay shared instead of being copied N times.
+The vocabulary is memory-mapped (see vocab_store.py) and shared through
+the page cache.
+
+Usage:
+    python serve.py --workers 4 --port 8000
+
+Linux/macOS only (requires os.fork). CPU inference only: CUDA contexts
+cannot be shared across fork.
+"""
+
+import argparse
+import gc
+import os
+import signal
+import socket
+import sys
+import time
+
+import uvicorn
+
+import api
+
+
+def create_socket(host: str, port: int) -> socket.socket:
+    """Bind the listening socket in the master so every worker shares it."""
+    family = socket.AF_INET6 if ':' in host else socket.AF_INET
+    sock = socket.socket(family, socket.SOCK_STREAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    sock.bind((host, port))
+    sock.listen(2048)
+    sock.set_inheritable(True)
+    return sock
+
+
+def run_worker(sock: socket.socket, args):
+    """Worker process body: serve the preloaded app on the shared socket."""
+    # Drop the master's shutdown handlers; uvicorn installs its own
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+    signal.signal(signal.SIGINT, signal.SIG_DFL)
+    if api.INFERENCE_BACKEND == "torch":
+        import torch
+        torch.set_num_threads(args.threads_per_worker)
+    
+    config = uvicorn.Config(api.app, log_level=args.log_level, access_log=False)
+    server = uvicorn.Server(config)
+    server.run(sockets=[sock])
+
+
+class Master:
+    """Forks workers, restarts crashed ones and forwards shutdown signals."""
+    
+    def __init__(self, sock: socket.socket, args):
+        self.sock = sock
+        self.args = args
+        self.workers = set()
+        self.stopping = False
+    
+    def spawn(self):
+        pid = os.fork()
+        if pid == 0:
+            try:
+                run_worker(self.sock, self.args)
+            finally:
+                os._exit(0)
+        self.workers.add(pid)
+        return pid
+    
+    def stop(self, signum, frame):
+        self.stopping = True
+        for pid in list(self.workers):
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+    
+    def run(self):
+        signal.signal(signal.SIGTERM, self.stop)
+        signal.signal(signal.SIGINT, self.stop)
+        
+        for _ in range(self.args.workers):
+            self.spawn()
+        print(f"Started {len(self.workers)} workers: {sorted(self.workers)}", flush=True)
+        
+        while self.workers:
+            try:
+                pid, status = os.wait()
+            except ChildProcessError:
+                break
+            except InterruptedError:
+                continue
+            self.workers.discard(pid)
+            if not self.stopping:
+                print(f"Worker {pid} exited with status {status}, restarting", flush=True)
+                time.sleep(0.5)
+                self.spawn()
+        
+        self.sock.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Serve the prediction API with N preforked workers")
+    parser.add_argument("--host", type=str, default="0.0.0.0", help="Bind address")
+    parser.add_argument("--port", type=int, default=8000, help="Bind port")
+    parser.add_argument("--workers", type=int, default=os.cpu_count() or 1, help="Number of worker processes")
+    parser.add_argument("--threads-per-worker", type=int, default=1, help="torch intra-op threads per worker (1 with the onnx backend)")
+    parser.add_argument("--model-path", type=str, default=api.MODEL_PATH, help="Model checkpoint (.onnx file with the onnx backend)")
+    parser.add_argument("--vocab-path", type=str, default=api.VOCAB_PATH, help="Vocabulary (.pkl or compact directory)")
+    parser.add_argument("--log-level", type=str, default="info", help="uvicorn log level")
+    args = parser.parse_args()
+    
+    if not hasattr(os, 'fork'):
+        sys.exit("serve.py needs os.fork; use `python api.py` on this platform")
+    
+    if api.INFERENCE_BACKEND == "onnx":
+        if args.threads_per_worker != 1:
+            sys.exit("--threads-per-worker must be 1 with INFERENCE_BACKEND=onnx: "
+                     "ONNX Runtime's thread pool would be created before fork and not survive it")
+        # One thread runs on the calling thread, so no pool exists at fork
+        api.ONNX_THREADS = 1
+    
+    # Load once in the master; workers inherit the weights copy-on-write.
+    # The master never runs inference, so torch's thread pool is not started before fork.
+    api.load_model_and_vocab(args.model_path, args.vocab_path, device_name="cpu")
+    if api.INFERENCE_BACKEND == "torch":
+        for param in api.bundle.model.parameters():
+            param.requires_grad_(False)
+    
+    # Move everything allocated so far out of the GC's generations, so
+    # collections in the workers don't write to (and un-share) those pages
+    gc.collect()
+    gc.freeze()
+    
+    sock = create_socket(args.host, args.port)
+    print(f"Listening on http://{args.host}:{args.port} (master pid {os.getpid()})", flush=True)
+    Master(sock, args).run()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,33 @@
+import os
+import subprocess
+import sys
+
+import pytest
+
+BACKEND_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, BACKEND_DIR)
+
+
+@pytest.fixture(scope='session')
+def synthetic_model(tmp_path_factory):
+    """
+    Build artifacts with scripts/make_synthetic_model.py.
+    
+    Returns a function taking the script's options as keyword arguments
+    (num_items=2000, model_type='gru', ...) and returning the output
+    directory; each set of options is generated once per session.
+    """
+    built = {}
+    
+    def build(**options):
+        key = tuple(sorted(options.items()))
+        if key not in built:
+            output_dir = str(tmp_path_factory.mktemp('synthetic'))
+            command = [sys.executable, os.path.join(BACKEND_DIR, 'scripts', 'make_synthetic_model.py'),
+                       '--output-dir', output_dir]
+            for name, value in options.items():
+                command += [f"--{name.replace('_', '-')}", str(value)]
+            subprocess.check_call(command, stdout=subprocess.DEVNULL)
+            built[key] = output_dir
+        return built[key]
+    return build
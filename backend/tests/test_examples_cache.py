@@ -0,0 +1,114 @@
+"""The examples cache written by train_instacart.py is reused only by matching runs."""
+
+import argparse
+import os
+import pickle
+
+import numpy as np
+import pandas as pd
+import pytest
+
+import train_instacart
+from data_processing.preprocess_instacart import InstacartPreprocessor
+
+
+def write_instacart(data_dir, num_users=40, num_products=30, seed=0):
+    """A tiny dataset in the Instacart CSV layout, with skewed product popularity."""
+    rng = np.random.default_rng(seed)
+    os.makedirs(data_dir, exist_ok=True)
+    pd.DataFrame({'aisle_id': [1, 2], 'aisle': ['aisle 1', 'aisle 2']}).to_csv(
+        os.path.join(data_dir, 'aisles.csv'), index=False)
+    pd.DataFrame({'department_id': [1], 'department': ['department 1']}).to_csv(
+        os.path.join(data_dir, 'departments.csv'), index=False)
+    pd.DataFrame({
+        'product_id': np.arange(1, num_products + 1),
+        'product_name': [f'Product {i}' for i in range(1, num_products + 1)],
+        'aisle_id': rng.integers(1, 3, size=num_products),
+        'department_id': 1,
+    }).to_csv(os.path.join(data_dir, 'products.csv'), index=False)
+    
+    popularity = np.linspace(2, 0.1, num_products)
+    orders, order_products = [], []
+    for user_id in range(1, num_users + 1):
+        for order_number in range(1, 4):
+            order_id = len(orders) + 1
+            orders.append((order_id, user_id, order_number))
+            products = rng.choice(num_products, size=4, replace=False, p=popularity / popularity.sum()) + 1
+            order_products.extend((order_id, int(p), position, 0) for position, p in enumerate(products, start=1))
+    pd.DataFrame(orders, columns=['order_id', 'user_id', 'order_number']).to_csv(
+        os.path.join(data_dir, 'orders.csv'), index=False)
+    pd.DataFrame(order_products, columns=['order_id', 'product_id', 'add_to_cart_order', 'reordered']).to_csv(
+        os.path.join(data_dir, 'order_products__prior.csv'), index=False)
+
+
+@pytest.fixture
+def dataset(tmp_path):
+    """(args, vocab_path) for a subsampled run whose vocabulary differs from the pickle's."""
+    data_dir = str(tmp_path / 'data')
+    write_instacart(data_dir)
+    # Like generate_vocab_instacart.py, the pickle keeps every product
+    preprocessor = InstacartPreprocessor()
+    data_df, _ = preprocessor.load_data(data_dir)
+    preprocessor.build_vocabulary(data_df)
+    vocab_path = str(tmp_path / 'vocabulary.pkl')
+    preprocessor.save_vocabulary(vocab_path)
+    args = argparse.Namespace(
+        data_dir=data_dir, examples_cache=str(tmp_path / 'examples_cache.npz'), objective='next-item',
+        sample_frac=0.5, min_product_count=10, max_cart_size=20, seed=0
+    )
+    return args, vocab_path
+
+
+@pytest.fixture
+def preprocessing_runs(monkeypatch):
+    """Count how often process_events runs instead of the cache being used."""
+    runs = []
+    process_events = InstacartPreprocessor.process_events
+    
+    def counted(self, *args, **kwargs):
+        runs.append(1)
+        return process_events(self, *args, **kwargs)
+    monkeypatch.setattr(InstacartPreprocessor, 'process_events', counted)
+    return runs
+
+
+def load(args, vocab_path):
+    np.random.seed(args.seed)
+    preprocessor = InstacartPreprocessor()
+    preprocessor.load_vocabulary(vocab_path)
+    return train_instacart.load_examples(preprocessor, args), preprocessor
+
+
+def test_identical_run_loads_from_cache(dataset, preprocessing_runs):
+    args, vocab_path = dataset
+    (carts, next_items, user_ids, _), first = load(args, vocab_path)
+    (cached_carts, cached_next_items, cached_user_ids, _), second = load(args, vocab_path)
+    
+    assert len(preprocessing_runs) == 1
+    np.testing.assert_array_equal(cached_carts, carts)
+    np.testing.assert_array_equal(cached_next_items, next_items)
+    np.testing.assert_array_equal(cached_user_ids, user_ids)
+    assert second.idx_to_item == first.idx_to_item
+
+
+def test_changed_vocabulary_rebuilds_cache(dataset, preprocessing_runs):
+    args, vocab_path = dataset
+    load(args, vocab_path)
+    with open(vocab_path, 'rb') as f:
+        vocab_data = pickle.load(f)
+    vocab_data['idx_to_item'][1], vocab_data['idx_to_item'][2] = vocab_data['idx_to_item'][2], vocab_data['idx_to_item'][1]
+    with open(vocab_path, 'wb') as f:
+        pickle.dump(vocab_data, f)
+    load(args, vocab_path)
+    
+    assert len(preprocessing_runs) == 2
+
+
+def test_changed_data_dir_rebuilds_cache(dataset, preprocessing_runs, tmp_path):
+    args, vocab_path = dataset
+    load(args, vocab_path)
+    args.data_dir = str(tmp_path / 'other_data')
+    write_instacart(args.data_dir)
+    load(args, vocab_path)
+    
+    assert len(preprocessing_runs) == 2
@@ -0,0 +1,58 @@
+"""The ONNX Runtime backend serves the same top-k as the PyTorch one."""
+
+import os
+
+import numpy as np
+import pytest
+
+pytest.importorskip('onnx')
+pytest.importorskip('onnxruntime')
+
+from checkpoint_store import load_checkpoint
+from inference import load_bundle
+from model import build_model_from_checkpoint
+from onnx_inference import load_onnx_bundle
+from scripts.export_onnx import export
+
+NUM_ITEMS = 500
+
+
+@pytest.fixture(params=[
+    {'model_type': 'mlp'},
+    {'model_type': 'gru'},
+    {'model_type': 'mlp', 'qr_buckets': 32},
+], ids=['mlp', 'gru', 'qr'])
+def bundles(request, synthetic_model):
+    """(torch bundle, ONNX bundle) for one synthetic model exported to ONNX."""
+    artifacts_dir = synthetic_model(num_items=NUM_ITEMS, embedding_dim=32, hidden_dim=64, **request.param)
+    model_path = os.path.join(artifacts_dir, 'best_model.pt')
+    onnx_path = os.path.join(artifacts_dir, 'best_model.onnx')
+    vocab_path = os.path.join(artifacts_dir, 'vocabulary')
+    if not os.path.exists(onnx_path):
+        checkpoint = load_checkpoint(model_path)
+        export(checkpoint, build_model_from_checkpoint(checkpoint).eval(), model_path, onnx_path)
+    return load_bundle(model_path, vocab_path, device_name='cpu'), load_onnx_bundle(onnx_path, vocab_path)
+
+
+def random_carts(bundle, num_carts, seed=0):
+    rng = np.random.default_rng(seed)
+    product_ids = np.asarray(bundle.vocabulary.item_ids[1:])
+    return [rng.choice(product_ids, size=rng.integers(1, 30)) for _ in range(num_carts)]
+
+
+@pytest.mark.parametrize('masked', [False, True], ids=['all-items', 'masked'])
+def test_onnx_matches_torch(bundles, masked):
+    torch_bundle, onnx_bundle = bundles
+    assert onnx_bundle.max_cart_size == torch_bundle.max_cart_size
+    carts = random_carts(torch_bundle, 32)
+    mask = None
+    if masked:
+        mask = np.random.default_rng(1).random(torch_bundle.vocabulary.num_items) < 0.5
+        mask[0] = False
+    
+    expected = torch_bundle.predict_product_ids(carts, top_k=20, mask=mask)
+    actual = onnx_bundle.predict_product_ids(carts, top_k=20, mask=mask)
+    
+    for (expected_ids, expected_probs), (actual_ids, actual_probs) in zip(expected, actual):
+        np.testing.assert_array_equal(actual_ids, expected_ids)
+        np.testing.assert_allclose(actual_probs, expected_probs, rtol=1e-4, atol=1e-6)
@@ -0,0 +1,30 @@
+"""serve.py workers share the memory-mapped model instead of each holding a copy."""
+
+import os
+
+import pytest
+
+from scripts.check_shared_memory import measure
+
+pytestmark = pytest.mark.skipif(not os.path.exists('/proc/self/smaps_rollup'),
+                                reason="needs Linux /proc/<pid>/smaps_rollup")
+
+WORKERS = 2
+# Each extra worker may add its runtime overhead, but not a share of the model
+MAX_FRACTION_OF_MODEL = 0.25
+
+
+@pytest.mark.parametrize('reload', [False, True], ids=['startup', 'hot-reload'])
+def test_workers_share_model_memory(synthetic_model, reload):
+    artifacts_dir = synthetic_model(num_items=50000)
+    model_path = os.path.join(artifacts_dir, 'best_model.safetensors')
+    limit_mb = MAX_FRACTION_OF_MODEL * os.path.getsize(model_path) / 2**20
+    
+    single = measure(1, model_path, artifacts_dir, requests_per_worker=10, reload=reload)
+    multi = measure(WORKERS, model_path, artifacts_dir, requests_per_worker=10, reload=reload)
+    
+    assert len(multi['worker_private_mb']) == WORKERS
+    for private_mb in multi['worker_private_mb']:
+        assert private_mb < limit_mb, f"a worker holds {private_mb:.0f} MB of unshared memory"
+    growth_mb = (multi['total_pss_mb'] - single['total_pss_mb']) / (WORKERS - 1)
+    assert growth_mb < limit_mb, f"each extra worker adds {growth_mb:.0f} MB"
@@ -0,0 +1,47 @@
+"""/ws/predict returns the same predictions as /predict for the same cart."""
+
+import importlib
+import json
+import os
+
+import pytest
+from fastapi.testclient import TestClient
+
+
+@pytest.fixture(params=['mlp', 'gru'])
+def client(request, synthetic_model, monkeypatch):
+    """(TestClient, product IDs) for the API serving a synthetic model."""
+    artifacts_dir = synthetic_model(num_items=300, model_type=request.param, embedding_dim=32, hidden_dim=64)
+    monkeypatch.setenv('MODEL_PATH', os.path.join(artifacts_dir, 'best_model.pt'))
+    monkeypatch.setenv('VOCAB_PATH', os.path.join(artifacts_dir, 'vocabulary.pkl'))
+    monkeypatch.setenv('PRODUCTS_PATH', os.path.join(artifacts_dir, 'all_products.json'))
+    # api reads its settings at import time
+    api = importlib.reload(importlib.import_module('api'))
+    with open(os.path.join(artifacts_dir, 'all_products.json')) as f:
+        product_ids = [str(product['id']) for product in json.load(f)[:3]]
+    with TestClient(api.app) as test_client:
+        yield test_client, product_ids
+
+
+def test_stream_matches_predict_with_repeated_items(client):
+    client, (a, b, c) = client
+    steps = [
+        ({'type': 'set', 'cart': [a, b], 'top_k': 10}, [a, b]),
+        ({'type': 'add', 'product_id': a}, [a, b, a]),
+        ({'type': 'add', 'product_id': a}, [a, b, a, a]),
+        ({'type': 'add', 'product_id': c}, [a, b, a, a, c]),
+        ({'type': 'remove', 'product_id': a}, [a, b, a, c]),
+        ({'type': 'remove', 'product_id': b}, [a, a, c]),
+    ]
+    with client.websocket_connect('/ws/predict') as websocket:
+        for message, cart in steps:
+            websocket.send_text(json.dumps(message))
+            streamed = json.loads(websocket.receive_text())
+            streamed.pop('seq')
+            expected = client.post('/predict', json={'cart': [{'product_id': p} for p in cart], 'top_k': 10}).json()
+            # Sequence models extend the previous encoding instead of rerunning the cart
+            streamed_items, expected_items = streamed.pop('next_item_predictions'), expected.pop('next_item_predictions')
+            assert [item['product_id'] for item in streamed_items] == [item['product_id'] for item in expected_items]
+            assert [item['probability'] for item in streamed_items] == pytest.approx(
+                [item['probability'] for item in expected_items], rel=1e-5)
+            assert streamed == expected, f"after {message}"
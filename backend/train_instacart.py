@@ -4,55 +4,385 @@ Train next-item prediction model on Instacart dataset.
 
 import torch
 import torch.nn as nn
-from torch.utils.data import Dataset, DataLoader
+import torch.nn.functional as F
+from torch.utils.data import Dataset, DataLoader, Sampler, get_worker_info
 import numpy as np
-from model import NextItemPredictor
-from data_processing.preprocess_instacart import InstacartPreprocessor
+from model import MODEL_TYPES, build_model, build_model_from_checkpoint
+from checkpoint_store import load_checkpoint, save_checkpoint
+from user_store import UserStore
+from vocab_store import CompactVocabulary
+from data_processing.preprocess_instacart import InstacartPreprocessor, carts_to_matrix, compact_examples, vocabulary_fingerprint
+import argparse
+import random
+import signal
 import time
+import uuid
 import os
+from itertools import chain
 
 class CartDataset(Dataset):
-    """PyTorch dataset for cart sequences."""
+    """
+    PyTorch dataset for cart sequences stored as a right-padded int32 matrix.
     
-    def __init__(self, carts, next_items):
+    With weights (how many identical examples each one stands for, see
+    compact_examples), batches end with a float weight per example.
+    """
+    
+    def __init__(self, carts, next_items, user_rows=None, weights=None):
         self.carts = carts
         self.next_items = next_items
+        self.user_rows = user_rows
+        self.weights = weights
+        self.lengths = (carts != 0).sum(axis=1)
     
     def __len__(self):
         return len(self.carts)
     
     def __getitem__(self, idx):
+        if self.user_rows is not None:
+            return self.carts[idx], self.next_items[idx], self.user_rows[idx]
         return self.carts[idx], self.next_items[idx]
+    
+    def __getitems__(self, indices):
+        """
+        Fetch a whole batch with one gather per array (DataLoader calls this
+        instead of __getitem__ per example), trimmed to its longest cart.
+        """
+        indices = np.asarray(indices)
+        max_len = max(int(self.lengths[indices].max(initial=0)), 1)
+        batch = (self.carts[indices, :max_len], self.next_items[indices])
+        if self.user_rows is not None:
+            batch += (self.user_rows[indices],)
+        if self.weights is not None:
+            batch += (self.weights[indices].astype(np.float32),)
+        return batch
+
+def select_baskets(target_items, target_offsets, indices):
+    """
+    Baskets of the given examples.
+    
+    Returns:
+        (items, offsets): their items back to back and the (len(indices) + 1,) boundaries
+    """
+    starts = target_offsets[indices]
+    sizes = target_offsets[indices + 1] - starts
+    offsets = np.concatenate([[0], np.cumsum(sizes)])
+    positions = np.repeat(starts - offsets[:-1], sizes) + np.arange(offsets[-1])
+    return target_items[positions], offsets
+
+class BasketDataset(CartDataset):
+    """Carts with a multi-label target: every item of the next order (see process_baskets)."""
+    
+    def __init__(self, carts, target_items, target_offsets, user_rows=None):
+        super().__init__(carts, None, user_rows)
+        self.target_items = target_items
+        self.target_offsets = target_offsets
+    
+    def __getitem__(self, idx):
+        basket = self.target_items[self.target_offsets[idx]:self.target_offsets[idx + 1]]
+        if self.user_rows is not None:
+            return self.carts[idx], basket, self.user_rows[idx]
+        return self.carts[idx], basket
+    
+    def __getitems__(self, indices):
+        """Like CartDataset.__getitems__, with baskets as a 0-padded (batch, largest basket) matrix."""
+        indices = np.asarray(indices)
+        max_len = max(int(self.lengths[indices].max(initial=0)), 1)
+        items, offsets = select_baskets(self.target_items, self.target_offsets, indices)
+        sizes = np.diff(offsets)
+        baskets = np.zeros((len(indices), max(int(sizes.max(initial=0)), 1)), dtype=self.target_items.dtype)
+        baskets[np.arange(baskets.shape[1]) < sizes[:, None]] = items
+        batch = (self.carts[indices, :max_len], baskets)
+        if self.user_rows is not None:
+            batch += (self.user_rows[indices],)
+        return batch
+
+def basket_loss(logits, baskets):
+    """
+    Multi-label loss over the softmax: the mean negative log-probability of
+    each basket's items, averaged over baskets. Predictions stay a
+    distribution over the catalog, as with next-item training.
+    
+    Args:
+        logits: (batch_size, num_items)
+        baskets: (batch_size, max_basket_size) item indices, 0 = padding
+    """
+    present = (baskets != 0).to(logits.dtype)
+    log_probs = F.log_softmax(logits, dim=-1).gather(1, baskets)
+    return -((log_probs * present).sum(dim=1) / present.sum(dim=1).clamp(min=1)).mean()
 
 def collate_fn(batch):
-    """Collate function to handle variable-length sequences."""
-    carts, next_items = zip(*batch)
-    
-    # Pad sequences
-    max_len = max(len(cart) for cart in carts)
-    padded_carts = []
-    for cart in carts:
-        padded = cart + [0] * (max_len - len(cart))
-        padded_carts.append(padded)
-    
-    return (
-        torch.LongTensor(padded_carts),
-        torch.LongTensor(next_items)
+    """
+    Convert a batch from CartDataset.__getitems__ to tensors.
+    
+    In a DataLoader worker the tensors are written straight into shared
+    memory, so handing the batch to the trainer passes a handle rather
+    than pickling or copying it again.
+    
+    Returns (carts, next_items), plus user rows for personalized datasets
+    and weights for compacted ones.
+    """
+    in_worker = get_worker_info() is not None
+    tensors = []
+    for array in batch:
+        tensor = torch.empty(array.shape, dtype=torch.float32 if array.dtype.kind == 'f' else torch.long)
+        if in_worker:
+            tensor.share_memory_()
+        tensors.append(tensor.copy_(torch.from_numpy(np.ascontiguousarray(array))))
+    return tuple(tensors)
+
+def make_loader(dataset, device, num_workers, prefetch_batches, **kwargs):
+    """
+    DataLoader whose workers prepare upcoming batches while the trainer runs
+    the current step. Workers persist across epochs (no restart and no
+    re-sending the dataset each epoch), and batches are pinned for
+    asynchronous copies to CUDA.
+    """
+    if num_workers > 0:
+        kwargs.update(persistent_workers=True, prefetch_factor=max(prefetch_batches, 1))
+    return DataLoader(
+        dataset,
+        collate_fn=collate_fn,
+        num_workers=num_workers,
+        pin_memory=device.type == 'cuda',
+        **kwargs
     )
 
-def train_epoch(model, dataloader, optimizer, criterion, device):
-    """Train for one epoch."""
+def per_user_temporal_split(user_ids, val_frac=0.2):
+    """
+    Validation mask holding out the last val_frac of each user's examples.
+    
+    Examples must be grouped by user in chronological order, as
+    process_events produces them. Users with a single example stay in training.
+    """
+    _, starts, counts = np.unique(user_ids, return_index=True, return_counts=True)
+    position = np.arange(len(user_ids)) - np.repeat(starts, counts)
+    num_val = np.floor(counts * val_frac).astype(np.int64)
+    return position >= np.repeat(counts - num_val, counts)
+
+def train_val_split(user_ids, personalized=False):
+    """
+    (train, val) indices into the examples cache, as train_instacart.py splits it.
+    
+    Personalized models hold out each user's latest examples, since every
+    user needs training examples to have a vector; otherwise the last 20%
+    of examples are held out. Scripts that evaluate or distill a trained
+    model must use the same split, or its training examples leak into
+    their validation set.
+    """
+    if personalized:
+        is_val = per_user_temporal_split(user_ids)
+        return np.flatnonzero(~is_val), np.flatnonzero(is_val)
+    split_idx = int(0.8 * len(user_ids))
+    return slice(None, split_idx), slice(split_idx, None)
+
+class ResumableRandomSampler(Sampler):
+    """
+    Random sampler whose order is a pure function of (seed, epoch), so an
+    epoch can be resumed part-way through by skipping already-seen samples.
+    """
+    
+    def __init__(self, num_samples, seed=0):
+        self.num_samples = num_samples
+        self.seed = seed
+        self.epoch = 0
+        self.start_index = 0
+    
+    def set_epoch(self, epoch, start_index=0):
+        self.epoch = epoch
+        self.start_index = start_index
+    
+    def __iter__(self):
+        generator = torch.Generator()
+        generator.manual_seed(self.seed + self.epoch)
+        order = torch.randperm(self.num_samples, generator=generator)
+        return iter(order[self.start_index:].tolist())
+    
+    def __len__(self):
+        return self.num_samples - self.start_index
+
+class LengthBucketedBatchSampler(Sampler):
+    """
+    Batch sampler that groups carts of similar length, so batches trimmed
+    to their longest cart carry little padding.
+    
+    Each epoch shuffles all examples, sorts them by length within pools of
+    pool_batches batches, cuts the result into batches and shuffles the
+    batch order. As with ResumableRandomSampler, the order is a pure
+    function of (seed, epoch), so an epoch resumes by skipping batches.
+    """
+    
+    def __init__(self, lengths, batch_size, pool_batches=50, seed=0):
+        self.lengths = np.asarray(lengths)
+        self.batch_size = batch_size
+        self.pool_size = batch_size * pool_batches
+        self.seed = seed
+        self.epoch = 0
+        self.start_batch = 0
+    
+    def set_epoch(self, epoch, start_batch=0):
+        self.epoch = epoch
+        self.start_batch = start_batch
+    
+    def batches(self):
+        """Every batch of the current epoch, as arrays of example indices."""
+        rng = np.random.default_rng((self.seed, self.epoch))
+        order = rng.permutation(len(self.lengths))
+        for start in range(0, len(order), self.pool_size):
+            pool = order[start:start + self.pool_size]
+            # Stable, so equal-length carts keep their random order
+            order[start:start + self.pool_size] = pool[np.argsort(self.lengths[pool], kind='stable')]
+        batches = np.array_split(order, range(self.batch_size, len(order), self.batch_size))
+        return [batches[i] for i in rng.permutation(len(batches))]
+    
+    def __iter__(self):
+        return iter(self.batches()[self.start_batch:])
+    
+    def __len__(self):
+        return (len(self.lengths) + self.batch_size - 1) // self.batch_size - self.start_batch
+
+def padding_fraction(lengths, batches):
+    """Fraction of the (trimmed) batch tensors that is padding."""
+    padded = sum(len(batch) * max(int(lengths[batch].max()), 1) for batch in batches)
+    return 1.0 - lengths.sum() / padded
+
+class GracefulInterrupt:
+    """
+    Turns SIGTERM/SIGINT into a flag so the loop can checkpoint before exiting.
+    
+    A second SIGINT raises KeyboardInterrupt, for when the current step or
+    validation pass should not be waited for. restore() puts the previous
+    handlers back once the training loop is done.
+    """
+    
+    def __init__(self):
+        self.requested = False
+        self.previous = {signum: signal.signal(signum, self._handle) for signum in (signal.SIGTERM, signal.SIGINT)}
+    
+    def _handle(self, signum, frame):
+        if self.requested and signum == signal.SIGINT:
+            raise KeyboardInterrupt
+        print(f"\nReceived signal {signum}, will checkpoint and stop after this step (Ctrl+C again to stop now)")
+        self.requested = True
+    
+    def restore(self):
+        for signum, handler in self.previous.items():
+            signal.signal(signum, handler)
+
+def get_rng_state():
+    """Capture every RNG that affects training."""
+    state = {
+        'python': random.getstate(),
+        'numpy': np.random.get_state(),
+        'torch': torch.get_rng_state(),
+    }
+    if torch.cuda.is_available():
+        state['cuda'] = torch.cuda.get_rng_state_all()
+    return state
+
+def set_rng_state(state):
+    """Restore RNG state captured by get_rng_state."""
+    random.setstate(state['python'])
+    np.random.set_state(state['numpy'])
+    torch.set_rng_state(state['torch'])
+    if 'cuda' in state and torch.cuda.is_available():
+        torch.cuda.set_rng_state_all(state['cuda'])
+
+def save_training_state(path, state):
+    """Atomically write a training checkpoint (write to temp file, then rename)."""
+    os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+    tmp_path = path + '.tmp'
+    torch.save(state, tmp_path)
+    os.replace(tmp_path, path)
+
+# Settings a resumed run must share with the one that wrote the training
+# checkpoint: (key in the checkpoint and args, flag, value in checkpoints
+# written before the key was recorded)
+RESUME_SETTINGS = (
+    ('model_type', '--model-type', 'mlp'),
+    ('hierarchy', '--hierarchy', 'none'),
+    ('qr_buckets', '--qr-buckets', 0),
+    ('personalized', '--personalized', False),
+    ('embedding_dim', '--embedding-dim', None),
+    ('hidden_dim', '--hidden-dim', None),
+    ('max_cart_size', '--max-cart-size', 20),
+    ('batch_size', '--batch-size', None),
+    ('bucket_pool', '--bucket-pool', 0),
+    ('objective', '--objective', 'next-item'),
+    ('compact', '--compact', False),
+)
+
+def check_resume_settings(path, saved, args, num_items):
+    """Exit naming every flag that differs from the run that wrote a training checkpoint."""
+    conflicts = [f"{flag} {saved.get(key, default)} (now {getattr(args, key)})"
+                 for key, flag, default in RESUME_SETTINGS if saved.get(key, default) != getattr(args, key)]
+    if saved['num_items'] != num_items:
+        conflicts.append(f"a vocabulary of {saved['num_items']:,} items (now {num_items:,})")
+    if conflicts:
+        raise SystemExit(f"{path} was written with " + ", ".join(conflicts)
+                         + ". Rerun with the same settings, or without --resume to start over.")
+
+def user_vectors_for(user_table, batch, device, dropout=0.0):
+    """User vectors for a collated batch, or None for non-personalized training."""
+    if user_table is None or len(batch) < 3:
+        return None
+    user_rows = batch[2].to(device, non_blocking=True)
+    if dropout > 0:
+        # Train the no-user path too: unknown users are served with row 0 (zeros)
+        user_rows = user_rows.masked_fill(torch.rand(user_rows.shape, device=device) < dropout, 0)
+    return user_table(user_rows)
+
+def train_epoch(model, dataloader, optimizer, criterion, device,
+                start_step=0, total_steps=None, on_step=None, running=(0.0, 0),
+                user_table=None, user_dropout=0.0):
+    """
+    Train for one epoch.
+    
+    Args:
+        start_step: batches of this epoch already consumed before a resume
+        total_steps: batches in the full epoch (for progress output)
+        on_step: called as on_step(step, loss_sum, num_batches) after every
+            batch; returning True stops the epoch early
+        running: (loss_sum, num_batches) carried over from before a resume
+        user_table: nn.Embedding of user vectors for personalized training
+        user_dropout: fraction of examples trained without their user vector
+    
+    Returns:
+        (average loss, completed, stall) where completed is False if on_step
+        stopped the epoch and stall is the time spent waiting for input batches
+    """
     model.train()
-    total_loss = 0
-    num_batches = 0
+    total_loss, num_batches = running
+    total_steps = total_steps or len(dataloader)
+    weighted = getattr(dataloader.dataset, 'weights', None) is not None
+    stall, window_stall, window_steps, window_start = 0.0, 0.0, 0, time.perf_counter()
     
-    for batch_idx, (carts, next_items) in enumerate(dataloader):
-        carts = carts.to(device)
-        next_items = next_items.to(device)
+    wait_start = time.perf_counter()
+    for batch_idx, batch in enumerate(dataloader, start=start_step):
+        # Time the trainer sat idle waiting for the input pipeline
+        waited = time.perf_counter() - wait_start
+        stall += waited
+        window_stall += waited
+        window_steps += 1
+        
+        carts = batch[0].to(device, non_blocking=True)
+        next_items = batch[1].to(device, non_blocking=True)
+        user_vectors = user_vectors_for(user_table, batch, device, user_dropout)
+        weights = batch[-1].to(device, non_blocking=True) if weighted else None
         
         optimizer.zero_grad()
-        outputs = model(carts)
-        loss = criterion(outputs, next_items)
+        if model.hierarchical:
+            # Scores the target's cluster only, not the whole catalog
+            loss = model.hierarchical_loss(carts, next_items, user_vectors, weights)
+        elif next_items.dim() == 2:
+            loss = basket_loss(model(carts, user_vectors), next_items)
+        elif weights is not None:
+            # Same loss as over the duplicated examples
+            losses = F.cross_entropy(model(carts, user_vectors), next_items, reduction='none')
+            loss = (losses * weights).sum() / weights.sum()
+        else:
+            outputs = model(carts, user_vectors)
+            loss = criterion(outputs, next_items)
         loss.backward()
         optimizer.step()
         
@@ -60,12 +390,24 @@ def train_epoch(model, dataloader, optimizer, criterion, device):
         num_batches += 1
         
         if (batch_idx + 1) % 100 == 0:
-            print(f"  Batch {batch_idx + 1}/{len(dataloader)}, Loss: {loss.item():.4f}")
+            window_time = time.perf_counter() - window_start
+            print(f"  Batch {batch_idx + 1}/{total_steps}, Loss: {loss.item():.4f}, "
+                  f"input stall: {window_stall / window_steps * 1000:.1f} ms/step ({window_stall / window_time * 100:.0f}%)")
+            window_stall, window_steps, window_start = 0.0, 0, time.perf_counter()
+        
+        if on_step is not None and on_step(batch_idx + 1, total_loss, num_batches):
+            return total_loss / max(num_batches, 1), False, stall
+        wait_start = time.perf_counter()
     
-    return total_loss / num_batches
+    return total_loss / max(num_batches, 1), True, stall
 
-def evaluate(model, dataloader, criterion, device, k_values=[1, 5, 10]):
-    """Evaluate the model."""
+def evaluate(model, dataloader, criterion, device, k_values=[1, 5, 10], user_table=None):
+    """
+    Evaluate the model (with user vectors if user_table is given).
+    
+    Accuracy at k is the fraction of examples with a target among the top
+    k predictions: the next item, or any item of the next basket.
+    """
     model.eval()
     total_loss = 0
     num_batches = 0
@@ -75,19 +417,26 @@ def evaluate(model, dataloader, criterion, device, k_values=[1, 5, 10]):
     total = 0
     
     with torch.no_grad():
-        for carts, next_items in dataloader:
-            carts = carts.to(device)
-            next_items = next_items.to(device)
+        for batch in dataloader:
+            carts = batch[0].to(device)
+            next_items = batch[1].to(device)
             
-            outputs = model(carts)
-            loss = criterion(outputs, next_items)
+            outputs = model(carts, user_vectors_for(user_table, batch, device))
+            if next_items.dim() == 2:
+                loss = basket_loss(outputs, next_items)
+                # Padding never counts as a hit
+                targets = next_items.masked_fill(next_items == 0, -1)
+            else:
+                loss = criterion(outputs, next_items)
+                targets = next_items.unsqueeze(1)
             total_loss += loss.item()
             num_batches += 1
             
             # Calculate top-k accuracy
             for k in k_values:
                 _, top_k_preds = outputs.topk(k, dim=1)
-                correct_at_k[k] += (top_k_preds == next_items.unsqueeze(1)).any(dim=1).sum().item()
+                hits = top_k_preds.unsqueeze(2) == targets.unsqueeze(1)
+                correct_at_k[k] += hits.flatten(1).any(dim=1).sum().item()
             
             total += next_items.size(0)
     
@@ -96,20 +445,175 @@ def evaluate(model, dataloader, criterion, device, k_values=[1, 5, 10]):
     
     return avg_loss, accuracy_at_k
 
+def compare_beam_search(model, dataloader, device, beam_widths=(1, 2, 4, 8), k_values=(1, 5, 10)):
+    """Top-k accuracy and time per batch of exact scoring vs beam search (hierarchical models)."""
+    model.eval()
+    max_k = max(k_values)
+    
+    def run(top_k):
+        correct = {k: 0 for k in k_values}
+        total, elapsed = 0, 0.0
+        with torch.no_grad():
+            for batch in dataloader:
+                carts, next_items = batch[0].to(device), batch[1].to(device)
+                start = time.perf_counter()
+                top_items = top_k(carts)
+                elapsed += time.perf_counter() - start
+                for k in k_values:
+                    correct[k] += (top_items[:, :k] == next_items.unsqueeze(1)).any(dim=1).sum().item()
+                total += len(next_items)
+        return {k: correct[k] / total for k in k_values}, elapsed * 1000 / len(dataloader)
+    
+    print("\nExact vs beam-search top-k (validation split):")
+    accuracy, ms = run(lambda carts: model.predict_top_k(carts, k=max_k)[0])
+    print(f"  exact     {ms:8.2f} ms/batch  " + "  ".join(f"top-{k} {accuracy[k]*100:.2f}%" for k in k_values))
+    for beam in beam_widths:
+        accuracy, ms = run(lambda carts: model.beam_top_k(model.cart_vector(carts), max_k, beam)[0])
+        print(f"  beam {beam:<4d} {ms:8.2f} ms/batch  " + "  ".join(f"top-{k} {accuracy[k]*100:.2f}%" for k in k_values))
+
+def compare_objectives(model, baseline_path, dataloader, criterion, device, num_items, k_values=(1, 5, 10)):
+    """Hit@k on the basket validation split of this model vs a next-item checkpoint."""
+    checkpoint = load_checkpoint(baseline_path, map_location=device)
+    if checkpoint['num_items'] != num_items:
+        raise ValueError(f"{baseline_path} was trained with a different vocabulary")
+    baseline = build_model_from_checkpoint(checkpoint).to(device)
+    
+    print("\n" + "="*60)
+    print("Basket vs next-item objective (Hit@k on next baskets)")
+    print("="*60)
+    for name, candidate in (('basket', model), (checkpoint.get('objective', 'next-item'), baseline)):
+        _, hit_at_k = evaluate(candidate, dataloader, criterion, device, k_values=k_values)
+        print(f"{name:>10}: " + ", ".join(f"Hit@{k}: {hit_at_k[k]*100:.2f}%" for k in k_values))
+
+def item_clusters_for(preprocessor, hierarchy):
+    """Aisle or department code per item index; items without metadata share one extra cluster."""
+    vocabulary = CompactVocabulary.from_dict({
+        'num_items': preprocessor.num_items,
+        'idx_to_item': preprocessor.idx_to_item,
+        'product_info': preprocessor.product_info,
+    })
+    codes = np.asarray(vocabulary.aisle_codes if hierarchy == 'aisle' else vocabulary.department_codes)
+    return np.where(codes < 0, codes.max() + 1, codes)
+
+def load_examples(preprocessor, args):
+    """
+    Load processed examples from the cache, or run preprocessing and fill it.
+    
+    Returns:
+        (carts, next_items, user_ids, target_offsets); for --objective basket
+        next_items holds every basket's items back to back and
+        target_offsets their boundaries, otherwise target_offsets is None
+    """
+    # Preprocessing rebuilds the vocabulary from the data, so the cached
+    # item_ids can differ from the pickle's; the pickle is keyed separately
+    params = {
+        'data_dir': os.path.abspath(args.data_dir),
+        'source_vocabulary': vocabulary_fingerprint(preprocessor.item_ids()),
+        'sample_frac': args.sample_frac,
+        'min_product_count': args.min_product_count,
+        'max_cart_size': args.max_cart_size,
+        'seed': args.seed,
+    }
+    cache_path = args.examples_cache
+    if args.objective == 'basket' and cache_path:
+        # Kept next to the next-item cache rather than overwriting it
+        params['objective'] = 'basket'
+        cache_path = os.path.splitext(cache_path)[0] + '_basket.npz'
+    if cache_path and os.path.exists(cache_path):
+        cached = preprocessor.load_examples(cache_path, params)
+        if cached is not None:
+            carts, _, next_items, user_ids, target_offsets = cached
+            return carts, next_items, user_ids, target_offsets
+    
+    print("\n" + "="*60)
+    print("Processing Instacart Orders")
+    print("="*60)
+    target_offsets = None
+    if args.objective == 'basket':
+        carts, baskets, user_ids = preprocessor.process_baskets(
+            args.data_dir,
+            max_cart_size=args.max_cart_size,
+            sample_frac=args.sample_frac,
+            min_product_count=args.min_product_count
+        )
+        target_offsets = np.concatenate([[0], np.cumsum([len(basket) for basket in baskets])]).astype(np.int64)
+        next_items = np.fromiter(chain.from_iterable(baskets), dtype=np.int32, count=int(target_offsets[-1]))
+    else:
+        carts, next_items, user_ids = preprocessor.process_events(
+            args.data_dir,
+            max_cart_size=args.max_cart_size,
+            sample_frac=args.sample_frac,
+            min_product_count=args.min_product_count
+        )
+        next_items = np.asarray(next_items, dtype=np.int32)
+    carts, lengths = carts_to_matrix(carts, args.max_cart_size)
+    user_ids = np.asarray(user_ids, dtype=np.int64)
+    
+    if cache_path:
+        preprocessor.save_examples(cache_path, carts, lengths, next_items, user_ids, params,
+                                   target_offsets=target_offsets)
+    
+    return carts, next_items, user_ids, target_offsets
+
 def main():
-    # Configuration
-    data_dir = '../data'
-    vocab_path = './models/vocabulary.pkl'
-    model_save_path = './models/best_model.pt'
-    
-    # Hyperparameters - optimized for speed and accuracy
-    embedding_dim = 512
-    hidden_dim = 1024
-    batch_size = 4096    # Even larger batches for speed
-    learning_rate = 0.001
-    num_epochs = 8  # Fewer epochs, faster training
-    sample_frac = 1.0
-    min_product_count = 5000
+    parser = argparse.ArgumentParser(description="Train next-item prediction model on Instacart")
+    parser.add_argument("--data-dir", type=str, default="../data", help="Directory with Instacart CSVs")
+    parser.add_argument("--vocab-path", type=str, default="./models/vocabulary.pkl", help="Vocabulary pickle")
+    parser.add_argument("--model-save-path", type=str, default="./models/best_model.pt", help="Best model output path")
+    parser.add_argument("--examples-cache", type=str, default="./models/examples_cache.npz",
+                        help="Cache of processed examples ('' to disable)")
+    parser.add_argument("--model-type", type=str, default="mlp", choices=sorted(MODEL_TYPES),
+                        help="Cart encoder: mlp (mean pooling) or gru (order-aware sequence model)")
+    parser.add_argument("--objective", type=str, default="next-item", choices=["next-item", "basket"],
+                        help="One example per cart position (next-item) or per order with a multi-label target (basket)")
+    parser.add_argument("--baseline-model", type=str, default=None,
+                        help="With --objective basket, a next-item checkpoint to compare Hit@k against")
+    parser.add_argument("--compact", action="store_true",
+                        help="Train on unique (cart, next item) examples weighted by their count")
+    parser.add_argument("--hierarchy", type=str, default="none", choices=["none", "aisle", "department"],
+                        help="Output layer: flat softmax (none) or two-level by aisle or department; "
+                             "the latter also compares exact and beam-search top-k at the end")
+    parser.add_argument("--qr-buckets", type=int, default=0,
+                        help="Compress item embeddings and the tied output layer into quotient-remainder "
+                             "tables with this many buckets, e.g. ~sqrt(num items) (0 = dense)")
+    parser.add_argument("--embedding-dim", type=int, default=512, help="Embedding dimension")
+    parser.add_argument("--hidden-dim", type=int, default=1024, help="Hidden layer dimension")
+    parser.add_argument("--batch-size", type=int, default=4096, help="Batch size")
+    parser.add_argument("--lr", type=float, default=0.001, help="Learning rate")
+    parser.add_argument("--epochs", type=int, default=8, help="Maximum number of epochs")
+    parser.add_argument("--sample-frac", type=float, default=1.0, help="Fraction of users to use")
+    parser.add_argument("--min-product-count", type=int, default=5000, help="Minimum product frequency")
+    parser.add_argument("--max-cart-size", type=int, default=20, help="Maximum cart size")
+    parser.add_argument("--num-workers", type=int, default=2, help="DataLoader workers")
+    parser.add_argument("--prefetch-batches", type=int, default=4, help="Batches each DataLoader worker prepares ahead")
+    parser.add_argument("--bucket-pool", type=int, default=50,
+                        help="Batch carts of similar length, sorting within pools of N batches (0 = random batches)")
+    parser.add_argument("--seed", type=int, default=42, help="Random seed")
+    parser.add_argument("--checkpoint-dir", type=str, default="./models/checkpoints", help="Training checkpoint directory")
+    parser.add_argument("--checkpoint-every", type=int, default=500, help="Checkpoint every N steps (0 = only at epoch end)")
+    parser.add_argument("--resume", action="store_true",
+                        help="Continue mid-epoch from the latest checkpoint (model, optimizer, RNG and data position)")
+    parser.add_argument("--patience", type=int, default=0,
+                        help="Stop after N epochs without val loss improvement (0 = disabled)")
+    parser.add_argument("--min-delta", type=float, default=0.0, help="Minimum val loss decrease counted as improvement")
+    parser.add_argument("--personalized", action="store_true",
+                        help="Learn per-user vectors and export them as a user store; validation then "
+                             "holds out each user's latest examples")
+    parser.add_argument("--user-dropout", type=float, default=0.2,
+                        help="Fraction of examples trained without their user vector (personalized)")
+    parser.add_argument("--user-store-path", type=str, default="./models/user_store",
+                        help="User store output directory (personalized)")
+    args = parser.parse_args()
+    if args.qr_buckets and args.hierarchy != 'none':
+        parser.error("--qr-buckets needs the flat output layer (--hierarchy none)")
+    if args.objective == 'basket' and args.hierarchy != 'none':
+        parser.error("--objective basket needs the flat output layer (--hierarchy none)")
+    if args.compact and (args.personalized or args.objective == 'basket'):
+        parser.error("--compact applies to non-personalized next-item training only")
+    
+    random.seed(args.seed)
+    np.random.seed(args.seed)
+    torch.manual_seed(args.seed)
     
     # Use MPS (Metal Performance Shaders) for M-series Macs
     if torch.backends.mps.is_available():
@@ -123,113 +627,267 @@ def main():
     # Load or create preprocessor
     preprocessor = InstacartPreprocessor()
     
-    if os.path.exists(vocab_path):
-        print(f"Loading vocabulary from {vocab_path}...")
-        preprocessor.load_vocabulary(vocab_path)
+    if os.path.exists(args.vocab_path):
+        print(f"Loading vocabulary from {args.vocab_path}...")
+        preprocessor.load_vocabulary(args.vocab_path)
     else:
         print("Vocabulary not found. Please run generate_vocab_instacart.py first.")
         return
     
-    # Process events
-    print("\n" + "="*60)
-    print("Processing Instacart Orders")
-    print("="*60)
-    carts, next_items, user_ids = preprocessor.process_events(
-        data_dir,
-        sample_frac=sample_frac,
-        min_product_count=min_product_count
-    )
+    carts, next_items, user_ids, target_offsets = load_examples(preprocessor, args)
     
-    # Split into train/val
-    split_idx = int(0.8 * len(carts))
-    train_carts = carts[:split_idx]
-    train_next_items = next_items[:split_idx]
-    val_carts = carts[split_idx:]
-    val_next_items = next_items[split_idx:]
+    def subset(indices, rows=None):
+        if target_offsets is None:
+            return CartDataset(carts[indices], next_items[indices], rows)
+        items, offsets = select_baskets(next_items, target_offsets, np.arange(len(carts))[indices])
+        return BasketDataset(carts[indices], items, offsets, rows)
     
-    print(f"\nTrain examples: {len(train_carts):,}")
-    print(f"Val examples: {len(val_carts):,}")
+    train_idx, val_idx = train_val_split(user_ids, args.personalized)
+    if args.personalized:
+        unique_users, user_rows = np.unique(user_ids, return_inverse=True)
+        user_rows = (user_rows + 1).astype(np.int64)  # row 0 = unknown user
+        train_dataset = subset(train_idx, user_rows[train_idx])
+        val_dataset = subset(val_idx, user_rows[val_idx])
+        print(f"\nUsers: {len(unique_users):,}")
+    else:
+        train_dataset = subset(train_idx)
+        val_dataset = subset(val_idx)
+        if args.compact:
+            # Validation stays as is, so accuracy is comparable to uncompacted runs
+            train_carts, train_next_items, counts = compact_examples(
+                train_dataset.carts, train_dataset.next_items,
+                order_invariant=MODEL_TYPES[args.model_type].order_invariant)
+            print(f"\nCompacted {len(train_dataset):,} training examples to {len(counts):,} unique ones "
+                  f"({len(counts) / len(train_dataset) * 100:.1f}%)")
+            train_dataset = CartDataset(train_carts, train_next_items, weights=counts)
     
-    # Create datasets
-    train_dataset = CartDataset(train_carts, train_next_items)
-    val_dataset = CartDataset(val_carts, val_next_items)
+    print(f"\nTrain examples: {len(train_dataset):,}")
+    print(f"Val examples: {len(val_dataset):,}")
     
-    train_loader = DataLoader(
-        train_dataset,
-        batch_size=batch_size,
-        shuffle=True,
-        collate_fn=collate_fn,
-        num_workers=2
-    )
-    val_loader = DataLoader(
-        val_dataset,
-        batch_size=batch_size,
-        shuffle=False,
-        collate_fn=collate_fn,
-        num_workers=2
-    )
+    random_sampler = ResumableRandomSampler(len(train_dataset), seed=args.seed)
+    if args.bucket_pool > 0:
+        train_sampler = LengthBucketedBatchSampler(train_dataset.lengths, args.batch_size,
+                                                   pool_batches=args.bucket_pool, seed=args.seed)
+        train_loader = make_loader(train_dataset, device, args.num_workers, args.prefetch_batches,
+                                   batch_sampler=train_sampler)
+        random_batches = np.array_split(np.fromiter(random_sampler, dtype=np.int64),
+                                        range(args.batch_size, len(train_dataset), args.batch_size))
+        print(f"Padding per epoch: {padding_fraction(train_dataset.lengths, random_batches)*100:.1f}% with random batches, "
+              f"{padding_fraction(train_dataset.lengths, train_sampler.batches())*100:.1f}% with length buckets")
+    else:
+        train_sampler = random_sampler
+        train_loader = make_loader(train_dataset, device, args.num_workers, args.prefetch_batches,
+                                   batch_size=args.batch_size, sampler=train_sampler)
+    val_loader = make_loader(val_dataset, device, args.num_workers, args.prefetch_batches,
+                             batch_size=args.batch_size, shuffle=False)
+    steps_per_epoch = (len(train_dataset) + args.batch_size - 1) // args.batch_size
     
     # Create model
     print("\n" + "="*60)
     print("Initializing Model")
     print("="*60)
-    model = NextItemPredictor(
+    item_clusters = None
+    if args.hierarchy != 'none':
+        item_clusters = item_clusters_for(preprocessor, args.hierarchy)
+    model = build_model(
+        args.model_type,
         num_items=preprocessor.num_items,
-        embedding_dim=embedding_dim,
-        hidden_dim=hidden_dim
+        embedding_dim=args.embedding_dim,
+        hidden_dim=args.hidden_dim,
+        max_cart_size=args.max_cart_size,
+        item_clusters=item_clusters,
+        qr_buckets=args.qr_buckets
     ).to(device)
     
     num_params = sum(p.numel() for p in model.parameters())
-    print(f"Model has {num_params:,} parameters")
+    print(f"{type(model).__name__} ({args.model_type}) has {num_params:,} parameters")
+    if model.hierarchical:
+        sizes = np.bincount(item_clusters)
+        print(f"Hierarchical output: {len(sizes)} {args.hierarchy} clusters, largest {sizes.max()} items")
+    if model.compressed:
+        item_params = sum(p.numel() for p in model.item_embeddings.parameters())
+        print(f"Compressed item tables: {item_params:,} parameters for {preprocessor.num_items:,} items "
+              f"({args.qr_buckets} buckets)")
+    
+    # Per-user vectors live outside the model, so the checkpoint stays a
+    # plain model and the table can be served memory-mapped
+    user_table = None
+    parameters = list(model.parameters())
+    if args.personalized:
+        user_table = nn.Embedding(len(unique_users) + 1, args.embedding_dim, padding_idx=0).to(device)
+        nn.init.normal_(user_table.weight, std=0.01)
+        with torch.no_grad():
+            user_table.weight[0].zero_()
+        parameters += list(user_table.parameters())
+        print(f"User table has {user_table.weight.numel():,} parameters")
     
     criterion = nn.CrossEntropyLoss()
-    optimizer = torch.optim.Adam(model.parameters(), lr=learning_rate)
+    optimizer = torch.optim.Adam(parameters, lr=args.lr)
+    
+    # Training state (everything needed to continue mid-epoch)
+    state = {
+        'epoch': 0,
+        'step_in_epoch': 0,
+        'global_step': 0,
+        'epoch_loss_sum': 0.0,
+        'epoch_batches': 0,
+        'best_val_loss': float('inf'),
+        'best_val_accuracy': {},
+        'epochs_without_improvement': 0,
+        # Ties the exported user store to the checkpoint it was trained with
+        'user_store_id': uuid.uuid4().hex if args.personalized else None,
+    }
+    checkpoint_path = os.path.join(args.checkpoint_dir, 'last.ckpt')
+    
+    if args.resume and os.path.exists(checkpoint_path):
+        print(f"\nResuming from {checkpoint_path}...")
+        saved = torch.load(checkpoint_path, map_location=device, weights_only=False)
+        check_resume_settings(checkpoint_path, saved, args, preprocessor.num_items)
+        model.load_state_dict(saved['model_state_dict'])
+        if user_table is not None:
+            user_table.load_state_dict(saved['user_table_state_dict'])
+        optimizer.load_state_dict(saved['optimizer_state_dict'])
+        set_rng_state(saved['rng_state'])
+        state = saved['training_state']
+        print(f"  Epoch {state['epoch'] + 1}, step {state['step_in_epoch']}/{steps_per_epoch}")
+    elif args.resume:
+        print(f"\nNo checkpoint at {checkpoint_path}, starting from scratch")
+    
+    def write_checkpoint():
+        save_training_state(checkpoint_path, {
+            'model_state_dict': model.state_dict(),
+            'user_table_state_dict': user_table.state_dict() if user_table is not None else None,
+            'optimizer_state_dict': optimizer.state_dict(),
+            'rng_state': get_rng_state(),
+            'training_state': state,
+            'num_items': preprocessor.num_items,
+            **{key: getattr(args, key) for key, _, _ in RESUME_SETTINGS},
+        })
+    
+    interrupt = GracefulInterrupt()
+    
+    def on_step(step, loss_sum, num_batches):
+        state['step_in_epoch'] = step
+        state['global_step'] += 1
+        state['epoch_loss_sum'] = loss_sum
+        state['epoch_batches'] = num_batches
+        if interrupt.requested or (args.checkpoint_every and state['global_step'] % args.checkpoint_every == 0):
+            write_checkpoint()
+            if interrupt.requested:
+                print(f"✓ Saved checkpoint at epoch {state['epoch'] + 1}, step {step}")
+                return True
+        return False
     
     # Training loop
     print("\n" + "="*60)
     print("Training")
     print("="*60)
     
-    best_val_loss = float('inf')
-    best_val_accuracy = {}
-    
-    for epoch in range(num_epochs):
-        print(f"\nEpoch {epoch + 1}/{num_epochs}")
+    while state['epoch'] < args.epochs:
+        epoch = state['epoch']
+        print(f"\nEpoch {epoch + 1}/{args.epochs}")
         print("-" * 60)
         
+        start_step = state['step_in_epoch']
+        if args.bucket_pool > 0:
+            train_sampler.set_epoch(epoch, start_batch=start_step)
+        else:
+            train_sampler.set_epoch(epoch, start_index=start_step * args.batch_size)
+        
         start_time = time.time()
-        train_loss = train_epoch(model, train_loader, optimizer, criterion, device)
+        train_loss, completed, stall = train_epoch(
+            model, train_loader, optimizer, criterion, device,
+            start_step=start_step,
+            total_steps=steps_per_epoch,
+            on_step=on_step,
+            running=(state['epoch_loss_sum'], state['epoch_batches']),
+            user_table=user_table,
+            user_dropout=args.user_dropout
+        )
         epoch_time = time.time() - start_time
         
-        print(f"Train loss: {train_loss:.4f}, Time: {epoch_time:.2f}s")
+        if not completed:
+            print(f"Stopped mid-epoch; rerun with --resume to continue")
+            return
+        
+        num_examples = len(train_dataset) - min(start_step * args.batch_size, len(train_dataset))
+        print(f"Train loss: {train_loss:.4f}, Time: {epoch_time:.2f}s ({num_examples / epoch_time:,.0f} examples/s, "
+              f"{stall / epoch_time * 100:.0f}% waiting for input)")
         
         # Validation
-        val_loss, val_accuracy = evaluate(model, val_loader, criterion, device)
+        val_loss, val_accuracy = evaluate(model, val_loader, criterion, device, user_table=user_table)
         print(f"Val loss: {val_loss:.4f}")
         print(f"Val accuracy - Top-1: {val_accuracy[1]*100:.2f}%, Top-5: {val_accuracy[5]*100:.2f}%, Top-10: {val_accuracy[10]*100:.2f}%")
+        if user_table is not None:
+            # What unknown users get: the same model without a user vector
+            fallback_loss, fallback_accuracy = evaluate(model, val_loader, criterion, device)
+            print(f"Without user vectors - loss: {fallback_loss:.4f}, Top-1: {fallback_accuracy[1]*100:.2f}%, "
+                  f"Top-5: {fallback_accuracy[5]*100:.2f}%, Top-10: {fallback_accuracy[10]*100:.2f}%")
         
         # Save best model
-        if val_loss < best_val_loss:
-            best_val_loss = val_loss
-            best_val_accuracy = val_accuracy
+        if val_loss < state['best_val_loss'] - args.min_delta:
+            state['best_val_loss'] = val_loss
+            state['best_val_accuracy'] = val_accuracy
+            state['epochs_without_improvement'] = 0
             checkpoint = {
                 'model_state_dict': model.state_dict(),
                 'val_loss': val_loss,
                 'val_accuracy': val_accuracy,
+                'model_type': args.model_type,
+                'hierarchy': args.hierarchy,
+                'objective': args.objective,
                 'num_items': preprocessor.num_items,
-                'embedding_dim': embedding_dim,
-                'hidden_dim': hidden_dim,
+                'embedding_dim': args.embedding_dim,
+                'hidden_dim': args.hidden_dim,
+                'max_cart_size': args.max_cart_size,
+                'personalized': args.personalized,
                 'epoch': epoch + 1
             }
-            torch.save(checkpoint, model_save_path)
+            if user_table is not None:
+                user_store = UserStore.build(unique_users, user_table.weight.detach().cpu().numpy(),
+                                             state['user_store_id'])
+                user_store.save(args.user_store_path)
+                # Resolved relative to the checkpoint's directory when serving
+                checkpoint['user_store'] = os.path.relpath(
+                    os.path.abspath(args.user_store_path),
+                    os.path.dirname(os.path.abspath(args.model_save_path)))
+                checkpoint['user_store_id'] = state['user_store_id']
+            # Also written as best_model.safetensors, which the API memory-maps
+            save_checkpoint(checkpoint, args.model_save_path)
             print(f"✓ Saved best model (val_loss: {val_loss:.4f})")
+        else:
+            state['epochs_without_improvement'] += 1
+            print(f"No improvement for {state['epochs_without_improvement']} epoch(s)")
+        
+        state['epoch'] = epoch + 1
+        state['step_in_epoch'] = 0
+        state['epoch_loss_sum'] = 0.0
+        state['epoch_batches'] = 0
+        write_checkpoint()
+        
+        if args.patience and state['epochs_without_improvement'] >= args.patience:
+            print(f"Early stopping: val loss has not improved for {args.patience} epochs")
+            break
+        if interrupt.requested:
+            print("Stopped after epoch; rerun with --resume to continue")
+            return
+    interrupt.restore()
     
+    best_val_accuracy = state['best_val_accuracy']
     print("\n" + "="*60)
     print("Training Complete!")
     print("="*60)
-    print(f"Best validation loss: {best_val_loss:.4f}")
-    print(f"Best accuracy - Top-1: {best_val_accuracy[1]*100:.2f}%, Top-5: {best_val_accuracy[5]*100:.2f}%, Top-10: {best_val_accuracy[10]*100:.2f}%")
-    print(f"Model saved to: {model_save_path}")
+    print(f"Best validation loss: {state['best_val_loss']:.4f}")
+    if best_val_accuracy:
+        print(f"Best accuracy - Top-1: {best_val_accuracy[1]*100:.2f}%, Top-5: {best_val_accuracy[5]*100:.2f}%, Top-10: {best_val_accuracy[10]*100:.2f}%")
+    print(f"Model saved to: {args.model_save_path}")
+    
+    if model.hierarchical:
+        model.load_state_dict(load_checkpoint(args.model_save_path, map_location=device)['model_state_dict'])
+        compare_beam_search(model, val_loader, device)
+    if args.baseline_model and args.objective == 'basket':
+        model.load_state_dict(load_checkpoint(args.model_save_path, map_location=device)['model_state_dict'])
+        compare_objectives(model, args.baseline_model, val_loader, criterion, device, preprocessor.num_items)
 
 if __name__ == '__main__':
     main()
@@ -0,0 +1,121 @@
+"""
+Memory-mapped user-embedding table for personalized predictions.
+
+train_instacart.py --personalized learns one vector per Instacart user
+alongside the model and exports them here:
+
+    models/user_store/
+        meta.json        num_users, embedding_dim, store_id (matches the checkpoint)
+        vectors.npy      float32 (num_users+1, embedding_dim)  row 0 = unknown user (zeros)
+        user_ids.npy     int64   (num_users,)  user id of rows 1..num_users, ascending
+        dense_index.npy  int32   (max_user_id+1,)  user id -> row, 0 = unknown; optional
+
+At serving time the user's vector is added to the mean-pooled cart vector
+(NextItemPredictor.forward's user_vectors). Users without a row skip that
+addition, so they get exactly the non-personalized forward pass.
+"""
+
+import json
+import os
+from typing import Optional
+
+import numpy as np
+
+
+FORMAT_VERSION = 1
+
+# Build the O(1) dense user id -> row table only while it stays small
+MAX_DENSE_INDEX_SIZE = 1 << 26
+
+
+class UserStore:
+    """User id -> embedding row lookups over memory-mapped arrays."""
+    
+    def __init__(self, vectors: np.ndarray, user_ids: np.ndarray, dense_index: Optional[np.ndarray], meta: dict):
+        self.meta = meta
+        self.num_users = int(meta['num_users'])
+        self.embedding_dim = int(meta['embedding_dim'])
+        self.store_id = meta.get('store_id')
+        self.vectors = vectors
+        self.user_ids = user_ids
+        self.dense_index = dense_index
+    
+    @classmethod
+    def build(cls, user_ids: np.ndarray, vectors: np.ndarray, store_id: str) -> 'UserStore':
+        """
+        Args:
+            user_ids: (num_users,) ascending user ids of rows 1..num_users
+            vectors: (num_users+1, embedding_dim) with row 0 for unknown users
+        """
+        user_ids = np.asarray(user_ids, dtype=np.int64)
+        dense_index = None
+        if len(user_ids) and 0 <= user_ids[0] and user_ids[-1] < MAX_DENSE_INDEX_SIZE:
+            dense_index = np.zeros(int(user_ids[-1]) + 1, dtype=np.int32)
+            dense_index[user_ids] = np.arange(1, len(user_ids) + 1, dtype=np.int32)
+        meta = {
+            'format_version': FORMAT_VERSION,
+            'num_users': len(user_ids),
+            'embedding_dim': int(vectors.shape[1]),
+            'store_id': store_id,
+        }
+        return cls(np.asarray(vectors, dtype=np.float32), user_ids, dense_index, meta)
+    
+    @classmethod
+    def load(cls, directory: str, mmap: bool = True) -> 'UserStore':
+        with open(os.path.join(directory, 'meta.json')) as f:
+            meta = json.load(f)
+        if meta.get('format_version') != FORMAT_VERSION:
+            raise ValueError(f"Unsupported user store format: {meta.get('format_version')}")
+        
+        mmap_mode = 'r' if mmap else None
+        dense_path = os.path.join(directory, 'dense_index.npy')
+        return cls(
+            np.load(os.path.join(directory, 'vectors.npy'), mmap_mode=mmap_mode),
+            np.load(os.path.join(directory, 'user_ids.npy'), mmap_mode=mmap_mode),
+            np.load(dense_path, mmap_mode=mmap_mode) if os.path.exists(dense_path) else None,
+            meta,
+        )
+    
+    def save(self, directory: str):
+        """Write to a temporary sibling directory, then swap it in."""
+        tmp_dir = directory.rstrip('/') + '.tmp'
+        os.makedirs(tmp_dir, exist_ok=True)
+        np.save(os.path.join(tmp_dir, 'vectors.npy'), self.vectors)
+        np.save(os.path.join(tmp_dir, 'user_ids.npy'), self.user_ids)
+        dense_path = os.path.join(tmp_dir, 'dense_index.npy')
+        if self.dense_index is not None:
+            np.save(dense_path, self.dense_index)
+        elif os.path.exists(dense_path):
+            os.remove(dense_path)
+        with open(os.path.join(tmp_dir, 'meta.json'), 'w') as f:
+            json.dump(self.meta, f)
+        
+        if os.path.isdir(directory):
+            old_dir = directory.rstrip('/') + '.old'
+            os.replace(directory, old_dir)
+            os.replace(tmp_dir, directory)
+            for filename in os.listdir(old_dir):
+                os.remove(os.path.join(old_dir, filename))
+            os.rmdir(old_dir)
+        else:
+            os.replace(tmp_dir, directory)
+    
+    def row(self, user_id) -> int:
+        """Embedding row for a user id (int or numeric string), 0 if unknown."""
+        try:
+            user_id = int(user_id)
+        except (TypeError, ValueError):
+            return 0
+        if not 0 <= user_id < 2 ** 63:
+            return 0
+        if self.dense_index is not None:
+            if user_id < len(self.dense_index):
+                return int(self.dense_index[user_id])
+            return 0
+        position = int(np.searchsorted(self.user_ids, user_id))
+        if position < len(self.user_ids) and self.user_ids[position] == user_id:
+            return position + 1
+        return 0
+    
+    def vector(self, row: int) -> np.ndarray:
+        return self.vectors[row]
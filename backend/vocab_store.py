@@ -0,0 +1,289 @@
+"""
+Compact, memory-mappable vocabulary for serving.
+
+The training pipeline writes vocabulary.pkl: Python dicts item_to_idx,
+idx_to_item and a nested product_info dict for every Instacart product.
+Unpickling it costs every API worker time and per-object memory, so the
+server uses this columnar format instead:
+
+    models/vocabulary/
+        meta.json            num_items, aisle/department name tables,
+                             fingerprint of the vocabulary.pkl it came from
+        item_ids.npy         int64  (num_items,)   idx -> product id (0 = padding)
+        sorted_ids.npy       int64  (num_items-1,) product ids, ascending
+        sorted_idx.npy       int32  (num_items-1,) idx of each sorted id
+        dense_index.npy      int32  (max_id+1,)    product id -> idx, optional
+        name_offsets.npy     int64  (num_items+1,) byte offsets into names.bin
+        names.bin            utf-8 product names, concatenated
+        aisle_codes.npy      int32  (num_items,)   index into meta aisles, -1 = unknown
+        department_codes.npy int32  (num_items,)   index into meta departments, -1 = unknown
+        aisle_ids.npy        int32  (num_items,)   Instacart aisle_id, 0 = unknown
+        department_ids.npy   int32  (num_items,)   Instacart department_id, 0 = unknown
+
+Arrays are opened with mmap_mode='r', so loading is near-instant and the
+pages are shared through the OS page cache by every worker process. A
+directory that no longer matches its vocabulary.pkl (preprocessing was
+rerun without converting again) is ignored in favour of the pickle, since
+its item indices would no longer match the model's.
+"""
+
+import hashlib
+import json
+import os
+import pickle
+from typing import Dict, Iterable, Optional
+
+import numpy as np
+
+
+FORMAT_VERSION = 1
+
+# Build the O(1) dense id -> idx table only while it stays small
+MAX_DENSE_INDEX_SIZE = 1 << 24
+
+
+class CompactVocabulary:
+    """Item vocabulary and product metadata stored as flat numpy arrays."""
+    
+    def __init__(self, arrays: Dict[str, np.ndarray], meta: Dict):
+        self.meta = meta
+        self.num_items = int(meta['num_items'])
+        self.aisles = meta['aisles']
+        self.departments = meta['departments']
+        
+        self.item_ids = arrays['item_ids']
+        self.sorted_ids = arrays['sorted_ids']
+        self.sorted_idx = arrays['sorted_idx']
+        self.dense_index = arrays.get('dense_index')
+        self.name_offsets = arrays['name_offsets']
+        self.names = arrays['names']
+        self.aisle_codes = arrays['aisle_codes']
+        self.department_codes = arrays['department_codes']
+        self.aisle_ids = arrays['aisle_ids']
+        self.department_ids = arrays['department_ids']
+    
+    @classmethod
+    def from_dict(cls, vocab_data: Dict) -> 'CompactVocabulary':
+        """Build from the dict stored in vocabulary.pkl."""
+        num_items = int(vocab_data['num_items'])
+        idx_to_item = vocab_data['idx_to_item']
+        product_info = vocab_data.get('product_info', {})
+        
+        item_ids = np.zeros(num_items, dtype=np.int64)
+        for idx in range(1, num_items):
+            item_ids[idx] = int(idx_to_item[idx])
+        
+        order = np.argsort(item_ids[1:], kind='stable')
+        sorted_ids = item_ids[1:][order]
+        sorted_idx = (order + 1).astype(np.int32)
+        
+        arrays = {
+            'item_ids': item_ids,
+            'sorted_ids': sorted_ids,
+            'sorted_idx': sorted_idx,
+        }
+        
+        if len(sorted_ids) and sorted_ids[0] >= 0 and sorted_ids[-1] < MAX_DENSE_INDEX_SIZE:
+            dense_index = np.zeros(int(sorted_ids[-1]) + 1, dtype=np.int32)
+            dense_index[sorted_ids] = sorted_idx
+            arrays['dense_index'] = dense_index
+        
+        # Columnar metadata aligned with item indices
+        aisles, departments = [], []
+        aisle_lookup, department_lookup = {}, {}
+        encoded_names = []
+        aisle_codes = np.full(num_items, -1, dtype=np.int32)
+        department_codes = np.full(num_items, -1, dtype=np.int32)
+        aisle_ids = np.zeros(num_items, dtype=np.int32)
+        department_ids = np.zeros(num_items, dtype=np.int32)
+        
+        for idx in range(num_items):
+            info = product_info.get(int(item_ids[idx]), {}) if idx > 0 else {}
+            encoded_names.append(info.get('name', '').encode('utf-8'))
+            
+            aisle = info.get('aisle')
+            if aisle:
+                if aisle not in aisle_lookup:
+                    aisle_lookup[aisle] = len(aisles)
+                    aisles.append(aisle)
+                aisle_codes[idx] = aisle_lookup[aisle]
+            
+            department = info.get('department')
+            if department:
+                if department not in department_lookup:
+                    department_lookup[department] = len(departments)
+                    departments.append(department)
+                department_codes[idx] = department_lookup[department]
+            
+            aisle_ids[idx] = info.get('aisle_id', 0)
+            department_ids[idx] = info.get('department_id', 0)
+        
+        name_offsets = np.zeros(num_items + 1, dtype=np.int64)
+        name_offsets[1:] = np.cumsum([len(name) for name in encoded_names])
+        
+        arrays.update({
+            'name_offsets': name_offsets,
+            'names': np.frombuffer(b''.join(encoded_names), dtype=np.uint8),
+            'aisle_codes': aisle_codes,
+            'department_codes': department_codes,
+            'aisle_ids': aisle_ids,
+            'department_ids': department_ids,
+        })
+        meta = {
+            'format_version': FORMAT_VERSION,
+            'num_items': num_items,
+            'aisles': aisles,
+            'departments': departments,
+        }
+        return cls(arrays, meta)
+    
+    @classmethod
+    def from_pickle(cls, path: str) -> 'CompactVocabulary':
+        """Convert an existing vocabulary.pkl, recording its fingerprint."""
+        with open(path, 'rb') as f:
+            vocabulary = cls.from_dict(pickle.load(f))
+        vocabulary.meta['source'] = pickle_fingerprint(path)
+        return vocabulary
+    
+    @classmethod
+    def load(cls, directory: str, mmap: bool = True) -> 'CompactVocabulary':
+        """Open a vocabulary directory written by save()."""
+        with open(os.path.join(directory, 'meta.json')) as f:
+            meta = json.load(f)
+        if meta.get('format_version') != FORMAT_VERSION:
+            raise ValueError(f"Unsupported vocabulary format: {meta.get('format_version')}")
+        
+        mmap_mode = 'r' if mmap else None
+        arrays = {}
+        for filename in os.listdir(directory):
+            name, ext = os.path.splitext(filename)
+            if ext == '.npy':
+                arrays[name] = np.load(os.path.join(directory, filename), mmap_mode=mmap_mode)
+        
+        names_path = os.path.join(directory, 'names.bin')
+        if mmap and os.path.getsize(names_path) > 0:
+            arrays['names'] = np.memmap(names_path, dtype=np.uint8, mode='r')
+        else:
+            arrays['names'] = np.fromfile(names_path, dtype=np.uint8)
+        return cls(arrays, meta)
+    
+    def save(self, directory: str):
+        """Write the vocabulary as a directory of .npy files plus meta.json."""
+        os.makedirs(directory, exist_ok=True)
+        for name in ('item_ids', 'sorted_ids', 'sorted_idx', 'dense_index', 'name_offsets',
+                     'aisle_codes', 'department_codes', 'aisle_ids', 'department_ids'):
+            array = getattr(self, name)
+            if array is not None:
+                np.save(os.path.join(directory, f'{name}.npy'), np.ascontiguousarray(array))
+        np.asarray(self.names, dtype=np.uint8).tofile(os.path.join(directory, 'names.bin'))
+        with open(os.path.join(directory, 'meta.json'), 'w') as f:
+            json.dump(self.meta, f)
+    
+    def lookup(self, product_ids: Iterable[int]) -> np.ndarray:
+        """
+        Map product IDs to item indices (vectorized).
+        
+        Returns:
+            int64 array of indices, 0 for products not in the vocabulary
+        """
+        ids = np.asarray(product_ids, dtype=np.int64).reshape(-1)
+        if len(self.sorted_ids) == 0:
+            return np.zeros(len(ids), dtype=np.int64)
+        if self.dense_index is not None:
+            in_range = (ids >= 0) & (ids < len(self.dense_index))
+            result = np.zeros(len(ids), dtype=np.int64)
+            result[in_range] = self.dense_index[ids[in_range]]
+            return result
+        
+        positions = np.searchsorted(self.sorted_ids, ids)
+        positions = np.minimum(positions, len(self.sorted_ids) - 1)
+        found = self.sorted_ids[positions] == ids
+        return np.where(found, self.sorted_idx[positions], 0).astype(np.int64)
+    
+    def contains(self, product_ids: Iterable[int]) -> np.ndarray:
+        """Boolean mask of which product IDs are in the vocabulary."""
+        return self.lookup(product_ids) > 0
+    
+    def item_id(self, idx: int) -> int:
+        """Product ID for an item index."""
+        return int(self.item_ids[idx])
+    
+    def name(self, idx: int) -> Optional[str]:
+        start, end = self.name_offsets[idx], self.name_offsets[idx + 1]
+        if start == end:
+            return None
+        return bytes(self.names[start:end]).decode('utf-8')
+    
+    def metadata(self, idx: int) -> Dict[str, Optional[str]]:
+        """Product metadata (name, aisle, department) for an item index."""
+        aisle_code = self.aisle_codes[idx]
+        department_code = self.department_codes[idx]
+        return {
+            'name': self.name(idx),
+            'aisle': self.aisles[aisle_code] if aisle_code >= 0 else None,
+            'department': self.departments[department_code] if department_code >= 0 else None,
+        }
+    
+    @property
+    def has_product_info(self) -> bool:
+        return len(self.names) > 0 or bool(self.aisles)
+
+
+def file_sha256(path: str) -> str:
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def pickle_fingerprint(path: str) -> Dict:
+    """Size, modification time and content hash of a vocabulary.pkl."""
+    stat = os.stat(path)
+    return {'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns, 'sha256': file_sha256(path)}
+
+
+def is_current(directory: str, vocab_path: str) -> bool:
+    """Whether a compact vocabulary directory was converted from vocab_path as it is now."""
+    meta_path = os.path.join(directory, 'meta.json')
+    with open(meta_path) as f:
+        source = json.load(f).get('source')
+    stat = os.stat(vocab_path)
+    if source is None:
+        # Converted before fingerprints were recorded: compare modification times
+        return stat.st_mtime <= os.path.getmtime(meta_path)
+    if source['size'] != stat.st_size:
+        return False
+    if source['mtime_ns'] == stat.st_mtime_ns:
+        return True
+    # Touched or copied since conversion; only the contents matter
+    return source['sha256'] == file_sha256(vocab_path)
+
+
+def compact_vocabulary_dir(vocab_path: str) -> str:
+    """Directory holding the compact form of a vocabulary.pkl (models/vocabulary.pkl -> models/vocabulary)."""
+    root, ext = os.path.splitext(vocab_path)
+    return root if ext == '.pkl' else vocab_path
+
+
+def load_vocabulary(vocab_path: str) -> CompactVocabulary:
+    """
+    Load a vocabulary for serving.
+    
+    Accepts either a compact vocabulary directory or a vocabulary.pkl path.
+    For a .pkl path, the sibling compact directory is used when it was
+    converted from the pickle as it is now; otherwise the pickle is
+    converted in memory.
+    """
+    directory = compact_vocabulary_dir(vocab_path)
+    if os.path.isdir(directory):
+        if directory == vocab_path or not os.path.exists(vocab_path) or is_current(directory, vocab_path):
+            return CompactVocabulary.load(directory)
+        print(f"WARNING: compact vocabulary at {directory} does not match {vocab_path} (was preprocessing "
+              f"rerun?); converting the pickle in memory instead. Run scripts/convert_vocabulary.py "
+              f"--input {vocab_path} to update it.")
+        return CompactVocabulary.from_pickle(vocab_path)
+    
+    print(f"Compact vocabulary not found at {directory}, converting {vocab_path} in memory "
+          f"(run scripts/convert_vocabulary.py to speed up startup)")
+    return CompactVocabulary.from_pickle(vocab_path)
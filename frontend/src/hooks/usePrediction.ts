@@ -1,8 +1,12 @@
 /**
  * Hook for making predictions using the backend API
+ *
+ * Cart changes are streamed as deltas over one WebSocket (/ws/predict) and
+ * the backend pushes updated predictions back. If the socket can't be
+ * opened, each change falls back to a POST /predict.
  */
 
-import { useState, useCallback } from 'react';
+import { useState, useCallback, useEffect, useRef } from 'react';
 import { generateMockPredictions, MOCK_PRODUCTS } from '@/data/mockProducts';
 
 export interface CartItem {
@@ -24,7 +28,39 @@ export interface PredictResponse {
   co_purchase: any[];
 }
 
+type CartDelta =
+  | { type: 'set'; cart: string[]; top_k: number }
+  | { type: 'add'; product_id: string; top_k: number }
+  | { type: 'remove'; product_id: string; top_k: number };
+
 const API_BASE_URL = import.meta.env.VITE_API_URL || 'http://localhost:8000';
+const WS_URL = import.meta.env.VITE_WS_URL || `${API_BASE_URL.replace(/^http/, 'ws')}/ws/predict`;
+
+// After a failed connection attempt, use HTTP for this long before retrying
+const WS_RETRY_MS = 30000;
+
+/**
+ * Smallest message that turns the server's cart into `next`, or null if
+ * nothing the model sees has changed (e.g. only a quantity).
+ */
+function cartDelta(prev: string[] | null, prevTopK: number, next: string[], topK: number): CartDelta | null {
+  if (prev === null) {
+    return { type: 'set', cart: next, top_k: topK };
+  }
+  if (next.length === prev.length + 1 && prev.every((id, i) => next[i] === id)) {
+    return { type: 'add', product_id: next[next.length - 1], top_k: topK };
+  }
+  if (next.length === prev.length - 1) {
+    const removed = prev.find((id) => !next.includes(id));
+    if (removed !== undefined && prev.filter((id) => id !== removed).every((id, i) => next[i] === id)) {
+      return { type: 'remove', product_id: removed, top_k: topK };
+    }
+  }
+  if (topK === prevTopK && next.length === prev.length && prev.every((id, i) => next[i] === id)) {
+    return null;
+  }
+  return { type: 'set', cart: next, top_k: topK };
+}
 
 export function usePrediction() {
   const [predictions, setPredictions] = useState<PredictionItem[]>([]);
@@ -32,13 +68,18 @@ export function usePrediction() {
   const [error, setError] = useState<string | null>(null);
   const [isOfflineMode, setIsOfflineMode] = useState(false);
 
-  const getPredictions = useCallback(async (cart: CartItem[], topK: number = 10) => {
-    if (cart.length === 0) {
-      setPredictions([]);
-      setIsOfflineMode(false);
-      return;
-    }
+  // WebSocket session state
+  const socketRef = useRef<WebSocket | null>(null);
+  const connectingRef = useRef<Promise<WebSocket | null> | null>(null);
+  const retryAtRef = useRef(0);
+  const sessionCartRef = useRef<string[] | null>(null); // cart as the server has it
+  const sessionTopKRef = useRef(0);
+  const sentRef = useRef(0); // messages sent on the current socket (matches the server's seq)
+  const pendingRef = useRef(false);
+  const replyTimerRef = useRef<ReturnType<typeof setTimeout>>();
+  const lastRequestRef = useRef<{ cart: CartItem[]; topK: number } | null>(null);
 
+  const fetchPredictions = useCallback(async (cart: CartItem[], topK: number) => {
     setLoading(true);
     setError(null);
 
@@ -85,6 +126,108 @@ export function usePrediction() {
     }
   }, []);
 
+  const connectSocket = useCallback((): Promise<WebSocket | null> => {
+    if (typeof WebSocket === 'undefined' || Date.now() < retryAtRef.current) {
+      return Promise.resolve(null);
+    }
+    if (socketRef.current?.readyState === WebSocket.OPEN) {
+      return Promise.resolve(socketRef.current);
+    }
+    if (connectingRef.current) {
+      return connectingRef.current;
+    }
+
+    connectingRef.current = new Promise((resolve) => {
+      const socket = new WebSocket(WS_URL);
+      const connectTimer = setTimeout(() => socket.close(), 3000);
+
+      socket.onopen = () => {
+        clearTimeout(connectTimer);
+        connectingRef.current = null;
+        socketRef.current = socket;
+        sessionCartRef.current = null;
+        sentRef.current = 0;
+        resolve(socket);
+      };
+
+      socket.onmessage = (event) => {
+        const data = JSON.parse(event.data);
+        if (data.type === 'error') {
+          // Out of sync with the server; start over on HTTP
+          console.warn('Streaming prediction error:', data.detail);
+          socket.close();
+          return;
+        }
+        // Only the reply to the newest cart matters
+        if (!pendingRef.current || data.seq !== sentRef.current) {
+          return;
+        }
+        pendingRef.current = false;
+        clearTimeout(replyTimerRef.current);
+        setPredictions(data.next_item_predictions);
+        setError(null);
+        setIsOfflineMode(false);
+        setLoading(false);
+      };
+
+      socket.onclose = () => {
+        clearTimeout(connectTimer);
+        clearTimeout(replyTimerRef.current);
+        connectingRef.current = null;
+        if (socketRef.current === socket) {
+          socketRef.current = null;
+          // Answer an unanswered cart change over HTTP instead
+          const last = lastRequestRef.current;
+          if (pendingRef.current && last) {
+            pendingRef.current = false;
+            fetchPredictions(last.cart, last.topK);
+          }
+        } else {
+          retryAtRef.current = Date.now() + WS_RETRY_MS;
+        }
+        resolve(null);
+      };
+    });
+    return connectingRef.current;
+  }, [fetchPredictions]);
+
+  useEffect(() => () => {
+    pendingRef.current = false;
+    socketRef.current?.close();
+  }, []);
+
+  const getPredictions = useCallback(async (cart: CartItem[], topK: number = 10) => {
+    if (cart.length === 0) {
+      pendingRef.current = false;
+      setPredictions([]);
+      setIsOfflineMode(false);
+      return;
+    }
+
+    lastRequestRef.current = { cart, topK };
+    const socket = await connectSocket();
+    if (!socket) {
+      await fetchPredictions(cart, topK);
+      return;
+    }
+
+    const ids = cart.map((item) => item.product_id);
+    const delta = cartDelta(sessionCartRef.current, sessionTopKRef.current, ids, topK);
+    if (delta === null) {
+      return;
+    }
+    sessionCartRef.current = ids;
+    sessionTopKRef.current = topK;
+    sentRef.current += 1;
+    pendingRef.current = true;
+    setLoading(true);
+    socket.send(JSON.stringify(delta));
+
+    // Same 5 second budget as HTTP; closing falls back to fetch
+    clearTimeout(replyTimerRef.current);
+    replyTimerRef.current = setTimeout(() => socket.close(), 5000);
+  }, [connectSocket, fetchPredictions]);
+
   const checkHealth = useCallback(async () => {
     try {
       const response = await fetch(`${API_BASE_URL}/health`, {